@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Check the accuracy of pylaprof's sampling engines against synthetic workloads.
+
+The share of samples of each task of a `workload.Workload` is compared with the share
+of time actually spent in it: wall-clock time of all threads for the thread engine and
+CPU time of the main thread for the signal engine (which samples only the main thread,
+and only while the process consumes CPU).
+"""
+
+import argparse
+import json
+import sys
+
+from engines import Null, shares
+from workload import Workload, expected_shares
+
+from pylaprof import Profiler, StackCollapse
+
+
+def check(workload, engine="thread", period=0.001):
+    """
+    Profile `workload` and return `{task: (expected share, measured share)}`.
+    """
+    sampler = StackCollapse()
+    single = engine == "signal"
+    with Profiler(
+        period=period, single=single, sampler=sampler, storer=Null(), engine=engine
+    ):
+        truth = workload.run()
+
+    if engine == "signal":
+        expected = expected_shares(truth, "cpu", threads={0})
+    else:
+        expected = expected_shares(truth, "wall")
+    names = [task.name for task in workload.tasks]
+    measured, _ = shares(sampler, names)
+    return {name: (expected.get(name, 0), measured[name]) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="check the accuracy of pylaprof against synthetic workloads"
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=["thread", "signal"],
+        default=["thread", "signal"],
+        help="sampling engines to check (default: thread signal)",
+    )
+    parser.add_argument(
+        "--periods",
+        nargs="+",
+        type=float,
+        default=[0.01, 0.001],
+        help="sampling periods to check (default: 0.01 0.001)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1, help="number of threads (default: 1)"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=0, help="stack depth of tasks (default: 0)"
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=10,
+        help="iterations over tasks per thread (default: 10)",
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    opts = parser.parse_args(sys.argv[1:])
+
+    workload = Workload(
+        threads=opts.threads, depth=opts.depth, iterations=opts.iterations
+    )
+    results = {}
+    for engine in opts.engines:
+        for period in opts.periods:
+            result = check(workload, engine=engine, period=period)
+            results[f"{engine}/{period}"] = result
+            print(f"{engine} engine, period {period}:")
+            print(f"{'task':>12} {'expected%':>10} {'measured%':>10} {'error%':>8}")
+            for name, (expected, measured) in result.items():
+                print(
+                    f"{name:>12} {100 * expected:10.2f} {100 * measured:10.2f}"
+                    f" {100 * abs(measured - expected):8.2f}"
+                )
+            print()
+
+    if opts.json:
+        with open(opts.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Compare overhead and accuracy of pylaprof's sampling engines.
+
+The workload is CPU-bound and spends a known fraction of its time in `heavy` (75%) and
+the rest in `light` (25%): the closer the share of samples of each function to those
+values, the more accurate the engine.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+from pylaprof import Profiler, StackCollapse, Storer
+
+
+class Null(Storer):
+    """Storer that doesn't do anything with the record file."""
+
+    def store(self, file):
+        pass
+
+
+def spin(duration):
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        pass
+
+
+def light(duration):
+    spin(duration)
+
+
+def heavy(duration):
+    spin(duration)
+
+
+def workload(duration, chunk=0.004):
+    for _ in range(int(duration / (4 * chunk))):
+        light(chunk)
+        heavy(3 * chunk)
+
+
+def shares(sampler, names=("light", "heavy")):
+    """
+    Return the share of samples of each function in `names` among the samples of all
+    of them, and their number: a sample is attributed to the innermost function of
+    `names` in its stack.
+    """
+    hits = dict.fromkeys(names, 0)
+    for stack, count in sampler._data.items():
+        for frame in stack:  # Innermost frame first
+            funcname = frame.split(" ", 1)[0]
+            if funcname in hits:
+                hits[funcname] += count
+                break
+    total = sum(hits.values()) or 1
+    return {k: v / total for k, v in hits.items()}, total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare overhead and accuracy of pylaprof's sampling engines"
+    )
+    parser.add_argument(
+        "--period",
+        metavar="PERIOD",
+        type=float,
+        default=0.001,
+        help="`period` parameter for pylaprof (default: 0.001)",
+    )
+    parser.add_argument(
+        "--duration",
+        metavar="SECONDS",
+        type=float,
+        default=1.0,
+        help="duration of the workload (default: 1.0)",
+    )
+    parser.add_argument(
+        "--iterations",
+        metavar="NUM",
+        type=int,
+        default=5,
+        help="number of executions (default: 5)",
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    print(
+        "Running a",
+        opts.duration,
+        "seconds workload (25% light, 75% heavy)",
+        opts.iterations,
+        "times per engine.\n",
+    )
+
+    durations = {"native": [], "thread": [], "signal": []}
+    errors = {"thread": [], "signal": []}
+    for i in range(opts.iterations):
+        start = time.perf_counter()
+        workload(opts.duration)
+        durations["native"].append(time.perf_counter() - start)
+
+        for engine in ("thread", "signal"):
+            sampler = StackCollapse()
+            start = time.perf_counter()
+            with Profiler(
+                period=opts.period, sampler=sampler, storer=Null(), engine=engine
+            ):
+                workload(opts.duration)
+            durations[engine].append(time.perf_counter() - start)
+            share, _ = shares(sampler)
+            errors[engine].append(abs(share["heavy"] - 0.75))
+
+    native = statistics.mean(durations["native"])
+    print("native:\n\t", native, "seconds per execution")
+    for engine in ("thread", "signal"):
+        print(
+            f"{engine} engine (period {opts.period}):\n\t",
+            statistics.mean(durations[engine]) - native,
+            "seconds of overhead per execution\n\t",
+            statistics.mean(errors[engine]),
+            "mean absolute error on the share of `heavy`",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Compare pylaprof on GIL and free-threaded CPython builds with multi-threaded
+CPU-bound workloads.
+
+Run it with both builds of the same Python version (e.g. `python3.13` and
+`python3.13t`) and compare their results:
+- workload: wall-clock time of threads running the same CPU-bound loop, natively and
+  profiled with `single=False` (a single profiler thread walking all the stacks while
+  they keep running);
+- shared: threads sampling their own stack at the same time into a single sampler,
+  as per-thread profilers sharing it would do: wall-clock time per sample (it goes
+  down with threads only if they sample in parallel) and share of samples lost, for
+  `StackCollapse` and `SharedStackCollapse`.
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from engines import Null
+
+from pylaprof import Profiler, SharedStackCollapse, StackCollapse
+
+
+def build():
+    """Return the kind of the running build: "GIL" or "free-threaded"."""
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    return "GIL" if gil else "free-threaded"
+
+
+def spin(iterations):
+    total = 0
+    for i in range(iterations):
+        total += i
+    return total
+
+
+def run_threads(count, target, *args):
+    """Run `target(*args)` in `count` threads at once, return the wall-clock time."""
+    barrier = threading.Barrier(count + 1)
+
+    def run():
+        barrier.wait()
+        target(*args)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_workload(count, iterations, period):
+    native = run_threads(count, spin, iterations)
+    sampler = StackCollapse()
+    with Profiler(period=period, single=False, sampler=sampler, storer=Null()):
+        profiled = run_threads(count, spin, iterations)
+    return {
+        "native": native,
+        "profiled": profiled,
+        "overhead": profiled / native - 1,
+        "samples": sum(sampler._data.values()),
+    }
+
+
+def bench_shared(count, samples, sampler):
+    def sample():
+        frame = sys._getframe()
+        for _ in range(samples):
+            sampler.sample(frame)
+
+    duration = run_threads(count, sample)
+    hits = sum(sampler.snapshot()._data.values())
+    return {
+        "per_sample": duration / (count * samples),
+        "lost": 1 - hits / (count * samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare pylaprof on GIL and free-threaded builds"
+    )
+    parser.add_argument(
+        "--threads",
+        nargs="+",
+        type=int,
+        default=[1, 4, 8],
+        help="thread counts (default: 1 4 8)",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=2000000,
+        help="iterations of the CPU-bound loop per thread (default: 2000000)",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=20000,
+        help="samples per thread into the shared sampler (default: 20000)",
+    )
+    parser.add_argument(
+        "--period", type=float, default=0.001, help="sampling period (default: 0.001)"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    opts = parser.parse_args(sys.argv[1:])
+
+    results = {"python": sys.version, "build": build(), "workload": {}, "shared": {}}
+    print(f"Python {sys.version.split()[0]} ({results['build']} build)\n")
+    print(f"{'threads':>8} {'native s':>10} {'profiled s':>11} {'overhead%':>10}")
+    for count in opts.threads:
+        result = bench_workload(count, opts.iterations, opts.period)
+        results["workload"][count] = result
+        print(
+            f"{count:>8} {result['native']:10.3f} {result['profiled']:11.3f}"
+            f" {100 * result['overhead']:10.2f}"
+        )
+
+    print(f"\n{'sampler':>20} {'threads':>8} {'us/sample':>10} {'lost%':>7}")
+    for cls in (StackCollapse, SharedStackCollapse):
+        for count in opts.threads:
+            result = bench_shared(count, opts.samples, cls())
+            results["shared"][f"{cls.__name__}/{count}"] = result
+            print(
+                f"{cls.__name__:>20} {count:>8} {1e6 * result['per_sample']:10.2f}"
+                f" {100 * result['lost']:7.2f}"
+            )
+
+    if opts.json:
+        with open(opts.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
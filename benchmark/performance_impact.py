@@ -32,6 +32,12 @@ def main():
         default=0.01,
         help="`period` parameter for pylaprof (default: 0.01)",
     )
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "signal"],
+        default="thread",
+        help="`engine` parameter for pylaprof (default: thread)",
+    )
     parser.add_argument(
         "--iterations",
         metavar="NUM",
@@ -47,7 +53,7 @@ def main():
     durations_pylaprof = []
     for i in range(opts.iterations):
         start = time.time()
-        with Profiler(period=opts.period, storer=Null()):
+        with Profiler(period=opts.period, storer=Null(), engine=opts.engine):
             handler({"dummy": "event"}, {"dummy": "context"})
         durations_pylaprof.append(time.time() - start)
 
@@ -66,7 +72,7 @@ def main():
 
     print(
         'Performance stats for `handler({"dummy": "event"}, {"dummy": "context"})`',
-        f"(pylaprof enabled with period {opts.period}):\n\t",
+        f"(pylaprof enabled with period {opts.period}, {opts.engine} engine):\n\t",
         statistics.mean(durations_pylaprof),
         "+-",
         statistics.stdev(durations_pylaprof),
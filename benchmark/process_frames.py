@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 
 import argparse
-import pickle
 import statistics
 import sys
-import time
 
-from record_frames import Code, Frame  # noqa
+from replay import Recording, replay
 
-from pylaprof import StackCollapse
+from pylaprof import BoundedStackCollapse, StackCollapse
+
+SAMPLERS = {
+    "stackcollapse": StackCollapse,
+    "function": lambda: StackCollapse(granularity="function"),
+    "lines": lambda: StackCollapse(lines=True),
+    "bounded": BoundedStackCollapse,
+}
 
 
 def main():
-    parser = argparse.ArgumentParser(sys.argv[0])
     parser = argparse.ArgumentParser(
-        description="benchmark sampler's processing of data generated by `record_frames.py`"  # noqa
+        description="benchmark sampler's processing of data recorded by `record_frames.py`"  # noqa
+    )
+    parser.add_argument(
+        "file",
+        metavar="FILE",
+        nargs="?",
+        default="frames.rec",
+        help="recording to replay (default: frames.rec)",
     )
     parser.add_argument(
         "--iterations",
@@ -23,21 +34,39 @@ def main():
         default=100,
         help="number of iterations over frames data (default: 100)",
     )
+    parser.add_argument(
+        "--sampler",
+        choices=sorted(SAMPLERS),
+        default="stackcollapse",
+        help="sampler to benchmark (default: stackcollapse)",
+    )
+    parser.add_argument(
+        "--thread",
+        type=int,
+        action="append",
+        help="replay only snapshots of this thread identifier (can be repeated)",
+    )
     opts = parser.parse_args(sys.argv[1:])
 
-    sampler = StackCollapse()
-    with open("frames.dump", "rb") as fp:
-        frames = pickle.load(fp)
+    with Recording(opts.file) as recording:
+        snapshots = len(recording)
+        threads = set(recording.threads)
+        frames = recording.frames(threads=opts.thread)
+        duration = recording.times[-1] - recording.times[0] if snapshots else 0
+    print(
+        f"Recording of {snapshots} snapshots over {duration:.2f} seconds from"
+        f" {len(threads)} thread(s): {', '.join(map(str, sorted(threads)))}.",
+    )
+    if not frames:
+        parser.error("no snapshots to replay")
 
-    print("Iterating", opts.iterations, "times over", len(frames), "frames.\n")
+    print("Iterating", opts.iterations, "times over", len(frames), "snapshots.\n")
     durations = []
     for i in range(opts.iterations):
-        start = time.time()
-        for frame in frames:
-            sampler.sample(frame)
-        durations.append(time.time() - start)
+        sampler = SAMPLERS[opts.sampler]()
+        durations.append(replay(frames, sampler))
 
-    # Normalize by number of stack frames (in this way we get how much it took on
+    # Normalize by number of stack snapshots (in this way we get how much it took on
     # average to process one single stack record)
     durations = [d / len(frames) for d in durations]
 
@@ -0,0 +1,218 @@
+"""Record stack snapshots in a compact binary format and replay them to samplers.
+
+A recording is made of timestamped, per-thread stack snapshots. Code objects are
+interned in a table and each snapshot is stored as a slice of two flat arrays of
+indexes in that table and line numbers, outermost frame first. Layout of the file
+(native byte order, every array is aligned to its item size):
+
+    MAGIC                        8 bytes
+    ORDER, samples, frames, len  4 x uint64 (byte order mark, counts, JSON length)
+    times                        float64[samples]  (`time.time()` of each snapshot)
+    threads                      uint64[samples]   (thread identifier)
+    starts                       uint64[samples + 1]  (snapshot i is frames
+                                                      starts[i]:starts[i + 1])
+    codes                        uint32[frames]    (index in the code table)
+    lines                        int32[frames]     (line number)
+    code table                   JSON list of [filename, name, firstlineno, module]
+
+`Recording` memory-maps a file and exposes those arrays without copying them.
+"""
+
+import json
+import mmap
+import struct
+import sys
+import time
+from array import array
+
+from pylaprof import Sampler
+
+MAGIC = b"PYLAREC1"
+ORDER = 0x0102030405060708
+HEADER = struct.Struct("=8s4Q")
+
+
+class Code:
+    """Stand-in for Python's code objects."""
+
+    __slots__ = ("co_filename", "co_name", "co_firstlineno")
+
+    def __init__(self, co_filename, co_name, co_firstlineno):
+        self.co_filename = co_filename
+        self.co_name = co_name
+        self.co_firstlineno = co_firstlineno
+
+
+class Frame:
+    """Stand-in for Python's frame objects."""
+
+    __slots__ = ("f_code", "f_lineno", "f_back", "f_globals")
+
+    def __init__(self, f_code, f_lineno, f_back, f_globals):
+        self.f_code = f_code
+        self.f_lineno = f_lineno
+        self.f_back = f_back
+        self.f_globals = f_globals
+
+
+class Recorder(Sampler):
+    """
+    Sampler that records every stack snapshot it gets: its `dump` writes a recording.
+    """
+
+    def __init__(self):
+        self.times = array("d")
+        self.threads = array("Q")
+        self.starts = array("Q", [0])
+        self.codes = array("I")
+        self.lines = array("i")
+        self.table = []
+        self._index = {}  # Code object -> index in `table`
+        self._roots = {}  # Outermost frame of running threads -> thread identifier
+
+    def _thread(self, root):
+        # `sample` isn't told which thread a frame belongs to: look for the thread
+        # whose stack has the same outermost frame, just once per thread. The cache is
+        # rebuilt from running threads only, so that we don't keep the frames (and
+        # their locals) of threads that ended alive.
+        ident = self._roots.get(root)
+        if ident is None:
+            roots = {}
+            for candidate, frame in sys._current_frames().items():
+                while frame.f_back is not None:
+                    frame = frame.f_back
+                roots[frame] = candidate
+            ident = roots[root] = roots.get(root, 0)
+            self._roots = roots
+        return ident
+
+    def sample(self, frame):
+        now = time.time()
+        stack = []
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+
+        index = self._index
+        for frame in reversed(stack):
+            code = frame.f_code
+            i = index.get(code)
+            if i is None:
+                i = index[code] = len(self.table)
+                module = frame.f_globals.get("__name__") or ""
+                self.table.append(
+                    [code.co_filename, code.co_name, code.co_firstlineno, module]
+                )
+            self.codes.append(i)
+            self.lines.append(frame.f_lineno or 0)
+
+        self.times.append(now)
+        self.threads.append(self._thread(stack[-1]) if stack else 0)
+        self.starts.append(len(self.codes))
+
+    def dump(self, file):
+        table = json.dumps(self.table).encode()
+        file.write(
+            HEADER.pack(MAGIC, ORDER, len(self.times), len(self.codes), len(table))
+        )
+        for data in (self.times, self.threads, self.starts, self.codes, self.lines):
+            file.write(data)
+        file.write(table)
+
+
+class Recording:
+    """
+    Memory-mapped recording: `times`, `threads`, `starts`, `codes` and `lines` are
+    memoryviews of the file's arrays and `table` is the list of recorded code objects
+    (as `Code` instances).
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, order, samples, frames, length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+        if order != ORDER:
+            raise ValueError(f"{path} was recorded with a different byte order")
+
+        view = self._view = memoryview(self._mmap)
+        offset = HEADER.size
+        arrays = []
+        for fmt, count in (
+            ("d", samples),
+            ("Q", samples),
+            ("Q", samples + 1),
+            ("I", frames),
+            ("i", frames),
+        ):
+            end = offset + count * struct.calcsize(fmt)
+            arrays.append(view[offset:end].cast(fmt))
+            offset = end
+        self.times, self.threads, self.starts, self.codes, self.lines = arrays
+        self.globals = []
+        self.table = []
+        end = offset + length
+        for filename, name, firstlineno, module in json.loads(bytes(view[offset:end])):
+            self.table.append(Code(filename, name, firstlineno))
+            self.globals.append({"__name__": module})
+
+    def __len__(self):
+        return len(self.times)
+
+    def stack(self, i):
+        """Return the i-th snapshot as a list of `(Code, lineno)`, outermost first."""
+        start, end = self.starts[i], self.starts[i + 1]
+        table = self.table
+        return [
+            (table[code], line)
+            for code, line in zip(self.codes[start:end], self.lines[start:end])
+        ]
+
+    def frames(self, threads=None):
+        """
+        Rebuild the snapshots of the given thread identifiers (all of them if None) as
+        chains of `Frame` instances: return the list of their innermost frames.
+
+        Frames are interned, snapshots sharing a stack prefix share its frames.
+        """
+        table, globals_ = self.table, self.globals
+        codes, lines, starts = self.codes, self.lines, self.starts
+        interned = {}
+        leaves = []
+        for i, thread in enumerate(self.threads):
+            if threads is not None and thread not in threads:
+                continue
+            frame = None
+            for j in range(starts[i], starts[i + 1]):
+                key = (frame, codes[j], lines[j])
+                child = interned.get(key)
+                if child is None:
+                    child = interned[key] = Frame(
+                        table[codes[j]], lines[j], frame, globals_[codes[j]]
+                    )
+                frame = child
+            leaves.append(frame)
+        return leaves
+
+    def close(self):
+        for data in (self.times, self.threads, self.starts, self.codes, self.lines):
+            data.release()
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def replay(frames, sampler):
+    """Feed `frames` (e.g. from `Recording.frames`) to `sampler` at full speed and
+    return the time it took."""
+    sample = sampler.sample
+    start = time.perf_counter()
+    for frame in frames:
+        sample(frame)
+    return time.perf_counter() - start
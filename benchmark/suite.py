@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""Reproducible, offline benchmark suite for pylaprof.
+
+Measures the cost of sampling, the overhead of profiling, the throughput of reports'
+dump/store and merge, and the accuracy of the sampling engines. Results are written as
+JSON and can be compared with a baseline: the script exits with status 1 if any metric
+regressed beyond the tolerance.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from engines import Null, shares, workload
+
+from pylaprof import FS, Aggregate, Profiler, StackCollapse, Threads
+from pylaprof.scripts.analyze import Columns
+from pylaprof.scripts.merge import merge
+
+
+def best(func, repeat):
+    """Return the shortest execution time of `func` over `repeat` runs."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def idle_threads(count, depth, name=None):
+    """Start `count` threads (named `name`) blocked at stack depth `depth`; return an
+    event that releases them."""
+    release = threading.Event()
+    ready = threading.Barrier(count + 1)
+
+    def nest(n):
+        if n > 0:
+            return nest(n - 1)
+        ready.wait()
+        release.wait()
+
+    for _ in range(count):
+        threading.Thread(target=nest, args=(depth,), name=name, daemon=True).start()
+    ready.wait()
+    return release
+
+
+def bench_sample_depth(results, repeat, depths=(10, 50, 200)):
+    """Cost of `StackCollapse.sample` against stack depth."""
+    for depth in depths:
+        release = idle_threads(1, depth)
+        ident = [i for i in sys._current_frames() if i != threading.get_ident()][-1]
+        frame = sys._current_frames()[ident]
+        sampler = StackCollapse()
+        n = 1000
+        duration = best(lambda: [sampler.sample(frame) for _ in range(n)], repeat)
+        release.set()
+        results[f"sample.depth_{depth}"] = {
+            "value": duration / n,
+            "unit": "s/sample",
+        }
+
+
+def bench_tick_threads(results, repeat, counts=(1, 10, 100)):
+    """Cost of one profiler tick (with `single=False`) against thread count."""
+    for count in counts:
+        release = idle_threads(count, 20)
+        sampler = StackCollapse()
+        me = threading.get_ident()
+
+        def tick():
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    sampler.sample(frame)
+
+        n = 100
+        duration = best(lambda: [tick() for _ in range(n)], repeat)
+        release.set()
+        results[f"tick.threads_{count}"] = {"value": duration / n, "unit": "s/tick"}
+
+
+def bench_tick_selected(results, repeat, counts=(100, 300)):
+    """Cost of one profiler tick sampling one thread selected by name (`Threads`)
+    against thread count."""
+    for count in counts:
+        release = idle_threads(count, 20)
+        target = idle_threads(1, 20, name="target")
+        sampler = StackCollapse()
+        select = Threads(name="target$").select
+
+        def tick():
+            for ident, frame in select(sys._current_frames()):
+                sampler.sample(frame)
+
+        n = 100
+        duration = best(lambda: [tick() for _ in range(n)], repeat)
+        release.set()
+        target.set()
+        results[f"tick.selected_1_of_{count}"] = {
+            "value": duration / n,
+            "unit": "s/tick",
+        }
+
+
+def bench_overhead(results, repeat, duration, periods=(0.01, 0.001)):
+    """Overhead of profiling a CPU-bound workload against sampling period."""
+    native = best(lambda: workload(duration), repeat)
+    for period in periods:
+
+        def profiled():
+            with Profiler(period=period, sampler=StackCollapse(), storer=Null()):
+                workload(duration)
+
+        results[f"overhead.period_{period}"] = {
+            "value": max(best(profiled, repeat) / native - 1, 0),
+            "unit": "fraction",
+            "abs_tolerance": 0.01,
+        }
+
+
+def synthetic_sampler(stacks, depth=30):
+    """Return a `StackCollapse` holding `stacks` distinct stacks."""
+    sampler = StackCollapse()
+    for i in range(stacks):
+        stack = tuple(f"f{i}_{j} (module{j}.py:{j})" for j in range(depth))
+        sampler._data[stack] = i + 1
+    return sampler
+
+
+def bench_dump_store(results, repeat, tmpdir, stacks=10000):
+    """Throughput of `StackCollapse.dump` and `FS.store`."""
+    sampler = synthetic_sampler(stacks)
+    results["dump"] = {
+        "value": stacks / best(lambda: sampler.dump(BytesIO()), repeat),
+        "unit": "stacks/s",
+        "better": "higher",
+    }
+
+    file = BytesIO()
+    sampler.dump(file)
+    storer = FS(path=lambda: os.path.join(tmpdir, "report.txt"))
+
+    def store():
+        file.seek(0)
+        storer.store(file)
+
+    results["store.fs"] = {
+        "value": file.tell() / best(store, repeat) / 2 ** 20,
+        "unit": "MiB/s",
+        "better": "higher",
+    }
+
+
+def bench_merge(results, repeat, tmpdir, counts=(10, 100), stacks=1000):
+    """Throughput of `pylaprof-merge` against the number of files."""
+    file = BytesIO()
+    synthetic_sampler(stacks).dump(file)
+    for count in counts:
+        files = []
+        for i in range(count):
+            files.append(os.path.join(tmpdir, f"merge-{i}.txt"))
+            with open(files[-1], "wb") as fp:
+                fp.write(file.getvalue())
+        dst = os.path.join(tmpdir, "merged.txt")
+        results[f"merge.files_{count}"] = {
+            "value": count * stacks / best(lambda: merge(files, dst), repeat),
+            "unit": "lines/s",
+            "better": "higher",
+        }
+
+
+def bench_analyze(results, repeat, stacks=10000):
+    """Throughput of `pylaprof-analyze`'s queries (with NumPy if it's installed)."""
+    file = BytesIO()
+    synthetic_sampler(stacks).dump(file)
+    data = [line.rsplit(" ", 1) for line in file.getvalue().decode().splitlines()]
+    data = [(stack, int(hits)) for stack, hits in data]
+    columns = Columns.load(data)
+
+    def query():
+        columns.top(columns.self_hits())
+        columns.top(columns.total_hits())
+
+    results["analyze.load"] = {
+        "value": stacks / best(lambda: Columns.load(data), repeat),
+        "unit": "stacks/s",
+        "better": "higher",
+    }
+    results["analyze.query"] = {
+        "value": stacks / best(query, repeat),
+        "unit": "stacks/s",
+        "better": "higher",
+    }
+
+
+def bench_aggregate(results, repeat, counts=(1, 8), stacks=1000):
+    """Throughput of `Aggregate.add` against the number of threads adding reports
+    concurrently (e.g. concurrent calls of a `profile`d function)."""
+    file = BytesIO()
+    synthetic_sampler(stacks).dump(file)
+    report = file.getvalue()
+    n = 10
+    for count in counts:
+
+        def run():
+            aggregate = Aggregate()
+            threads = [
+                threading.Thread(
+                    target=lambda: [aggregate.add(report) for _ in range(n)]
+                )
+                for _ in range(count)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        results[f"aggregate.threads_{count}"] = {
+            "value": count * n * stacks / best(run, repeat),
+            "unit": "stacks/s",
+            "better": "higher",
+        }
+
+
+def bench_accuracy(results, repeat, duration, period=0.001):
+    """Error on the share of samples of a workload with a known time split."""
+    for engine in ("thread", "signal"):
+        errors = []
+        for _ in range(repeat):
+            sampler = StackCollapse()
+            with Profiler(period=period, sampler=sampler, storer=Null(), engine=engine):
+                workload(duration)
+            errors.append(abs(shares(sampler)[0]["heavy"] - 0.75))
+        results[f"accuracy.{engine}"] = {
+            "value": sum(errors) / len(errors),
+            "unit": "abs error",
+            "abs_tolerance": 0.02,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """Return the metrics that regressed with respect to the baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        value, base = result["value"], baseline[name]["value"]
+        abs_tolerance = result.get("abs_tolerance", 0)
+        if result.get("better", "lower") == "lower":
+            limit = max(base * (1 + tolerance), base + abs_tolerance)
+            regressed = value > limit
+        else:
+            limit = min(base * (1 - tolerance), base - abs_tolerance)
+            regressed = value < limit
+        print(
+            f"{'REGRESSION' if regressed else 'ok':>10}  {name:<24}"
+            f" {value:.4g} (baseline {base:.4g}, limit {limit:.4g}) {result['unit']}"
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="run pylaprof's benchmark suite")
+    parser.add_argument(
+        "-o",
+        "--out",
+        default="results.json",
+        help="write results to this file (default: results.json)",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        metavar="FILE",
+        help="compare results with this file and exit with 1 on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="relative tolerance for regressions (default: 0.25)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="repetitions of each measurement, the best is kept (default: 5)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=0.5,
+        help="seconds of CPU-bound workload for overhead and accuracy (default: 0.5)",
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="pylaprof-bench") as tmpdir:
+        for bench in (
+            lambda: bench_sample_depth(results, opts.repeat),
+            lambda: bench_tick_threads(results, opts.repeat),
+            lambda: bench_tick_selected(results, opts.repeat),
+            lambda: bench_overhead(results, opts.repeat, opts.duration),
+            lambda: bench_dump_store(results, opts.repeat, tmpdir),
+            lambda: bench_merge(results, opts.repeat, tmpdir),
+            lambda: bench_aggregate(results, opts.repeat),
+            lambda: bench_analyze(results, opts.repeat),
+            lambda: bench_accuracy(results, opts.repeat, opts.duration),
+        ):
+            bench()
+
+    for name, result in sorted(results.items()):
+        print(f"{name:<24} {result['value']:.4g} {result['unit']}")
+    with open(opts.out, "w") as fp:
+        json.dump(
+            {"python": sys.version, "platform": sys.platform, "results": results},
+            fp,
+            indent=2,
+        )
+
+    if opts.baseline:
+        with open(opts.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        print(f"\nComparing with {opts.baseline}:")
+        if compare(results, baseline, opts.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Deterministic synthetic workloads for profiling-accuracy tests.
+
+A workload runs the same schedule of tasks in one or more threads: each task is a
+generated function, with its own name, that burns a given amount of CPU time and then
+sleeps for a given amount of time. Tasks are called at a configurable stack depth.
+
+While running, the workload measures the wall-clock and CPU time actually spent in
+each task by each thread: this is the ground truth profilers are compared with (with
+many threads GIL contention stretches wall-clock time in ways that can't be known in
+advance).
+"""
+
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+Task = namedtuple("Task", ["name", "cpu", "sleep"])
+Task.__doc__ = """A function that burns `cpu` seconds of CPU time and sleeps `sleep`
+seconds at each call."""
+
+TASK_SOURCE = """
+def {name}(cpu, sleep):
+    end = thread_time() + cpu
+    while thread_time() < end:
+        pass
+    if sleep:
+        time.sleep(sleep)
+"""
+
+DEFAULT_TASKS = [
+    Task("cpu_heavy", 0.03, 0),
+    Task("cpu_light", 0.01, 0),
+    Task("sleepy", 0, 0.02),
+    Task("mixed", 0.01, 0.01),
+]
+
+
+def make_task(task):
+    """Generate the function of a task (its frames are in file `<workload>`)."""
+    namespace = {"time": time, "thread_time": time.thread_time}
+    exec(compile(TASK_SOURCE.format(name=task.name), "<workload>", "exec"), namespace)
+    return namespace[task.name]
+
+
+def descend(depth, func, *args):
+    """Call `func` with `depth` more frames on the stack."""
+    if depth > 0:
+        return descend(depth - 1, func, *args)
+    return func(*args)
+
+
+class Workload:
+    def __init__(self, tasks=None, threads=1, depth=0, iterations=10):
+        """
+        tasks (list of Task)
+          Tasks to run, in order, at each iteration. Defaults to `DEFAULT_TASKS`.
+        threads (int)
+          Number of threads running the tasks: the thread calling `run` and
+          `threads - 1` other threads.
+        depth (int)
+          Number of frames between the thread's entry point and the tasks.
+        iterations (int)
+          Number of times each thread runs the tasks.
+        """
+        self.tasks = tasks or DEFAULT_TASKS
+        self.threads = threads
+        self.depth = depth
+        self.iterations = iterations
+        self._funcs = [(make_task(task), task) for task in self.tasks]
+
+    def _run(self, index, truth):
+        wall = defaultdict(lambda: 0)
+        cpu = defaultdict(lambda: 0)
+        for _ in range(self.iterations):
+            for func, task in self._funcs:
+                start_wall, start_cpu = time.perf_counter(), time.thread_time()
+                descend(self.depth, func, task.cpu, task.sleep)
+                wall[task.name] += time.perf_counter() - start_wall
+                cpu[task.name] += time.thread_time() - start_cpu
+        truth[index] = {"wall": dict(wall), "cpu": dict(cpu)}
+
+    def run(self):
+        """
+        Run the workload and return the ground truth as a dictionary mapping thread's
+        index (0 is the calling thread) to the wall-clock and CPU seconds spent in each
+        task, e.g. `{0: {"wall": {"sleepy": 0.1, ...}, "cpu": {...}}, ...}`.
+        """
+        truth = {}
+        threads = [
+            threading.Thread(target=self._run, args=(i, truth))
+            for i in range(1, self.threads)
+        ]
+        for thread in threads:
+            thread.start()
+        self._run(0, truth)
+        for thread in threads:
+            thread.join()
+        return truth
+
+
+def expected_shares(truth, metric="wall", threads=None):
+    """
+    Return the share of `metric` ("wall" or "cpu") time spent in each task by the
+    given thread indexes (all of them if None).
+    """
+    totals = defaultdict(lambda: 0)
+    for index, times in truth.items():
+        if threads is None or index in threads:
+            for name, seconds in times[metric].items():
+                totals[name] += seconds
+    total = sum(totals.values()) or 1
+    return {name: seconds / total for name, seconds in totals.items()}
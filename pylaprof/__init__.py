@@ -1,14 +1,22 @@
+import atexit
+import copy
 import logging
 import os
+import re
 import shutil
+import signal
 import sys
 import threading
 import time
+import tracemalloc
 import uuid
 from collections import defaultdict
+from contextlib import closing
 from datetime import datetime, timezone
 from functools import partial, wraps
+from heapq import heappush, heapreplace
 from io import BytesIO
+from itertools import count
 
 try:
     import boto3
@@ -97,6 +105,299 @@ class S3(Storer):
         self.bucket.put_object(Body=file.read(), Key=key, **self.put_object_opts)
 
 
+def _function(frame):
+    """Return the function of a stackcollapse frame: `func (file:lineno)` -> `func
+    (file)`. Synthetic frames (e.g. `[IO]`) are returned as they are."""
+    name, sep, lineno = frame.rpartition(":")
+    if sep and lineno[:-1].isdigit() and lineno.endswith(")"):
+        return f"{name})"
+    return frame
+
+
+class SQLite(Storer):
+    """
+    Stores report's data in an indexed SQLite database, where it can be queried
+    without reading reports again (check `pylaprof-query`).
+
+    Stacks are stored as nodes of a call tree (each node is a frame and its parent)
+    and hits are aggregated by time partition. For each node the database also keeps
+    the set of functions and of caller -> callee pairs on its path, so that total
+    time, callers and callees of a function are computed with a single join.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY, value INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY, time REAL NOT NULL, samples INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS functions (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS frames (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, function INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS nodes (
+        id INTEGER PRIMARY KEY,
+        parent INTEGER NOT NULL,  -- 0 for the root frames
+        frame INTEGER NOT NULL,
+        UNIQUE (parent, frame)
+    );
+    CREATE TABLE IF NOT EXISTS node_functions (
+        node INTEGER, function INTEGER, PRIMARY KEY (node, function)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS node_calls (
+        node INTEGER,
+        caller INTEGER,
+        callee INTEGER,
+        PRIMARY KEY (node, caller, callee)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS node_calls_caller ON node_calls (caller);
+    CREATE INDEX IF NOT EXISTS node_calls_callee ON node_calls (callee);
+    CREATE TABLE IF NOT EXISTS counts (
+        bucket INTEGER,  -- Start of the time partition (Unix time)
+        node INTEGER,
+        hits INTEGER NOT NULL,
+        PRIMARY KEY (bucket, node)
+    ) WITHOUT ROWID;
+    """
+
+    # Filter on time partitions for queries.
+    _RANGE = (
+        "(:since IS NULL OR bucket >= :since) AND (:until IS NULL OR bucket <= :until)"
+    )
+
+    def __init__(self, path="pylaprof.db", now=None, partition=None):
+        """
+        path (str)
+          Path of the database, created if it doesn't exist.
+        now (func() -> float)
+          Function to use to get report's timestamp (Unix time). Defaults to
+          `time.time` if None.
+        partition (int)
+          Hits are aggregated by periods of this many seconds. It's stored in the
+          database when it's created (defaults to 3600 if None) and can't change
+          afterwards: if None the stored value is used, otherwise it must match it.
+        """
+        self.path = path
+        self.now = now or time.time
+        with closing(self._connect()) as conn:  # Create the database now
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO meta VALUES ('partition', ?)",
+                    (partition or 3600,),
+                )
+            (stored,) = conn.execute(
+                "SELECT value FROM meta WHERE key = 'partition'"
+            ).fetchone()
+        if partition is not None and partition != stored:
+            raise ValueError(
+                f"{path} is partitioned by {stored} seconds, not {partition}"
+            )
+        self.partition = stored
+
+    def _connect(self):
+        import sqlite3  # Not at the top: don't slow down imports (e.g. cold starts)
+
+        # Connections can't be shared between threads, and the profiler stores its
+        # report from its own thread.
+        conn = sqlite3.connect(self.path)
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def store(self, file):
+        data = (line.decode().rsplit(" ", 1) for line in file)
+        self.ingest(((stack, int(hits)) for stack, hits in data), self.now())
+
+    def ingest(self, data, timestamp):
+        """
+        Add a report to the database.
+
+        data (iterable of (str, int))
+          Report's `(stack, hits)` pairs, stack's frames separated by ';'.
+        timestamp (float)
+          Report's Unix time.
+        """
+        bucket = int(timestamp // self.partition * self.partition)
+        with closing(self._connect()) as conn, conn:  # A single transaction
+            ids = {}  # (table, name) -> id
+            nodes = {}  # (parent, frame) -> node
+            paths = {0: (None, frozenset(), frozenset())}  # Node's path, check `path`
+
+            def name_id(table, name, **columns):
+                key = (table, name)
+                if key not in ids:
+                    row = conn.execute(
+                        f"SELECT id FROM {table} WHERE name = ?", (name,)
+                    ).fetchone()
+                    if row is None:
+                        names = ", ".join(["name", *columns])
+                        marks = ", ".join("?" * (len(columns) + 1))
+                        row = (
+                            conn.execute(
+                                f"INSERT INTO {table} ({names}) VALUES ({marks})",
+                                (name, *columns.values()),
+                            ).lastrowid,
+                        )
+                    ids[key] = row[0]
+                return ids[key]
+
+            def path(node):
+                """Return node's function, and functions and calls on its path."""
+                if node not in paths:
+                    function = conn.execute(
+                        "SELECT function FROM nodes JOIN frames ON frames.id = frame "
+                        "WHERE nodes.id = ?",
+                        (node,),
+                    ).fetchone()[0]
+                    functions = conn.execute(
+                        "SELECT function FROM node_functions WHERE node = ?", (node,)
+                    ).fetchall()
+                    calls = conn.execute(
+                        "SELECT caller, callee FROM node_calls WHERE node = ?", (node,)
+                    ).fetchall()
+                    paths[node] = (
+                        function,
+                        frozenset(f for f, in functions),
+                        frozenset(calls),
+                    )
+                return paths[node]
+
+            def node_id(parent, frame):
+                key = (parent, frame)
+                if key in nodes:
+                    return nodes[key]
+                row = conn.execute(
+                    "SELECT id FROM nodes WHERE parent = ? AND frame = ?", key
+                ).fetchone()
+                if row is not None:
+                    nodes[key] = row[0]
+                    return row[0]
+
+                node = conn.execute(
+                    "INSERT INTO nodes (parent, frame) VALUES (?, ?)", key
+                ).lastrowid
+                caller, functions, calls = path(parent)
+                function = ids["frame_function", frame]
+                functions = functions | {function}
+                if caller is not None:
+                    calls = calls | {(caller, function)}
+                paths[node] = (function, functions, calls)
+                conn.executemany(
+                    "INSERT INTO node_functions VALUES (?, ?)",
+                    [(node, f) for f in functions],
+                )
+                conn.executemany(
+                    "INSERT INTO node_calls VALUES (?, ?, ?)",
+                    [(node, *call) for call in calls],
+                )
+                nodes[key] = node
+                return node
+
+            hits_by_node = defaultdict(lambda: 0)
+            samples = 0
+            for stack, hits in data:
+                node = 0
+                for frame in stack.split(";"):
+                    if ("frames", frame) not in ids:
+                        function = name_id("functions", _function(frame))
+                        name_id("frames", frame, function=function)
+                        ids["frame_function", ids["frames", frame]] = function
+                    node = node_id(node, ids["frames", frame])
+                hits_by_node[node] += hits
+                samples += hits
+
+            conn.executemany(
+                "INSERT OR IGNORE INTO counts VALUES (?, ?, 0)",
+                [(bucket, node) for node in hits_by_node],
+            )
+            conn.executemany(
+                "UPDATE counts SET hits = hits + ? WHERE bucket = ? AND node = ?",
+                [(hits, bucket, node) for node, hits in hits_by_node.items()],
+            )
+            conn.execute(
+                "INSERT INTO reports (time, samples) VALUES (?, ?)",
+                (timestamp, samples),
+            )
+
+    def _query(self, sql, since, until, **params):
+        if since is not None:
+            since = since // self.partition * self.partition
+        with closing(self._connect()) as conn:
+            return conn.execute(sql, dict(params, since=since, until=until)).fetchall()
+
+    def top(self, n=10, total=False, since=None, until=None):
+        """
+        Return the `n` functions with most self (or total) hits as a list of
+        `(function, hits)` pairs, e.g. `[("main (app.py)", 42)]`.
+
+        since (float)
+          Consider only hits of time partitions that end after this Unix time.
+        until (float)
+          Consider only hits of time partitions that start before this Unix time.
+        """
+        if total:
+            join = "JOIN node_functions AS nf ON nf.node = c.node"
+            function = "nf.function"
+        else:
+            join = "JOIN nodes ON nodes.id = c.node JOIN frames ON frames.id = frame"
+            function = "frames.function"
+        return self._query(
+            f"SELECT functions.name, SUM(hits) FROM counts AS c {join} "
+            f"JOIN functions ON functions.id = {function} WHERE {self._RANGE} "
+            "GROUP BY functions.id ORDER BY 2 DESC, 1 LIMIT :n",
+            since,
+            until,
+            n=n,
+        )
+
+    def _calls(self, function, this, other, since, until):
+        # Not `LIKE`: it ignores case, `main` would also match `Main (app.py)`.
+        return self._query(
+            "SELECT functions.name, SUM(hits) FROM counts AS c "
+            "JOIN node_calls AS nc ON nc.node = c.node "
+            f"JOIN functions ON functions.id = nc.{other} "
+            f"WHERE nc.{this} IN ("
+            "  SELECT id FROM functions "
+            "  WHERE name = :function"
+            "  OR substr(name, 1, length(:prefix)) = :prefix"
+            f") AND {self._RANGE} "
+            "GROUP BY functions.id ORDER BY 2 DESC, 1",
+            since,
+            until,
+            function=function,
+            prefix=f"{function} (",
+        )
+
+    def callers(self, function, since=None, until=None):
+        """
+        Return the callers of `function` (e.g. `main (app.py)`, or just `main` for
+        functions with this name in any file) as a list of `(caller, hits)` pairs,
+        where hits are the total hits of calls from the caller. Check `top`.
+        """
+        return self._calls(function, "callee", "caller", since, until)
+
+    def callees(self, function, since=None, until=None):
+        """
+        Return the functions called by `function` as a list of `(callee, hits)`
+        pairs, where hits are the total hits of calls to the callee. Check `callers`.
+        """
+        return self._calls(function, "caller", "callee", since, until)
+
+    def totals(self, since=None, until=None):
+        """
+        Return the total hits of each time partition as a list of `(start, hits)`
+        pairs, where start is partition's Unix time. Check `top`.
+        """
+        return self._query(
+            f"SELECT bucket, SUM(hits) FROM counts WHERE {self._RANGE} "
+            "GROUP BY bucket ORDER BY bucket",
+            since,
+            until,
+        )
+
+
 class Sampler:
     def sample(self, frame):
         """
@@ -116,6 +417,65 @@ class Sampler:
         """
         pass  # pragma: no cover
 
+    def snapshot(self, delta=False):
+        """
+        Return a copy of sampling data as a sampler whose `dump` method can be called
+        while this sampler keeps sampling. Check `Profiler.snapshot`.
+
+        delta (bool)
+          Copy only the data sampled since the last delta snapshot.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def close(self):
+        """
+        End a profiling session: release the resources acquired while sampling.
+        `Profiler` calls it when it stops, whether the report was stored or not.
+        """
+        pass
+
+
+class Rule:
+    """
+    Match stack frames by module, filename and/or function name: a frame matches if it
+    satisfies all the criteria that are provided.
+    """
+
+    def __init__(self, module=None, filename=None, function=None, label=None):
+        """
+        module (str)
+          Match frames of this module or of its submodules (e.g. "django" matches
+          frames of "django" and "django.core.handlers.base").
+        filename (str)
+          Match frames whose code is in a file with this path prefix.
+        function (str)
+          Match frames of functions with this name.
+        label (str)
+          Name of the node that replaces a run of frames folded by this rule.
+          Defaults to `[{module}]`, `[{filename}]` or `[{function}]`.
+        """
+        self.module = module
+        self.filename = filename
+        self.function = function
+        self.label = label
+        if label is None:
+            self.label = f"[{module or filename or function}]"
+
+    def match(self, frame):
+        if self.module is not None:
+            name = frame.f_globals.get("__name__") or ""
+            if name != self.module and not name.startswith(self.module + "."):
+                return False
+        code = frame.f_code
+        if self.filename is not None and not code.co_filename.startswith(self.filename):
+            return False
+        if self.function is not None and code.co_name != self.function:
+            return False
+        return True
+
+
+_DROP = object()  # Rule action for frames that are dropped.
+
 
 class StackCollapse(Sampler):
     """
@@ -123,27 +483,987 @@ class StackCollapse(Sampler):
     generator (https://github.com/brendangregg/flamegraph).
     """
 
-    def __init__(self):
+    def __init__(
+        self, exclude=None, include=None, fold=None, granularity="line", lines=False
+    ):
+        """
+        exclude (list of Rule)
+          Drop frames that match any of these rules.
+        include (list of Rule)
+          If provided, drop frames that don't match any of these rules (and are not
+          folded).
+        fold (list of Rule)
+          Replace each run of consecutive frames that match one of these rules with a
+          single node named after rule's label, e.g. `Rule(module="requests")` folds
+          all the frames of a call to `requests.get` into a `[requests]` node.
+
+        granularity (str)
+          How frames are aggregated:
+          - "line" (default): one node per line, `func (file:lineno)`. A hot loop
+            spanning many lines produces many distinct stacks for the same call path.
+          - "firstline": one node per function, `func (file:firstlineno)` where
+            firstlineno is the line where the function is defined.
+          - "function": one node per function, `func (file)`.
+        lines (bool)
+          Keep a histogram of the lines of the innermost (kept) frame of each sample,
+          to spot hot lines even with a coarser granularity. Check `dump_lines`.
+
+        Rules are evaluated the first time a code object is sampled and their result is
+        cached: the cost of filtering doesn't depend on the number of rules.
+
+        Samples can be tagged by setting the `tags` attribute to a tuple of synthetic
+        frames, which are added at the root of each stack sampled from then on,
+        innermost first: with `("[span 1]", "[request 42]")` stacks start with
+        `[request 42];[span 1];...`.
+        """
+        if granularity not in {"line", "firstline", "function"}:
+            raise ValueError(f"unknown granularity: {granularity!r}")
+
         self._data = defaultdict(lambda: 0)
 
-    def sample(self, frame):
-        stack = []
+        self.exclude = exclude or []
+        self.include = include or []
+        self.fold = fold or []
+        self.granularity = granularity
+        self._lines = defaultdict(lambda: 0) if lines else None
+        self.tags = ()
+        self._last = None  # Data of the last delta snapshot
+        self._actions = {}  # Rules' result for each code object
+        if self.exclude or self.include or self.fold or granularity != "line" or lines:
+            self.sample = self._sample_cached
+
+    def sample(self, frame, leaf=None):
+        """
+        Check `Sampler.sample`.
+
+        leaf (str)
+          Synthetic frame to add on top of the stack, e.g. `[IO]` (check `Profiler`'s
+          `annotate` parameter).
+        """
+        stack = [] if leaf is None else [leaf]
         while frame:
             filename = frame.f_code.co_filename
             funcname = frame.f_code.co_name
             lineno = frame.f_lineno
             stack.append(f"{funcname} ({filename}:{lineno})")
             frame = frame.f_back
+        stack.extend(self.tags)
         self._data[tuple(stack)] += 1
 
+    def _action(self, frame):
+        """
+        Return what to do with frames of the same code object of `frame`: `_DROP`, a
+        1-tuple with the label of a fold rule or, for frames that are kept, their
+        representation (just its prefix with "line" granularity), so that we don't have
+        to format it at each sample.
+        """
+        for rule in self.exclude:
+            if rule.match(frame):
+                return _DROP
+        for rule in self.fold:
+            if rule.match(frame):
+                return (rule.label,)
+        code = frame.f_code
+        if self.granularity == "line":
+            keep = f"{code.co_name} ({code.co_filename}:"
+        elif self.granularity == "firstline":
+            keep = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+        else:
+            keep = f"{code.co_name} ({code.co_filename})"
+        if not self.include:
+            return keep
+        for rule in self.include:
+            if rule.match(frame):
+                return keep
+        return _DROP
+
+    def _sample_cached(self, frame, leaf=None):
+        actions = self._actions
+        line = self.granularity == "line"
+        stack = []
+        innermost = None  # Innermost frame that is kept, as `(code, lineno)`
+        folded = None  # Fold action of the run of folded frames we are in, if any
+        while frame:
+            action = actions.get(frame.f_code)
+            if action is None:
+                action = actions[frame.f_code] = self._action(frame)
+            if action.__class__ is str:
+                stack.append(f"{action}{frame.f_lineno})" if line else action)
+                if innermost is None:
+                    innermost = (frame.f_code, frame.f_lineno)
+                folded = None
+            elif action is not _DROP and action != folded:
+                stack.append(action[0])
+                folded = action
+            frame = frame.f_back
+        if stack:
+            if leaf is not None:
+                stack.insert(0, leaf)
+            stack.extend(self.tags)
+            self._data[tuple(stack)] += 1
+        if innermost is not None and self._lines is not None:
+            self._lines[innermost] += 1
+
     def dump(self, file):
         for stack, hits in self._data.items():
             line = f"{';'.join(stack[::-1])} {hits}\n"
             file.write(line.encode())
 
+    def snapshot(self, delta=False):
+        # Copying a dictionary is a single C call: it's cheap and no sample can be
+        # recorded in the middle of it (we hold the GIL or, on free-threaded builds,
+        # the dictionary's own lock).
+        data = self._data.copy()
+        lines = self._lines.copy() if self._lines is not None else None
+        if delta:
+            last_data, last_lines = self._last or ({}, {})
+            self._last = (data, lines)
+            data = _subtract(data, last_data)
+            if lines is not None:
+                lines = _subtract(lines, last_lines)
+
+        snapshot = copy.copy(self)
+        snapshot._data = data
+        snapshot._lines = lines
+        return snapshot
+
+    def dump_lines(self, file):
+        """
+        Dump the histogram of innermost lines (if enabled with `lines=True`), in the
+        same format of `dump` where each stack is made of a single frame.
+
+        file
+          A file-like object in binary mode where to write data.
+        """
+        for (code, lineno), hits in (self._lines or {}).items():
+            line = f"{code.co_name} ({code.co_filename}:{lineno}) {hits}\n"
+            file.write(line.encode())
+
+
+def _subtract(counters, other):
+    """Return the positive differences between two dictionaries of counters."""
+    diff = defaultdict(lambda: 0)
+    for key, counter in counters.items():
+        counter -= other.get(key, 0)
+        if counter > 0:
+            diff[key] = counter
+    return diff
+
+
+class _SpaceSaving(dict):
+    """
+    Dictionary of counters that holds at most `capacity` keys, following the
+    Space-Saving algorithm (Metwally, Agrawal, El Abbadi - "Efficient computation of
+    frequent and top-k elements in data streams"): when a new key arrives and the
+    dictionary is full, the key with the smallest counter is evicted and the new key
+    inherits its counter, which is recorded as the new key's maximum overestimation.
+
+    The sum of all the counters is always equal to the sum of all the increments and
+    each counter overestimates the actual count of its key by at most
+    `sum of increments / capacity`.
+    """
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.capacity = capacity
+        self.errors = {}  # Overestimation of keys that replaced an evicted one
+        self.evictions = 0
+        # Min-heap with an entry `(counter, seq, key)` for each key. Counters only grow
+        # so entries are lower bounds that we refresh lazily when looking for the
+        # smallest one: each increment causes at most one refresh.
+        self._heap = []
+        self._seq = count()  # Tie-breaker, so that keys are never compared
+
+    def __missing__(self, key):
+        heap = self._heap
+        if len(self) < self.capacity:
+            heappush(heap, (0, next(self._seq), key))
+            return 0
+
+        while True:
+            counter, _, victim = heap[0]
+            current = self[victim]
+            if current == counter:
+                break
+            heapreplace(heap, (current, next(self._seq), victim))
+
+        heapreplace(heap, (counter, next(self._seq), key))
+        del self[victim]
+        self.errors.pop(victim, None)
+        self.errors[key] = counter
+        self.evictions += 1
+        return counter
+
+
+class BoundedStackCollapse(StackCollapse):
+    """
+    Like `StackCollapse` but it keeps track of at most `capacity` distinct stacks, so
+    its memory usage doesn't grow with profiling session's duration or with the
+    diversity of code paths.
+
+    When a new stack arrives and `capacity` stacks are already tracked, the least
+    sampled one is evicted (check `_SpaceSaving`). The dump reports for each stack the
+    number of hits it is guaranteed to have had, and the remaining hits of evicted
+    stacks in a single `[evicted]` node (the number of evictions is the `evictions`
+    attribute): the total number of hits is exact and the most sampled stacks are
+    always reported. The node's name doesn't change, so that it merges across reports.
+    """
+
+    def __init__(self, capacity=10000, **kwargs):
+        """
+        capacity (int)
+          Maximum number of distinct stacks to track.
+
+        Check `StackCollapse` for the other arguments.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        super().__init__(**kwargs)
+        self.capacity = capacity
+        self._data = _SpaceSaving(capacity)
+
+    @property
+    def evictions(self):
+        """Number of stacks evicted so far."""
+        return self._data.evictions
+
+    def dump(self, file):
+        errors = self._data.errors
+        evicted = 0
+        for stack, hits in self._data.items():
+            # Every tracked stack has at least one guaranteed hit: its own.
+            error = errors.get(stack, 0)
+            evicted += error
+            line = f"{';'.join(stack[::-1])} {hits - error}\n"
+            file.write(line.encode())
+        if self._data.evictions:
+            logger.debug("%d stacks evicted", self._data.evictions)
+            file.write(f"[evicted] {evicted}\n".encode())
+
+    def snapshot(self, delta=False):
+        """
+        Delta snapshots are not supported: counters of evicted stacks are inherited by
+        other stacks, so they can't be compared across snapshots.
+        """
+        if delta:
+            raise ValueError("delta snapshots are not supported")
+        data = _SpaceSaving(self.capacity)
+        dict.update(data, self._data)
+        data.errors = self._data.errors.copy()
+        data.evictions = self._data.evictions
+
+        snapshot = copy.copy(self)
+        snapshot._data = data
+        snapshot._lines = self._lines.copy() if self._lines is not None else None
+        return snapshot
+
+
+class SharedStackCollapse(StackCollapse):
+    """
+    Like `StackCollapse` but it can be shared by profilers sampling at the same time,
+    e.g. by per-thread profilers on free-threaded CPython builds, where nothing
+    serializes the updates of a shared dictionary and concurrent samples would be lost.
+
+    Each sampling thread records its samples in its own buffer (a `StackCollapse` with
+    the same arguments) and merges it into the shared data, under a lock, every `flush`
+    samples. Dumps and snapshots also count the samples of buffers not merged yet, and
+    merge for good the buffers of threads that ended.
+
+    Tags are per thread too: each thread sees and samples with the `tags` it set, so
+    that profilers sharing the sampler don't tag each other's samples (a `Profiler`'s
+    thread starts with the tags of the thread that started the profiler).
+    """
+
+    def __init__(self, flush=1000, **kwargs):
+        """
+        flush (int)
+          Number of samples after which a thread merges its buffer.
+
+        Check `StackCollapse` for the other arguments.
+        """
+        if flush < 1:
+            raise ValueError("flush must be at least 1")
+        self._local = threading.local()
+        super().__init__(**kwargs)
+        self.flush = flush
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._buffers = {}  # Sampling thread -> its buffer
+        self.sample = self._sample_buffered
+
+    @property
+    def tags(self):
+        return getattr(self._local, "tags", ())
+
+    @tags.setter
+    def tags(self, tags):
+        self._local.tags = tags
+
+    def _sample_buffered(self, frame, leaf=None):
+        local = self._local
+        buffer = getattr(local, "buffer", None)
+        if buffer is None:
+            buffer = local.buffer = StackCollapse(**self._kwargs)
+            local.samples = 0
+            with self._lock:
+                self._buffers[threading.current_thread()] = buffer
+        buffer.tags = getattr(local, "tags", ())
+        buffer.sample(frame, leaf)
+        local.samples += 1
+        if local.samples >= self.flush:
+            local.samples = 0
+            with self._lock:
+                self._merge(buffer)
+
+    def _merge(self, buffer):
+        """Move the samples of `buffer` into the shared data (hold `_lock`)."""
+        for stack, hits in buffer._data.items():
+            self._data[stack] += hits
+        buffer._data = defaultdict(lambda: 0)
+        if self._lines is not None:
+            for line, hits in buffer._lines.items():
+                self._lines[line] += hits
+            buffer._lines = defaultdict(lambda: 0)
+
+    def _collect(self):
+        """Return a copy of the data and of the lines sampled by all threads."""
+        with self._lock:
+            for thread, buffer in list(self._buffers.items()):
+                if not thread.is_alive():  # It won't sample anymore
+                    self._merge(buffer)
+                    del self._buffers[thread]
+            data = self._data.copy()
+            lines = self._lines.copy() if self._lines is not None else None
+            for buffer in self._buffers.values():
+                for stack, hits in buffer._data.copy().items():
+                    data[stack] += hits
+                if lines is not None:
+                    for line, hits in buffer._lines.copy().items():
+                        lines[line] += hits
+        return data, lines
+
+    def dump(self, file):
+        self.snapshot().dump(file)
+
+    def dump_lines(self, file):
+        self.snapshot().dump_lines(file)
+
+    def snapshot(self, delta=False):
+        """
+        Check `Sampler.snapshot`: the copy is a `StackCollapse`.
+        """
+        data, lines = self._collect()
+        if delta:
+            last_data, last_lines = self._last or ({}, {})
+            self._last = (data, lines)
+            data = _subtract(data, last_data)
+            if lines is not None:
+                lines = _subtract(lines, last_lines)
+
+        snapshot = StackCollapse(**self._kwargs)
+        snapshot._data = data
+        snapshot._lines = lines
+        snapshot.tags = self.tags
+        return snapshot
+
+
+class CallGraph(StackCollapse):
+    """
+    Aggregated call graph in callgrind format (for KCachegrind, QCachegrind, ...): hits
+    of each function's lines (self cost) and of each call site, i.e. of each caller ->
+    callee edge (inclusive cost, from which tools derive functions' inclusive cost).
+
+    Its size grows with the number of functions and call sites rather than with the
+    number of distinct stacks, so it's far smaller than `StackCollapse`'s data for deep
+    and diverse code. Use `pylaprof-callgrind` to convert existing stackcollapse
+    reports instead.
+
+    Rules, tags and `leaf` work as with `StackCollapse`: synthetic frames (folded
+    runs, tags and leaves) are functions of file `SYNTHETIC`. A function recursing
+    into itself is counted once per sample, like an edge repeated in the same stack.
+    """
+
+    SYNTHETIC = "[pylaprof]"
+
+    def __init__(self, exclude=None, include=None, fold=None):
+        """
+        Check `StackCollapse` for the arguments.
+        """
+        # Always go through `_sample_cached`, which caches rules' result.
+        super().__init__(
+            exclude=exclude, include=include, fold=fold, granularity="function"
+        )
+        self._self = defaultdict(lambda: 0)  # (function, lineno) -> hits
+        self._calls = defaultdict(lambda: 0)  # (caller, lineno, callee) -> hits
+
+    def _node(self, frame):
+        """
+        Return what to do with frames of the same code object of `frame`: `_DROP` or
+        a `(function, folded)` tuple, where a function is a `(filename, name,
+        firstlineno)` tuple.
+        """
+        action = self._action(frame)
+        if action is _DROP:
+            return _DROP
+        if action.__class__ is tuple:
+            return ((self.SYNTHETIC, action[0], 0), True)
+        code = frame.f_code
+        return ((code.co_filename, code.co_name, code.co_firstlineno), False)
+
+    def _sample_cached(self, frame, leaf=None):
+        actions = self._actions
+        stack = []
+        folded = None  # Function of the run of folded frames we are in, if any
+        while frame:
+            action = actions.get(frame.f_code)
+            if action is None:
+                action = actions[frame.f_code] = self._node(frame)
+            if action is not _DROP:
+                function, fold = action
+                if not fold:
+                    stack.append((function, frame.f_lineno))
+                    folded = None
+                elif function != folded:
+                    stack.append((function, 0))
+                    folded = function
+            frame = frame.f_back
+        if stack:
+            synthetic = self.SYNTHETIC
+            if leaf is not None:
+                stack.insert(0, ((synthetic, leaf, 0), 0))
+            stack.extend(((synthetic, tag, 0), 0) for tag in self.tags)
+            self.add(stack)
+
+    def add(self, stack, hits=1):
+        """
+        Add the hits of a stack.
+
+        stack (list)
+          `(function, lineno)` tuples, innermost first, where a function is a
+          `(filename, name, firstlineno)` tuple.
+        hits (int)
+          Number of samples of the stack.
+        """
+        self._self[stack[0]] += hits
+        calls = self._calls
+        edges = set()
+        callee = stack[0][0]
+        for i in range(1, len(stack)):
+            caller, lineno = stack[i]
+            edge = (caller, lineno, callee)
+            if edge not in edges:
+                edges.add(edge)
+                calls[edge] += hits
+            callee = caller
+
+    def dump(self, file):
+        functions = defaultdict(lambda: ([], []))  # function -> (costs, calls)
+        for (function, lineno), hits in self._self.items():
+            functions[function][0].append((lineno, hits))
+        for (caller, lineno, callee), hits in self._calls.items():
+            functions[caller][1].append((lineno, callee, hits))
+
+        file.write(
+            "# callgrind format\nversion: 1\ncreator: pylaprof\npositions: line\n"
+            f"events: Samples\nsummary: {sum(self._self.values())}\n".encode()
+        )
+        for (filename, name, _), (costs, calls) in functions.items():
+            lines = [f"\nfl={filename}\nfn={name}\n"]
+            lines.extend(f"{lineno} {hits}\n" for lineno, hits in costs)
+            for lineno, (cfilename, cname, cfirstlineno), hits in calls:
+                lines.append(
+                    f"cfl={cfilename}\ncfn={cname}\ncalls={hits} {cfirstlineno}\n"
+                    f"{lineno} {hits}\n"
+                )
+            file.write("".join(lines).encode())
+
+    def snapshot(self, delta=False):
+        costs, calls = self._self.copy(), self._calls.copy()
+        if delta:
+            last_costs, last_calls = self._last or ({}, {})
+            self._last = (costs, calls)
+            costs = _subtract(costs, last_costs)
+            calls = _subtract(calls, last_calls)
+
+        snapshot = copy.copy(self)
+        snapshot._self = costs
+        snapshot._calls = calls
+        return snapshot
+
+
+class Tracemalloc(Sampler):
+    """
+    Create memory profiling data from `tracemalloc` snapshots in the same format of
+    `StackCollapse`, so that it can be fed to Brendan Gregg's Flamegraph generator or
+    merged with `pylaprof-merge`.
+
+    Frames are reported as `{filename}:{lineno}` (tracemalloc doesn't record function
+    names) and stacks are weighted either by bytes allocated during the profiling
+    session or by bytes still allocated (live) when the report is dumped.
+
+    Keep in mind that while tracemalloc is tracing every memory allocation of the
+    process gets slower (check https://docs.python.org/3/library/tracemalloc.html).
+    """
+
+    def __init__(
+        self,
+        weight="allocated",
+        interval=1.0,
+        depth=16,
+        max_overhead=0.05,
+        sampler=None,
+    ):
+        """
+        weight (str)
+          - "allocated": bytes allocated by each stack between snapshots. Memory that is
+            allocated and released between two consecutive snapshots is not counted.
+          - "live": bytes allocated by each stack and not yet released.
+        interval (float)
+          Minimum number of seconds between two consecutive snapshots.
+        depth (int)
+          Maximum number of frames recorded for each allocation. Ignored if tracemalloc
+          is already tracing when sampling starts.
+        max_overhead (float)
+          Skip snapshots while the time spent taking them exceeds this fraction of the
+          profiling session's duration.
+        sampler (Sampler)
+          Sampler to feed with the stack frames provided by the profiler, if any: it
+          allows to collect time samples alongside memory ones (use `sampler.dump` to
+          get its report).
+        """
+        if weight not in {"allocated", "live"}:
+            raise ValueError(f"unknown weight: {weight!r}")
+        self.weight = weight
+        self.interval = interval
+        self.depth = depth
+        self.max_overhead = max_overhead
+        self.sampler = sampler
+
+        self.overhead = 0  # Seconds spent taking and comparing snapshots.
+        self.snapshots = 0  # Number of snapshots taken...
+        self.skipped = 0  # ... and skipped to stay within `max_overhead`.
+
+        self._filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+        self._tracing = False  # Whether we started tracemalloc (and must stop it).
+        self._start = None
+        self._last = None
+        self._snapshot = None
+        self._allocated = defaultdict(lambda: 0)
+        self._delta = None  # Data of the last delta snapshot
+
+    def sample(self, frame):
+        if self.sampler is not None:
+            self.sampler.sample(frame)
+
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.depth)
+                self._tracing = True
+            self._take_snapshot()
+            return
+
+        if now - self._last < self.interval:
+            return
+        if self.overhead > self.max_overhead * (now - self._start):
+            self._last = now
+            self.skipped += 1
+            return
+        self._take_snapshot()
+
+    def _take_snapshot(self):
+        start = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot().filter_traces(self._filters)
+        if self._snapshot is not None:
+            for stat in snapshot.compare_to(self._snapshot, "traceback"):
+                if stat.size_diff > 0:
+                    self._allocated[stat.traceback] += stat.size_diff
+        self._snapshot = snapshot
+        self._last = time.perf_counter()
+        self.overhead += self._last - start
+        self.snapshots += 1
+
+    def dump(self, file):
+        """Write the report and end the session (check `close`)."""
+        if self._start is not None:
+            self._take_snapshot()
+        logger.debug(
+            "tracemalloc: %d snapshots (%d skipped) in %f seconds",
+            self.snapshots,
+            self.skipped,
+            self.overhead,
+        )
+
+        for traceback, size in self._data():
+            # Since Python 3.7 frames are sorted from the oldest to the most recent.
+            stack = ";".join(f"{f.filename}:{f.lineno}" for f in traceback)
+            file.write(f"{stack} {size}\n".encode())
+        self.close()
+
+    def close(self):
+        """
+        Stop tracemalloc if we started it and forget the session's snapshots, so that
+        the next `sample` starts a new session.
+        """
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self._start = self._last = self._snapshot = self._delta = None
+        self._allocated = defaultdict(lambda: 0)
+        if self.sampler is not None:
+            self.sampler.close()
+
+    def _data(self):
+        """Return `(traceback, bytes)` pairs according to `weight`."""
+        if self.weight == "allocated":
+            return self._allocated.items()
+        if self._snapshot is not None:
+            return (
+                (stat.traceback, stat.size)
+                for stat in self._snapshot.statistics("traceback")
+            )
+        return ()
+
+    def snapshot(self, delta=False):
+        """
+        Check `Sampler.snapshot`: the copy is a `StackCollapse`, taken after a new
+        tracemalloc snapshot (tracing goes on). With `weight="live"` a delta holds the
+        growth of live bytes since the last delta snapshot.
+        """
+        if self._start is not None:
+            self._take_snapshot()
+        data = defaultdict(lambda: 0)
+        for traceback, size in self._data():
+            data[tuple(f"{f.filename}:{f.lineno}" for f in reversed(traceback))] += size
+        if delta:
+            last, self._delta = self._delta or {}, data
+            data = _subtract(data, last)
+
+        snapshot = StackCollapse()
+        snapshot._data = data
+        return snapshot
+
+
+def _collapsed(sampler):
+    """
+    Return whether a sampler, or the samplers made by a sampler class, dumps collapsed
+    stacks with their hits: the reports that `Aggregate.add` expects.
+    """
+    if isinstance(sampler, type):
+        return issubclass(sampler, StackCollapse) and not issubclass(sampler, CallGraph)
+    return isinstance(sampler, StackCollapse) and not isinstance(sampler, CallGraph)
+
+
+class Aggregate:
+    """
+    Collapsed stacks merged from the reports of many profilers, e.g. of concurrent
+    calls of a function decorated with `profile` (check `Profiler`'s `aggregate`
+    parameter). It can be dumped and snapshotted like a sampler.
+
+    Stacks are spread by hash over `shards` dictionaries, each with its own lock: a
+    report is split by shard before taking any lock, then each shard is locked once, so
+    concurrent merges seldom wait for each other.
+    """
+
+    def __init__(self, shards=16):
+        """
+        shards (int)
+          Number of independently locked dictionaries.
+        """
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self._shards = [
+            (threading.Lock(), defaultdict(lambda: 0)) for _ in range(shards)
+        ]
+        self._last = None  # Data of the last delta snapshot
+
+    def add(self, report):
+        """
+        Add the hits of a report.
+
+        report (bytes)
+          Lines `stack hits`, as dumped by `StackCollapse`.
+        """
+        shards = self._shards
+        parts = [{} for _ in shards]
+        for line in report.splitlines():
+            stack, _, hits = line.rpartition(b" ")
+            if stack:
+                part = parts[hash(stack) % len(parts)]
+                part[stack] = part.get(stack, 0) + int(hits)
+
+        for (lock, data), part in zip(shards, parts):
+            if part:
+                with lock:
+                    for stack, hits in part.items():
+                        data[stack] += hits
+
+    def _copy(self):
+        copy = {}
+        for lock, data in self._shards:
+            with lock:
+                copy.update(data)  # Shards don't share stacks
+        return copy
+
+    def dump(self, file):
+        for stack, hits in self._copy().items():
+            file.write(b"%s %d\n" % (stack, hits))
+
+    def snapshot(self, delta=False):
+        """Check `Sampler.snapshot`."""
+        data = self._copy()
+        if delta:
+            last = self._last or {}
+            self._last = data
+            data = _subtract(data, last)
+
+        snapshot = Aggregate(shards=1)
+        snapshot._shards[0][1].update(data)
+        return snapshot
+
+
+# Innermost Python frames of calls that block waiting for something, identified by
+# module and function name, and the synthetic frame that annotates their samples (check
+# `Profiler`'s `annotate` parameter). Add your own as needed.
+BLOCKING_CALLS = {
+    ("socket", "accept"): "[IO]",
+    ("socket", "create_connection"): "[IO]",
+    ("socket", "readinto"): "[IO]",
+    ("ssl", "do_handshake"): "[IO]",
+    ("ssl", "read"): "[IO]",
+    ("ssl", "recv"): "[IO]",
+    ("ssl", "recv_into"): "[IO]",
+    ("ssl", "sendall"): "[IO]",
+    ("selectors", "select"): "[IO]",
+    ("subprocess", "_try_wait"): "[wait]",
+    ("threading", "wait"): "[wait]",
+    ("threading", "_wait_for_tstate_lock"): "[wait]",
+}
+
+
+def _cpu_clocks(frames, clocks):
+    """
+    Return `clocks` (thread id -> id of the thread's CPU time clock) updated for the
+    threads of `frames`, just returned by `sys._current_frames`, or None if the
+    platform doesn't support per-thread clocks.
+
+    `time.pthread_getcpuclockid` has undefined behaviour (it may crash) for threads
+    that ended, so it's called once for each thread, as soon as the thread is seen:
+    reading the clock of a thread that ended is safe, `time.clock_gettime` raises
+    `OSError` (then drop the clock, in case the thread id is reused).
+    """
+    getcpuclockid = getattr(time, "pthread_getcpuclockid", None)
+    if getcpuclockid is None:
+        return None
+    if len(clocks) > len(frames):  # Forget about ended threads
+        clocks = {i: c for i, c in clocks.items() if i in frames}
+    for ident in frames:
+        if ident not in clocks:
+            try:
+                clocks[ident] = getcpuclockid(ident)
+            except OSError:
+                pass
+    return clocks
+
+
+class _ThreadStates:
+    """
+    Guess what sampled threads were doing since their previous sample from the CPU
+    time they consumed (`time.pthread_getcpuclockid`) and from their innermost frame.
+
+    A thread that used a fraction `f` of the elapsed time on CPU is considered on CPU
+    in a fraction `f` of its samples (the error is carried over to the next sample).
+    Other samples are annotated with the label of the blocking call the thread is in
+    (check `BLOCKING_CALLS`) or, if it isn't in a known one, with `[GIL wait]` when
+    other threads were on CPU at least half of the time (likely holding the GIL) and
+    `[off-CPU]` otherwise. Blocking calls implemented in C (e.g. `time.sleep`) have no
+    frame of their own: a thread sleeping while others run shows up as `[GIL wait]`.
+    """
+
+    def __init__(self):
+        self._labels = {}  # Label of BLOCKING_CALLS for each code object
+        self._threads = {}  # Thread's CPU time and on-CPU credit at its last sample
+        self._tick = None  # Time, process' and own CPU time at the last tick
+        self._elapsed = 0  # Duration of the last tick
+        self._others = 0  # CPU time used by other threads during the last tick
+        self._clocks = {}  # CPU time clock of each thread, if supported
+
+    def tick(self, frames):
+        """Update clocks, to be called before sampling `frames` (thread id -> frame)."""
+        now = (time.monotonic(), time.process_time(), time.thread_time())
+        if self._tick is not None:
+            self._elapsed = now[0] - self._tick[0]
+            self._others = (now[1] - self._tick[1]) - (now[2] - self._tick[2])
+        self._tick = now
+        if len(self._threads) > 2 * len(frames):  # Forget about ended threads
+            self._threads = {i: v for i, v in self._threads.items() if i in frames}
+        self._clocks = _cpu_clocks(frames, self._clocks or {})
+
+    def classify(self, ident, frame):
+        """Return the synthetic leaf frame for a sample of thread `ident`, or None."""
+        code = frame.f_code
+        label = self._labels.get(code, _DROP)
+        if label is _DROP:
+            module = frame.f_globals.get("__name__")
+            label = self._labels[code] = BLOCKING_CALLS.get((module, code.co_name))
+
+        clock = self._clocks.get(ident) if self._clocks is not None else None
+        if clock is None:  # Not supported by the platform
+            return label
+        try:
+            cpu = time.clock_gettime(clock)
+        except OSError:  # The thread ended
+            del self._clocks[ident]
+            return label
+        last = self._threads.get(ident)
+        if last is None or self._elapsed <= 0:
+            self._threads[ident] = (cpu, 0)
+            return label
+
+        used = cpu - last[0]
+        credit = last[1] + min(used / self._elapsed, 1)
+        if credit >= 1:  # On CPU
+            self._threads[ident] = (cpu, credit - 1)
+            return None
+        self._threads[ident] = (cpu, credit)
+        if label is not None:
+            return label
+        if self._others - used >= self._elapsed / 2:
+            return "[GIL wait]"
+        return "[off-CPU]"
+
+
+class Threads:
+    """
+    Selection of the threads to sample, for processes with many threads (check
+    `Profiler`'s `threads` parameter).
+
+    The selection is cached: it is refreshed when threads start or stop and every
+    `interval` seconds, so that the cost of a profiler's tick depends on the number of
+    selected threads rather than on the number of all the threads.
+    """
+
+    def __init__(self, name=None, registered=False, active=None, interval=1):
+        """
+        name (str)
+          Select threads whose name matches this regular expression (at its start),
+          e.g. `"ThreadPoolExecutor-0_"`.
+        registered (bool)
+          Select only threads registered with `register`.
+        active (float)
+          Select only threads that ran in the last `active` seconds, i.e. whose
+          innermost frame or CPU time (where `time.pthread_getcpuclockid` is
+          available) changed. The selection is then refreshed every `active` seconds.
+        interval (float)
+          Refresh the selection at least every this many seconds, e.g. to notice that
+          a thread identifier was reused by a new thread.
+
+        Threads must satisfy all the given criteria.
+        """
+        self.name = re.compile(name) if name is not None else None
+        self.registered = registered
+        self.active = active
+        self.interval = active if active is not None else interval
+        self._registered = set()
+        self._seen = set()  # Threads' identifiers at the last refresh
+        self._selected = []
+        self._next = 0  # Time of the next periodic refresh
+        self._last = {}  # Threads' innermost frame, position and CPU time
+        self._clocks = {}  # CPU time clock of each thread, if supported
+
+    def register(self, thread=None):
+        """Register a `threading.Thread` (the current one if None)."""
+        self._registered.add((thread or threading.current_thread()).ident)
+        self._next = 0  # Refresh at the next tick
+
+    def unregister(self, thread=None):
+        """Unregister a `threading.Thread` (the current one if None)."""
+        self._registered.discard((thread or threading.current_thread()).ident)
+        self._next = 0
+
+    def _ran(self, ident, frame):
+        """Return whether the thread ran since the last refresh."""
+        cpu = None
+        clock = self._clocks.get(ident) if self._clocks is not None else None
+        if clock is not None:
+            try:
+                cpu = time.clock_gettime(clock)
+            except OSError:  # The thread ended
+                del self._clocks[ident]
+        state = (frame, frame.f_lasti, cpu)
+        last = self._last.get(ident)
+        self._last[ident] = state
+        return last is None or last[0] is not frame or last[1:] != state[1:]
+
+    def select(self, frames):
+        """
+        Return the `(thread id, frame)` pairs of `frames` (thread id -> frame) of the
+        selected threads.
+        """
+        now = time.monotonic()
+        if now >= self._next or frames.keys() != self._seen:
+            self._refresh(frames)
+            self._next = now + self.interval
+        return [(ident, frames[ident]) for ident in self._selected if ident in frames]
+
+    def _refresh(self, frames):
+        self._seen = set(frames)
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        if self.active is not None:
+            self._clocks = _cpu_clocks(frames, self._clocks or {})
+        selected = []
+        for ident, frame in frames.items():
+            if self.registered and ident not in self._registered:
+                continue
+            if self.name is not None and not self.name.match(names.get(ident) or ""):
+                continue
+            if self.active is not None and not self._ran(ident, frame):
+                continue
+            selected.append(ident)
+        self._selected = selected
+        self._last = {i: v for i, v in self._last.items() if i in frames}
+
+
+_BURST = object()  # Sentinel for `Profiler._span`: tags changed because we burst
+
+
+class _SnapshotRequest:
+    def __init__(self, delta):
+        self.delta = delta
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def serve(self, sampler):
+        try:
+            self.result = sampler.snapshot(self.delta)
+        except Exception as exc:  # Let the requester handle it
+            self.error = exc
+        self.done.set()
+
 
 class Profiler(threading.Thread):
-    def __init__(self, period=0.01, single=True, min_time=0, sampler=None, storer=None):
+    def __init__(
+        self,
+        period=0.01,
+        single=True,
+        min_time=0,
+        sampler=None,
+        storer=None,
+        engine="thread",
+        span=None,
+        annotate=False,
+        threads=None,
+        aggregate=None,
+        deadline=None,
+        burst=None,
+        remaining=None,
+        margin=1,
+    ):
         """
         period (float)
           How many seconds to wait between consecutive samples.
@@ -161,14 +1481,99 @@ class Profiler(threading.Thread):
         storer (Storer)
           Storer to use to memorize sampler's report.
           Defaults to an instance of `S3` if none.
+        engine (str)
+          How stack samples are taken:
+          - "thread" (default): the profiler's own thread wakes up every `period`
+            seconds and samples other threads' stacks. This requires the profiler's
+            thread to acquire the GIL, so samples of a CPU-bound thread can be delayed
+            by up to `sys.getswitchinterval()` seconds.
+          - "signal": a `SIGPROF` is delivered every `period` seconds of CPU time
+            consumed by the process (`signal.setitimer(signal.ITIMER_PROF, ...)`) and
+            the interrupted frame of the main thread is sampled from the signal
+            handler. This gives a lower-jitter CPU profile but time spent sleeping or
+            waiting on I/O is not sampled. It can only be used with `single=True` and
+            the profiler must be created, started and stopped from the main thread.
+        span (contextvars.ContextVar)
+          Variable holding the active span or trace of the profiled code, e.g. its
+          identifier: samples are tagged with a `[span {value}]` root frame (the
+          sampler must support tags, check `StackCollapse`) and a single span's
+          profile can be pulled out of the report with `pylaprof-merge --tag`.
+          The variable is read in the sampled thread, so this requires the signal
+          engine (another thread can't see the profiled thread's context).
+        annotate (bool)
+          Add a synthetic leaf frame to samples of threads that were waiting rather
+          than running Python code: `[IO]` or `[wait]` for known blocking calls (check
+          `BLOCKING_CALLS`), `[GIL wait]` and `[off-CPU]` (check `_ThreadStates` for
+          the heuristics). Samples of threads on CPU are not annotated. The sampler's
+          `sample` method must accept a `leaf` argument, like `StackCollapse`'s.
+          This requires the thread engine: the signal engine only samples the main
+          thread while it runs.
+        threads (Threads)
+          Sample only the threads selected by it (requires `single=False`), e.g.
+          `Threads(name="worker-", active=0.1)` for worker threads that ran in the
+          last 100 milliseconds.
+        aggregate (Aggregate)
+          Also add the sampler's report to it when the profiler stops (even if it
+          doesn't last `min_time` seconds): it collects the data of many profilers,
+          e.g. of concurrent calls of a function decorated with `profile`. The sampler
+          must dump collapsed stacks with their hits, like `StackCollapse` (not
+          `CallGraph` or `Tracemalloc`).
+        deadline (float)
+          Soft deadline in seconds: when the profiled section lasts longer, switch to
+          the `burst` sampling period and tag the samples taken from then on with a
+          `[burst]` root frame (the sampler must support tags, check
+          `StackCollapse`), so that a cheap `period` can be used for the fast runs
+          while slow ones get a detailed profile. The switch happens at the first
+          sample after the deadline. A burst sample stands for `burst / period` of a
+          regular one: weight them accordingly, or view them on their own with
+          `pylaprof-merge --tag "[burst]"`.
+        burst (float)
+          Sampling period after the deadline. Defaults to `period / 10` if None.
+        remaining (float)
+          Number of seconds left before the process may be killed, e.g.
+          `context.get_remaining_time_in_millis() / 1000` in an AWS Lambda handler.
+          When only `margin` seconds are left, or when the process receives a
+          `SIGTERM` (check `flush`), stop sampling and store a partial report, even if
+          the profiler didn't run for `min_time` seconds: otherwise the slowest runs,
+          those that time out, would leave no report at all. Nothing else is stored
+          when the profiler stops.
+        margin (float)
+          Number of seconds needed to store a report.
 
         Profiler's activity can be controlled through the `PYLAPROF_DISABLE` environment
         variable: if it is set to 'true' then profiler's context will be a noop.
         """
         super().__init__()
 
+        if engine not in {"thread", "signal"}:
+            raise ValueError(f"unknown engine: {engine!r}")
+        if engine == "signal":
+            if not single:
+                raise ValueError("signal engine can only sample the main thread")
+            if threading.current_thread() is not threading.main_thread():
+                raise ValueError("signal engine must be used from the main thread")
+            if annotate:
+                raise ValueError("annotations require the thread engine")
+        elif span is not None:
+            raise ValueError("span correlation requires the signal engine")
+        if single and threads is not None:
+            raise ValueError("thread selection requires single=False")
+        if burst is not None and deadline is None:
+            raise ValueError("burst sampling requires a deadline")
+        if aggregate is not None and sampler is not None and not _collapsed(sampler):
+            raise ValueError("aggregate requires a sampler dumping collapsed stacks")
+
         self.period = period
         self.min_time = min_time
+        self.engine = engine
+        self.span = span
+        self.annotate = annotate
+        self.threads = threads
+        self.aggregate = aggregate
+        self.deadline = deadline
+        self.burst = burst if burst is not None else period / 10
+        self.remaining = remaining
+        self.margin = margin
 
         self._test = None
         if single:
@@ -184,12 +1589,45 @@ class Profiler(threading.Thread):
 
         self._can_run = False  # Variable to control profiler's main loop.
         self._stop_event = threading.Event()
+        self._prev_handler = None  # SIGPROF handler to restore (signal engine).
+        self._signal_exc = None  # Exception raised in `_handle_signal`, if any.
+        self._wakeup = False  # Whether `snapshot` sent the next SIGPROF.
+        self._span = None  # Last value of `span` seen by `_handle_signal`.
+        self._tags = ()  # Sampler's tags when we started.
+        self._burst_at = None  # `time.monotonic()` of the deadline, until we burst.
+        self._burst_tag = ()  # Tag of burst samples, once we burst.
+        self._flush_at = None  # `time.monotonic()` of the partial flush, if any.
+        self._flush = False  # Whether to stop sampling and store a partial report.
+        self._main_flush = False  # Whether `flush` was called by the main thread.
+        self._prev_sigterm = None  # SIGTERM handler to restore.
+        # Snapshot requests are served by the sampling code between two samples.
+        self._requests = []
+        self._requests_lock = threading.Lock()
+        self._serving = False  # Whether there's someone serving snapshot requests.
         self.daemon = True
         self.clean_exit = False
 
     def start(self):
         self.clean_exit = False
         self._can_run = True
+        if not self._disabled():
+            self._serving = True
+            self._tags = getattr(self.sampler, "tags", ())
+            self._burst_tag = ()
+            if self.deadline is not None:
+                self._burst_at = time.monotonic() + self.deadline
+            self._flush = self._main_flush = False
+            if self.remaining is not None:
+                self._flush_at = time.monotonic() + self.remaining - self.margin
+                if threading.current_thread() is threading.main_thread():
+                    self._prev_sigterm = signal.signal(
+                        signal.SIGTERM, self._handle_sigterm
+                    )
+                else:
+                    logger.debug("Not in the main thread, won't flush on SIGTERM")
+            if self.engine == "signal":
+                self._prev_handler = signal.signal(signal.SIGPROF, self._handle_signal)
+                signal.setitimer(signal.ITIMER_PROF, self.period, self.period)
         super().start()
 
     def stop(self):
@@ -198,8 +1636,138 @@ class Profiler(threading.Thread):
         Does not wait for actual termination (use join() method).
         """
         self._can_run = False
+        if self._prev_handler is not None:
+            # Disarm the timer first: `signal.signal` runs pending Python handlers
+            # before replacing ours, so no SIGPROF can reach the previous handler.
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._prev_handler)
+            self._prev_handler = None
+            if self.span is not None:
+                self.sampler.tags = self._tags
+        if self._prev_sigterm is not None:
+            signal.signal(signal.SIGTERM, self._prev_sigterm)
+            self._prev_sigterm = None
         self._stop_event.set()
 
+    def flush(self, timeout=None):
+        """
+        Stop sampling and store the data sampled so far, as when the `remaining` time
+        runs out, and wait at most `timeout` seconds (indefinitely if None) for the
+        report to be stored. It can be called from any thread, or from a signal
+        handler: with `remaining`, the profiler calls it on `SIGTERM` (if it was
+        started from the main thread) and then honors the previous handler.
+        """
+        if not self.is_alive():
+            return
+        self._main_flush = threading.current_thread() is threading.main_thread()
+        self._flush = True
+        self._can_run = False
+        self._stop_event.set()
+        self.join(timeout)
+
+    def _handle_sigterm(self, signum, frame):
+        previous = self._prev_sigterm
+        self.flush(self.margin)
+        _forward(previous, signum, frame)
+
+    def snapshot(self, delta=False, timeout=None):
+        """
+        Return a consistent copy of the data sampled so far (check `Sampler.snapshot`)
+        without stopping the profiler. It can be called from any thread.
+
+        delta (bool)
+          Copy only the data sampled since the last delta snapshot.
+        timeout (float)
+          Maximum number of seconds to wait for the copy, `TimeoutError` is raised if
+          it takes longer. Wait indefinitely if None.
+
+        While the profiler is running the copy is taken between two samples by the
+        sampling code itself (the profiler's thread or, with the signal engine, the
+        signal handler), so samplers don't need any locking.
+        """
+        request = _SnapshotRequest(delta)
+        with self._requests_lock:
+            if not self._serving:
+                return self.sampler.snapshot(delta)
+            self._requests.append(request)
+        if self.engine == "signal":
+            # Don't wait for the process to consume a whole period of CPU time.
+            self._wakeup = True
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGPROF)
+
+        if not request.done.wait(timeout):
+            with self._requests_lock:
+                if request in self._requests:
+                    self._requests.remove(request)
+                    raise TimeoutError("snapshot took too long")
+            request.done.wait()  # It's being served right now
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _serve_snapshots(self):
+        with self._requests_lock:
+            requests, self._requests[:] = self._requests[:], []
+        for request in requests:
+            request.serve(self.sampler)
+
+    def _start_burst(self):
+        """
+        Switch to the burst period and tag samples from now on. With the signal engine
+        it's called by `_handle_signal`, so that the timer can't be armed again after
+        `stop` disarmed it.
+        """
+        logger.debug("Deadline exceeded, sampling every %f seconds", self.burst)
+        self._burst_at = None
+        self._burst_tag = ("[burst]",)
+        self._span = _BURST  # `_handle_signal` must format tags again
+        self.sampler.tags = self._burst_tag + self._tags
+        if self.engine == "signal":
+            signal.setitimer(signal.ITIMER_PROF, self.burst, self.burst)
+
+    def _handle_signal(self, signum, frame):
+        try:
+            if self._wakeup:
+                # Sent by `snapshot` rather than by the timer: don't sample, or each
+                # snapshot would add a sample, even if the process is idle.
+                self._wakeup = False
+            else:
+                if self._burst_at is not None and time.monotonic() >= self._burst_at:
+                    self._start_burst()
+                if self.span is not None:
+                    span = self.span.get(None)
+                    if span is not self._span:  # Format tags only if the span changed
+                        self._span = span
+                        tags = self._burst_tag + self._tags
+                        if span is not None:
+                            tags = (f"[span {span}]",) + tags
+                        self.sampler.tags = tags
+                self.sampler.sample(frame)
+            if self._requests:
+                self._serve_snapshots()
+        except Exception as exc:
+            # Never let the exception bubble up into the interrupted code: stop
+            # sampling and let `run` report it.
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            self._signal_exc = exc
+
+    def _stop_sampling(self):
+        """
+        Disarm the signal engine's timer and return a sampler holding the data sampled
+        so far, copied by the signal handler (between two samples) if possible.
+        """
+        self._burst_at = None  # `_start_burst` would arm the timer again
+        sampler = self.sampler
+        if not self._main_flush:  # Otherwise the main thread is waiting in `flush`
+            try:
+                sampler = self.snapshot(timeout=self.margin / 2)
+            except Exception:
+                # The main thread is stuck in C code, or the sampler doesn't support
+                # snapshots: it's likely that no sample is being taken right now.
+                logger.warning("Unable to copy sampler's data, using it as is")
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        return sampler
+
     def __enter__(self):
         self.start()
         return self
@@ -231,28 +1799,154 @@ class Profiler(threading.Thread):
             if test is None:
                 test = lambda x, ident=threading.current_thread().ident: ident != x
             stop_event = self._stop_event
-            wait = partial(stop_event.wait, self.period)
+            period = self.period
+            wait = partial(stop_event.wait, period)
             current_frames = sys._current_frames
             sample = self.sampler.sample
+            requests = self._requests
 
             start = time.time()
-            while self._can_run:
-                for ident, frame in current_frames().items():
-                    if test(ident):
-                        sample(frame)
-                wait()
+            if self.engine == "signal":
+                # Samples are taken by `_handle_signal` in the main thread, we only
+                # have to wait until we are asked to stop.
+                flush_at = self._flush_at
+                while self._can_run:
+                    if flush_at is None:
+                        stop_event.wait()
+                    elif not stop_event.wait(flush_at - time.monotonic()):
+                        self._flush = True
+                        break
+            else:
+                states = _ThreadStates() if self.annotate else None
+                select = self.threads.select if self.threads is not None else None
+                if self._tags:  # Per-thread tags (`SharedStackCollapse`)
+                    self.sampler.tags = self._tags
+                burst_at = self._burst_at
+                flush_at = self._flush_at
+                while self._can_run:
+                    frames = current_frames()
+                    if states is not None:
+                        states.tick(frames)
+                    selected = frames.items() if select is None else select(frames)
+                    for ident, frame in selected:
+                        if not test(ident):
+                            continue
+                        if states is None:
+                            sample(frame)
+                        else:
+                            sample(frame, states.classify(ident, frame))
+                    if requests:
+                        self._serve_snapshots()
+                    if burst_at is not None and time.monotonic() >= burst_at:
+                        burst_at = None
+                        self._start_burst()
+                        period = self.burst
+                        wait = partial(stop_event.wait, period)
+                    if flush_at is not None:
+                        left = flush_at - time.monotonic()
+                        if left <= 0:
+                            self._flush = True
+                            break
+                        if left < period:  # Don't oversleep the flush
+                            stop_event.wait(left)
+                            continue
+                    wait()
             end = time.time()
+            if self._burst_tag:
+                self.sampler.tags = self._tags
 
-            if end - start >= self.min_time:
+            if self._signal_exc is not None:
+                raise self._signal_exc
+
+            sampler = self.sampler
+            if self._flush:
+                logger.debug("Storing a partial report")
+                if self.engine == "signal":
+                    sampler = self._stop_sampling()
+            store = self._flush or end - start >= self.min_time
+            if store or self.aggregate is not None:
                 file = BytesIO()
-                self.sampler.dump(file)
-                file.seek(0)
-                self.storer.store(file)
+                sampler.dump(file)
+                if store:
+                    file.seek(0)
+                    self.storer.store(file)
+                if self.aggregate is not None:
+                    self.aggregate.add(file.getvalue())
 
             stop_event.clear()
             self.clean_exit = True
         except Exception:
             logger.exception("Uncaught exception")
+        finally:
+            # From now on snapshots are taken by the caller.
+            with self._requests_lock:
+                self._serving = False
+                requests, self._requests[:] = self._requests[:], []
+            for request in requests:
+                request.serve(self.sampler)
+            self.sampler.close()
+
+
+class _SnapshotHandler:
+    """Request handler of `serve`, mixed into `http.server.BaseHTTPRequestHandler`."""
+
+    def do_GET(self):
+        if self.path not in {"/snapshot", "/delta"}:
+            self.send_error(404)
+            return
+        try:
+            snapshot = self.server.profiler.snapshot(
+                delta=self.path == "/delta", timeout=self.server.snapshot_timeout
+            )
+            file = BytesIO()
+            snapshot.dump(file)
+        except NotImplementedError:
+            self.send_error(501, "The sampler doesn't support snapshots")
+            return
+        except Exception:
+            logger.exception("Unable to take a snapshot")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(file.tell()))
+        self.end_headers()
+        self.wfile.write(file.getvalue())
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)  # Don't pollute standard error
+
+
+def serve(profiler, host="127.0.0.1", port=0, timeout=5):
+    """
+    Serve snapshots of a running profiler over HTTP from a daemon thread:
+    - `GET /snapshot` returns the report of data sampled so far;
+    - `GET /delta` returns the report of data sampled since the last `/delta` request.
+
+    profiler (Profiler)
+      Profiler to take snapshots of.
+    host (str)
+      Address to listen on. Defaults to the loopback interface: reports can reveal
+      details of your code, think twice before exposing them.
+    port (int)
+      Port to listen on, a free one is picked if 0 (check server's `server_address`).
+    timeout (float)
+      Maximum number of seconds to wait for a snapshot.
+
+    Return the `http.server.ThreadingHTTPServer` instance, call its `shutdown` method
+    to stop serving.
+    """
+    # Not at the top: don't slow down imports (e.g. cold starts)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    handler = type("SnapshotHandler", (_SnapshotHandler, BaseHTTPRequestHandler), {})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.profiler = profiler
+    server.snapshot_timeout = timeout
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
 
 
 class profile:
@@ -264,26 +1958,253 @@ class profile:
         ...
     """
 
-    def __init__(self, period=0.01, single=True, min_time=0, sampler=None, storer=None):
+    def __init__(
+        self,
+        period=0.01,
+        single=True,
+        min_time=0,
+        sampler=None,
+        storer=None,
+        engine="thread",
+        span=None,
+        annotate=False,
+        threads=None,
+        aggregate=None,
+        deadline=None,
+        burst=None,
+        remaining=None,
+        margin=1,
+    ):
         """
         Check `Profiler`.
+
+        `sampler` can also be a callable returning a new sampler, e.g. `StackCollapse`
+        or `lambda: StackCollapse(granularity="function")`: it's called for each call
+        of the decorated function, so that concurrent calls (e.g. in a threaded
+        server) get their own reports. A sampler instance is shared by all calls,
+        meaning that each report also holds the samples of the calls before and, if
+        any, concurrent with it. Pass an `Aggregate` as `aggregate` to also collect
+        the samples of all calls.
+
+        `remaining` can also be a callable, called with the arguments of each call,
+        e.g. `lambda event, context: context.get_remaining_time_in_millis() / 1000`
+        for an AWS Lambda handler.
         """
+        if (
+            aggregate is not None
+            and sampler is not None
+            and (isinstance(sampler, type) or not callable(sampler))
+            and not _collapsed(sampler)
+        ):
+            # Other factories are checked by `Profiler` on each call.
+            raise ValueError("aggregate requires a sampler dumping collapsed stacks")
+
         self.period = period
         self.single = single
         self.min_time = min_time
         self.sampler = sampler
         self.storer = storer
+        self.engine = engine
+        self.span = span
+        self.annotate = annotate
+        self.threads = threads
+        self.aggregate = aggregate
+        self.deadline = deadline
+        self.burst = burst
+        self.remaining = remaining
+        self.margin = margin
 
     def __call__(self, func):
         @wraps(func)
         def profiler_wrapped(*args, **kwargs):
+            sampler = self.sampler
+            if callable(sampler):
+                sampler = sampler()
+            remaining = self.remaining
+            if callable(remaining):
+                remaining = remaining(*args, **kwargs)
             with Profiler(
                 period=self.period,
                 single=self.single,
                 min_time=self.min_time,
-                sampler=self.sampler,
+                sampler=sampler,
                 storer=self.storer,
+                engine=self.engine,
+                span=self.span,
+                annotate=self.annotate,
+                threads=self.threads,
+                aggregate=self.aggregate,
+                deadline=self.deadline,
+                burst=self.burst,
+                remaining=remaining,
+                margin=self.margin,
             ):
                 return func(*args, **kwargs)
 
         return profiler_wrapped
+
+
+def _on_shutdown(callback):
+    """
+    Call `callback` when the interpreter exits and when the process receives a
+    `SIGTERM` (then the previous handler of `SIGTERM` is honored). The handler of
+    `SIGTERM` can be installed only from the main thread.
+    """
+    atexit.register(callback)
+    if threading.current_thread() is not threading.main_thread():
+        logger.debug("Not in the main thread, won't handle SIGTERM")
+        return
+
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handler(signum, frame):
+        callback()
+        _forward(previous, signum, frame)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def _forward(previous, signum, frame):
+    """Honor `previous`, the handler of `SIGTERM` that was replaced by ours."""
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:  # Terminate as we would have done
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+class _Partial(Storer):
+    """Store the partial report of a `lambda_profile`'s window, starting a new one."""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def store(self, file):
+        self.owner._sampler = None
+        self.owner._store(file.read())
+
+
+class lambda_profile:
+    """
+    Profile an AWS Lambda handler across warm invocations of the same container:
+
+    @lambda_profile(period=0.01, window=300)
+    def handler(event, context):
+        ...
+
+    The sampler and the storer are created once and kept alive between invocations:
+    samples of all invocations are aggregated into a single report, which is stored
+    once per `window` and when the container shuts down.
+    """
+
+    def __init__(
+        self,
+        period=0.01,
+        single=True,
+        sampler=None,
+        storer=None,
+        engine="thread",
+        window=300,
+        tag=True,
+        margin=1,
+    ):
+        """
+        period (float)
+          Check `Profiler`.
+        single (bool)
+          Check `Profiler`.
+        sampler (func() -> Sampler)
+          Function to use to get a new sampler for each report. Defaults to
+          `StackCollapse` if None.
+        storer (Storer)
+          Storer to use to memorize reports. Defaults to an instance of `S3`, created
+          the first time a report is stored, if None.
+        engine (str)
+          Check `Profiler`.
+        window (float)
+          The report is stored at the end of the first invocation that ends `window`
+          seconds or more after the report's first invocation started.
+        tag (bool)
+          Add a `[request {aws_request_id}]` frame at the root of the stacks sampled
+          during each invocation (the sampler must support tags, check
+          `StackCollapse`).
+        margin (float)
+          Store the report (of the current window) when only `margin` seconds are left
+          before the invocation times out (according to the context's
+          `get_remaining_time_in_millis`) or on `SIGTERM`, check `Profiler`'s
+          `remaining`. Disabled if None.
+
+        The report of the last window is stored by `flush`, which is called when the
+        interpreter exits or on `SIGTERM`: note that Lambda sends `SIGTERM` to the
+        runtime on shutdown only if at least one extension is registered.
+        """
+        self.period = period
+        self.single = single
+        self.sampler = sampler or StackCollapse
+        self.storer = storer
+        self.engine = engine
+        self.window = window
+        self.tag = tag
+        self.margin = margin
+
+        self._sampler = None  # Sampler of the current window
+        self._window_start = None
+        _on_shutdown(self.flush)
+
+    def flush(self):
+        """
+        Store the report of the current window, if anything was sampled, and start a
+        new window.
+        """
+        sampler, self._sampler = self._sampler, None
+        if sampler is None:
+            return
+        try:
+            file = BytesIO()
+            sampler.dump(file)
+            self._store(file.getvalue())
+        except Exception:  # Never fail an invocation, or the shutdown, because of us
+            logger.exception("Unable to store report")
+
+    def _store(self, report):
+        if not report:
+            return
+        if self.storer is None:
+            self.storer = S3()
+        self.storer.store(BytesIO(report))
+
+    def __call__(self, func):
+        @wraps(func)
+        def profiler_wrapped(*args, **kwargs):
+            if self._sampler is None:
+                self._sampler = self.sampler()
+                self._window_start = time.time()
+            sampler = self._sampler
+
+            # Lambda's runtime calls `handler(event, context)`.
+            context = kwargs.get("context", args[1] if len(args) > 1 else None)
+            request_id = getattr(context, "aws_request_id", None)
+            if self.tag and request_id is not None:
+                sampler.tags = (f"[request {request_id}]",)
+            remaining = None
+            get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+            if self.margin is not None and get_remaining is not None:
+                remaining = get_remaining() / 1000
+            try:
+                with Profiler(
+                    period=self.period,
+                    single=self.single,
+                    min_time=float("inf"),  # Reports are stored by `flush`...
+                    sampler=sampler,
+                    storer=_Partial(self),  # ...or are partial
+                    engine=self.engine,
+                    remaining=remaining,
+                    margin=self.margin,
+                ):
+                    return func(*args, **kwargs)
+            finally:
+                sampler.tags = ()
+                if time.time() - self._window_start >= self.window:
+                    self.flush()
+
+        return profiler_wrapped
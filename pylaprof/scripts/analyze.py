@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+from array import array
+
+from pylaprof.scripts.diff import strip_lines
+from pylaprof.scripts.merge import read
+
+try:
+    import numpy
+
+except ModuleNotFoundError:  # pragma: nocover
+    numpy = None  # That's fine, we fall back to pure Python
+
+DEFAULT_TOP = 10
+
+
+class Columns:
+    """
+    Stackcollapse data in columnar form: each distinct frame is stored once in
+    `frames` and identified by its index there, stacks are concatenated in `ids` (frame
+    ids, root first) and stack i is `ids[offsets[i]:offsets[i + 1]]`, with `counts[i]`
+    hits.
+
+    With NumPy, `ids`, `offsets` and `counts` are NumPy arrays and queries are
+    vectorized, otherwise they are `array.array`s and queries are plain loops: results
+    are the same.
+    """
+
+    def __init__(self, frames, ids, offsets, counts):
+        self.frames = frames
+        if numpy is not None:
+            ids = numpy.asarray(ids, dtype=numpy.int64)
+            offsets = numpy.asarray(offsets, dtype=numpy.int64)
+            counts = numpy.asarray(counts, dtype=numpy.int64)
+        self.ids = ids
+        self.offsets = offsets
+        self.counts = counts
+
+    @classmethod
+    def load(cls, data):
+        """Build from `(stack, hits)` pairs, e.g. `merge.read(files)`."""
+        index = {}
+        frames = []
+        ids, offsets, counts = array("q"), array("q", [0]), array("q")
+        for stack, hits in data:
+            for frame in stack.split(";"):
+                i = index.get(frame)
+                if i is None:
+                    i = index[frame] = len(frames)
+                    frames.append(frame)
+                ids.append(i)
+            offsets.append(len(ids))
+            counts.append(hits)
+        return cls(frames, ids, offsets, counts)
+
+    def __len__(self):
+        """Number of stacks."""
+        return len(self.counts)
+
+    def total(self):
+        """Total number of hits."""
+        if numpy is not None:
+            return int(self.counts.sum())
+        return sum(self.counts)
+
+    def functions(self):
+        """Return a copy where frames of the same function are merged (line numbers
+        are removed, check `diff.strip_lines`)."""
+        index = {}
+        frames = []
+        table = array("q")  # Frame id -> function id
+        for frame in self.frames:
+            function = strip_lines(frame)
+            i = index.get(function)
+            if i is None:
+                i = index[function] = len(frames)
+                frames.append(function)
+            table.append(i)
+        if numpy is not None:
+            ids = numpy.frombuffer(table, dtype=numpy.int64)[self.ids]
+        else:
+            ids = array("q", (table[i] for i in self.ids))
+        return Columns(frames, ids, self.offsets, self.counts)
+
+    def filter(self, prefix):
+        """
+        Return a copy with only the stacks starting with `prefix`, a list of frames
+        (root first), e.g. the `[span 42]` tag or `main (app.py:3)`.
+        """
+        index = {frame: i for i, frame in enumerate(self.frames)}
+        wanted = [index.get(frame, -1) for frame in prefix]
+        offsets, ids, counts = self.offsets, self.ids, self.counts
+        if numpy is not None:
+            starts, ends = offsets[:-1], offsets[1:]
+            keep = ends - starts >= len(wanted)
+            for j, frame in enumerate(wanted):
+                positions = numpy.minimum(starts + j, len(ids) - 1)
+                keep &= ids[positions] == frame
+            lengths = (ends - starts)[keep]
+            new_offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+            numpy.cumsum(lengths, out=new_offsets[1:])
+            return Columns(
+                self.frames,
+                ids[numpy.repeat(keep, ends - starts)],
+                new_offsets,
+                counts[keep],
+            )
+
+        new_ids, new_offsets, new_counts = array("q"), array("q", [0]), array("q")
+        for i, hits in enumerate(counts):
+            start, end = offsets[i], offsets[i + 1]
+            stop = min(start + len(wanted), end)
+            if ids[start:stop].tolist() == wanted:
+                new_ids.extend(ids[start:end])
+                new_offsets.append(len(new_ids))
+                new_counts.append(hits)
+        return Columns(self.frames, new_ids, new_offsets, new_counts)
+
+    def self_hits(self):
+        """Return the self hits of each frame, as a sequence indexed by frame id."""
+        if numpy is not None:
+            if not len(self):
+                return numpy.zeros(len(self.frames), dtype=numpy.int64)
+            leaves = self.ids[self.offsets[1:] - 1]
+            return numpy.bincount(
+                leaves, weights=self.counts, minlength=len(self.frames)
+            ).astype(numpy.int64)
+
+        hits = [0] * len(self.frames)
+        for i, count in enumerate(self.counts):
+            hits[self.ids[self.offsets[i + 1] - 1]] += count
+        return hits
+
+    def total_hits(self):
+        """
+        Return the total hits of each frame, as a sequence indexed by frame id: frames
+        repeated in a stack (recursive calls) are counted once.
+        """
+        size = len(self.frames)
+        if numpy is not None:
+            # Group by (stack, frame) pairs to count recursive frames once per stack:
+            # sort the pairs and keep the first of each run (it's much faster than
+            # `numpy.unique`).
+            lengths = numpy.diff(self.offsets)
+            stacks = numpy.repeat(numpy.arange(len(self), dtype=numpy.int64), lengths)
+            keys = numpy.sort(stacks * size + self.ids)
+            first = numpy.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            pairs = keys[first]
+            return numpy.bincount(
+                pairs % size, weights=self.counts[pairs // size], minlength=size
+            ).astype(numpy.int64)
+
+        hits = [0] * size
+        ids, offsets = self.ids, self.offsets
+        for i, count in enumerate(self.counts):
+            start, end = offsets[i], offsets[i + 1]
+            for frame in set(ids[start:end]):
+                hits[frame] += count
+        return hits
+
+    def top(self, hits, n=DEFAULT_TOP):
+        """
+        Return the `(frame, hits)` pairs of the `n` frames with most `hits` (as
+        returned by `self_hits` or `total_hits`), ties broken by frame id.
+        """
+        if numpy is not None:
+            order = numpy.argsort(-hits, kind="stable")[:n]
+            return [(self.frames[i], int(hits[i])) for i in order if hits[i] > 0]
+
+        order = sorted(range(len(hits)), key=lambda i: -hits[i])[:n]
+        return [(self.frames[i], hits[i]) for i in order if hits[i] > 0]
+
+
+def analyze(files, n=DEFAULT_TOP, functions=False, prefix=None, out=None):
+    """
+    Print the `n` frames with most self and total hits among the stacks of `files`
+    starting with `prefix` (a list of frames) to `out` (defaults to standard output).
+    """
+    if out is None:
+        out = sys.stdout
+    columns = Columns.load(read(files))
+    if functions:
+        columns = columns.functions()
+    if prefix:
+        columns = columns.filter(prefix)
+
+    total = columns.total()
+    print(f"{len(columns)} stacks, {total} samples", file=out)
+    for kind, hits in (("self", columns.self_hits()), ("total", columns.total_hits())):
+        print(f"\nTop {n} frames by {kind} time:", file=out)
+        print(f"{'samples':>10} {'%':>7}  frame", file=out)
+        for frame, count in columns.top(hits, n):
+            print(f"{count:>10} {100 * count / total:7.2f}  {frame}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="rank the frames of stackcollapse files by self and total time"
+    )
+    parser.add_argument(
+        "files", metavar="FILE", type=str, nargs="+", help="a stackcollapse file"
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"number of frames to show (default: {DEFAULT_TOP})",
+    )
+    parser.add_argument(
+        "-f",
+        "--functions",
+        action="store_true",
+        help="ignore line numbers, aggregating frames by function",
+    )
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        help="keep only stacks starting with these frames, e.g. 'main (app.py:3);f (app.py:7)'",  # noqa
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    prefix = opts.prefix.split(";") if opts.prefix else None
+    analyze(opts.files, n=opts.top, functions=opts.functions, prefix=prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+import argparse
+import re
+import sys
+
+from pylaprof import CallGraph
+from pylaprof.scripts.merge import read
+
+DEFAULT_OUT = "callgrind.out"
+
+# `func (file:lineno)` with "line" granularity, `func (file)` with "function" one.
+FRAME = re.compile(r"(?P<name>.*) \((?P<filename>.*?)(?::(?P<lineno>\d+))?\)$")
+
+
+def parse(frame):
+    """
+    Return the `(function, lineno)` tuple of a stackcollapse frame (check
+    `CallGraph.add`). Frames that aren't formatted by `StackCollapse` (e.g. tags or
+    folded runs) are functions of file `CallGraph.SYNTHETIC`.
+    """
+    match = FRAME.match(frame)
+    if match is None:
+        return ((CallGraph.SYNTHETIC, frame, 0), 0)
+    lineno = int(match.group("lineno") or 0)
+    return ((match.group("filename"), match.group("name"), 0), lineno)
+
+
+def convert(files, dst):
+    graph = CallGraph()
+    parsed = {}  # Frame -> `parse(frame)`, frames are repeated in many stacks
+    for stack, hits in read(files):
+        frames = []
+        for frame in reversed(stack.split(";")):
+            function = parsed.get(frame)
+            if function is None:
+                function = parsed[frame] = parse(frame)
+            frames.append(function)
+        graph.add(frames, hits)
+
+    with open(dst, "wb") as fp:
+        graph.dump(fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="convert stackcollapse files to a call graph in callgrind format"
+    )
+    parser.add_argument(
+        "files", metavar="FILE", type=str, nargs="+", help="a stackcollapse file"
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        default=DEFAULT_OUT,
+        help=f"write the call graph to this file (default: {DEFAULT_OUT})",
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    convert(opts.files, opts.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import argparse
+import re
+import sys
+from collections import defaultdict
+
+from pylaprof.scripts.merge import read
+
+DEFAULT_OUT = "stackcollapse-diff.txt"
+DEFAULT_TOP = 10
+
+_lineno = re.compile(r":\d+\)$")
+
+
+def strip_lines(stack):
+    """
+    Remove line numbers from the frames of a stack: `f (mod.py:42)` -> `f (mod.py)`.
+    """
+    return ";".join(_lineno.sub(")", frame) for frame in stack.split(";"))
+
+
+def aggregate(files, functions=False):
+    """
+    Sum the hits of each stack found in `files`.
+
+    Return the aggregated data and the total number of hits.
+    """
+    data = defaultdict(lambda: 0)
+    total = 0
+    for stack, hits in read(files):
+        if functions:
+            stack = strip_lines(stack)
+        data[stack] += hits
+        total += hits
+    return data, total
+
+
+def frame_times(data):
+    """
+    Compute self and total hits of each frame of stackcollapse data.
+    """
+    self_hits = defaultdict(lambda: 0)
+    total_hits = defaultdict(lambda: 0)
+    for stack, hits in data.items():
+        frames = stack.split(";")
+        self_hits[frames[-1]] += hits
+        for frame in set(frames):  # Don't count recursive calls twice
+            total_hits[frame] += hits
+    return self_hits, total_hits
+
+
+def diff(baseline, candidate, dst, top=DEFAULT_TOP, functions=False, out=None):
+    """
+    Write a two-column stackcollapse of `baseline` and `candidate` files to `dst`, in
+    the format of flamegraph's `difffolded.pl` with baseline's hits normalized to the
+    candidate's total, and print the top `top` regressions and improvements to `out`
+    (defaults to standard output).
+    """
+    if out is None:
+        out = sys.stdout
+    base, base_total = aggregate(baseline, functions)
+    cand, cand_total = aggregate(candidate, functions)
+    scale = cand_total / base_total if base_total else 0
+
+    with open(dst, "w") as fp:
+        for stack in base.keys() | cand.keys():
+            print(stack, round(base.get(stack, 0) * scale), cand.get(stack, 0), file=fp)
+
+    # Compare frames' share of samples, in percentage.
+    base_times = frame_times(base)
+    cand_times = frame_times(cand)
+    for kind, base_hits, cand_hits in zip(("self", "total"), base_times, cand_times):
+        rows = []
+        for frame in base_hits.keys() | cand_hits.keys():
+            b = 100 * base_hits.get(frame, 0) / base_total if base_total else 0
+            c = 100 * cand_hits.get(frame, 0) / cand_total if cand_total else 0
+            rows.append((c - b, b, c, frame))
+        rows.sort(key=lambda row: row[0])
+
+        regressions = [row for row in rows[::-1][:top] if row[0] > 0]
+        improvements = [row for row in rows[:top] if row[0] < 0]
+        for title, rows in (
+            ("regressions", regressions),
+            ("improvements", improvements),
+        ):
+            print(f"Top {title} by {kind} time:", file=out)
+            print(f"{'delta%':>8} {'base%':>8} {'cand%':>8}  frame", file=out)
+            for delta, b, c, frame in rows:
+                print(f"{delta:+8.2f} {b:8.2f} {c:8.2f}  {frame}", file=out)
+            print(file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compare a baseline set of stackcollapses with a candidate one"
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        metavar="FILE",
+        type=str,
+        nargs="+",
+        required=True,
+        help="a stackcollapse file of the baseline",
+    )
+    parser.add_argument(
+        "-c",
+        "--candidate",
+        metavar="FILE",
+        type=str,
+        nargs="+",
+        required=True,
+        help="a stackcollapse file of the candidate",
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        default=DEFAULT_OUT,
+        help=f"write resulting two-column stackcollapse to this file (default: {DEFAULT_OUT})",  # noqa
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"number of regressions and improvements to show (default: {DEFAULT_TOP})",
+    )
+    parser.add_argument(
+        "-f",
+        "--functions",
+        action="store_true",
+        help="ignore line numbers, useful when comparing different code versions",
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    diff(
+        opts.baseline, opts.candidate, opts.out, top=opts.top, functions=opts.functions
+    )
+
+
+if __name__ == "__main__":
+    main()
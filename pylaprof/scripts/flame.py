@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import zlib
+from collections import defaultdict
+from html import escape
+
+from pylaprof.scripts.merge import read
+
+DEFAULT_OUT = "flame.svg"
+DEFAULT_TOP = 10
+DEFAULT_WIDTH = 1200
+DEFAULT_MIN_WIDTH = 0.1
+
+FRAME_HEIGHT = 16
+FONT_SIZE = 12
+FONT_WIDTH = 0.59  # Average character width, relative to font size
+PAD = 10  # Horizontal padding
+HEADER = 40  # Room for title and reset button
+
+SCRIPT = """
+var frames = document.getElementsByClassName("f");
+function label(g, width) {
+  var name = g.getAttribute("data-n"), chars = Math.floor(width / %(char)f);
+  if (chars < 3) return "";
+  return name.length <= chars ? name : name.substring(0, chars - 2) + "..";
+}
+function zoom(x, w) {
+  for (var i = 0; i < frames.length; i++) {
+    var g = frames[i], fx = +g.getAttribute("data-x"), fw = +g.getAttribute("data-w");
+    var left = Math.max(fx, x), right = Math.min(fx + fw, x + w);
+    if (right <= left) { g.style.display = "none"; continue; }
+    g.style.display = "";
+    var px = %(pad)d + (left - x) / w * %(width)d, pw = (right - left) / w * %(width)d;
+    var rect = g.getElementsByTagName("rect")[0];
+    var text = g.getElementsByTagName("text")[0];
+    rect.setAttribute("x", px);
+    rect.setAttribute("width", Math.max(pw - 1, 0));
+    text.setAttribute("x", px + 3);
+    text.textContent = label(g, pw);
+  }
+  document.getElementById("reset").style.display = w < 1 ? "" : "none";
+}
+for (var i = 0; i < frames.length; i++) {
+  frames[i].onclick = function () {
+    zoom(+this.getAttribute("data-x"), +this.getAttribute("data-w"));
+  };
+}
+document.getElementById("reset").onclick = function () { zoom(0, 1); };
+"""
+
+
+def build(data):
+    """
+    Build a call tree from `(stack, hits)` pairs in a single pass.
+
+    Nodes are identified by integers (0 is the root) and the tree is returned as a
+    `(frames, hits, children)` tuple of lists indexed by node: frame's name, hits of the
+    node's subtree and node's children.
+    """
+    # Looking up `(parent, frame)` keys in a flat dictionary is much faster than
+    # allocating a dictionary of children for each node.
+    index = {}
+    frames = [None]
+    counts = [0]
+    for stack, hits in data:
+        counts[0] += hits
+        node = 0
+        for frame in stack.split(";"):
+            key = (node, frame)
+            child = index.get(key)
+            if child is None:
+                child = index[key] = len(frames)
+                frames.append(frame)
+                counts.append(0)
+            counts[child] += hits
+            node = child
+
+    children = [[] for _ in frames]
+    for (parent, _), child in index.items():
+        children[parent].append(child)
+    return frames, counts, children
+
+
+def times(tree):
+    """
+    Compute self and total hits of each frame of the call tree.
+    """
+    frames, counts, children = tree
+    self_hits = defaultdict(lambda: 0)
+    total_hits = defaultdict(lambda: 0)
+    on_path = defaultdict(lambda: 0)  # Occurrences of frames in the current path
+    todo = [child for child in children[0]]
+    while todo:
+        node = todo.pop()
+        if node < 0:  # We are done with the subtree of ~node
+            on_path[frames[~node]] -= 1
+            continue
+        frame = frames[node]
+        self_hits[frame] += counts[node] - sum(counts[c] for c in children[node])
+        if not on_path[frame]:  # Don't count recursive calls twice
+            total_hits[frame] += counts[node]
+        on_path[frame] += 1
+        todo.append(~node)
+        todo.extend(children[node])
+    return self_hits, total_hits
+
+
+def layout(tree, min_hits):
+    """
+    Compute position of tree's frames: return a list of `(frame, depth, x, hits)`
+    tuples, where `x` is the offset in hits from the left border.
+
+    Subtrees with less than `min_hits` are pruned: they would be too narrow to be seen.
+    """
+    frames, counts, children = tree
+    rects = []
+    todo = [(0, -1, 0)]  # Iterate instead of recursing: stacks can be very deep
+    while todo:
+        node, depth, x = todo.pop()
+        if node:
+            rects.append((frames[node], depth, x, counts[node]))
+        for child in children[node]:
+            if counts[child] >= min_hits:
+                todo.append((child, depth + 1, x))
+            x += counts[child]
+    return rects
+
+
+def color(frame):
+    """Return a deterministic warm color for a frame's function."""
+    h = zlib.crc32(frame.split(" ", 1)[0].encode())
+    return f"rgb({205 + h % 50},{(h >> 8) % 230},{(h >> 16) % 55})"
+
+
+def svg(
+    tree, fp, title="Flame Graph", width=DEFAULT_WIDTH, min_width=DEFAULT_MIN_WIDTH
+):
+    """
+    Write an interactive SVG flamegraph of the call tree to the file `fp`.
+    Frames narrower than `min_width` pixels are omitted.
+    """
+    total = tree[1][0]
+    inner = width - 2 * PAD
+    frames = layout(tree, min_width * total / inner) if total else []
+    depth = max((f[1] for f in frames), default=-1) + 1
+    height = HEADER + depth * FRAME_HEIGHT + PAD
+    char = FONT_SIZE * FONT_WIDTH
+
+    def label(name, px):
+        chars = int(px / char)
+        if chars < 3:
+            return ""
+        return name if len(name) <= chars else name[: chars - 2] + ".."
+
+    fp.write(
+        '<?xml version="1.0" standalone="no"?>\n'
+        f'<svg version="1.1" width="{width}" height="{height}" '
+        f'viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg" '
+        f'font-family="Verdana" font-size="{FONT_SIZE}">\n'
+        f'<rect width="100%" height="100%" fill="#eeeeb0"/>\n'
+        f'<text x="{width / 2}" y="24" font-size="17" text-anchor="middle">'
+        f"{escape(title)}</text>\n"
+        f'<text id="reset" x="{PAD}" y="24" style="display:none;cursor:pointer">'
+        "Reset Zoom</text>\n"
+    )
+    for frame, d, x, hits in frames:
+        px = PAD + x / total * inner
+        pw = hits / total * inner
+        y = height - PAD - (d + 1) * FRAME_HEIGHT
+        name = escape(frame)
+        fp.write(
+            f'<g class="f" data-n="{name}" '
+            f'data-x="{x / total}" data-w="{hits / total}">'
+            f"<title>{name} ({hits} samples, {100 * hits / total:.2f}%)</title>"
+            f'<rect x="{px:.1f}" y="{y}" width="{max(pw - 1, 0):.1f}" '
+            f'height="{FRAME_HEIGHT - 1}" fill="{color(frame)}" rx="2"/>'
+            f'<text x="{px + 3:.1f}" y="{y + FRAME_HEIGHT - 4}">'
+            f"{escape(label(frame, pw))}</text></g>\n"
+        )
+    script = SCRIPT % {"char": char, "pad": PAD, "width": inner}
+    fp.write(f"<script><![CDATA[{script}]]></script>\n</svg>\n")
+
+
+def top(self_hits, total_hits, n=DEFAULT_TOP, out=None):
+    """
+    Print the `n` frames with most self and total hits to `out` (defaults to standard
+    output).
+    """
+    if out is None:
+        out = sys.stdout
+    total = sum(self_hits.values())
+    for kind, hits in (("self", self_hits), ("total", total_hits)):
+        print(f"Top {n} frames by {kind} time:", file=out)
+        print(f"{'samples':>10} {'%':>7}  frame", file=out)
+        for frame, count in sorted(hits.items(), key=lambda i: -i[1])[:n]:
+            print(f"{count:>10} {100 * count / total:7.2f}  {frame}", file=out)
+        print(file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="render stackcollapse files as an interactive SVG flamegraph"
+    )
+    parser.add_argument(
+        "files", metavar="FILE", type=str, nargs="+", help="a stackcollapse file"
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        default=DEFAULT_OUT,
+        help=f"write the flamegraph to this file (default: {DEFAULT_OUT})",
+    )
+    parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"number of frames to show in top tables, 0 to disable (default: {DEFAULT_TOP})",  # noqa
+    )
+    parser.add_argument(
+        "--title", default="Flame Graph", help="title of the flamegraph"
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        default=DEFAULT_WIDTH,
+        help=f"width of the flamegraph in pixels (default: {DEFAULT_WIDTH})",
+    )
+    parser.add_argument(
+        "--min-width",
+        type=float,
+        default=DEFAULT_MIN_WIDTH,
+        help=f"omit frames narrower than this many pixels (default: {DEFAULT_MIN_WIDTH})",  # noqa
+    )
+    opts = parser.parse_args(sys.argv[1:])
+
+    tree = build(read(opts.files))
+    with open(opts.out, "w") as fp:
+        svg(tree, fp, title=opts.title, width=opts.width, min_width=opts.min_width)
+    if opts.top > 0:
+        top(*times(tree), n=opts.top)
+
+
+if __name__ == "__main__":
+    main()
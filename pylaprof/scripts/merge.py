@@ -7,15 +7,37 @@ from collections import defaultdict
 DEFAULT_OUT = "stackcollapse-merged.txt"
 
 
-def merge(files, dst):
-    data = defaultdict(lambda: 0)
-
+def read(files):
+    """
+    Iterate over the `(stack, hits)` pairs of multiple stackcollapse files, one line at
+    a time.
+    """
     for file in files:
         with open(file, "r") as fp:
-            for line in fp.readlines():
+            for line in fp:
                 stack, hits = line.rsplit(" ", 1)
-                hits = int(hits)
-                data[stack] += hits
+                yield stack, int(hits)
+
+
+def tagged(stack, tag):
+    """
+    Return whether `tag` is one of the synthetic frames (e.g. `[span 42]`) at the root
+    of `stack`.
+    """
+    for frame in stack.split(";"):
+        if frame == tag:
+            return True
+        if not frame.startswith("["):
+            return False
+    return False
+
+
+def merge(files, dst, tag=None):
+    data = defaultdict(lambda: 0)
+
+    for stack, hits in read(files):
+        if tag is None or tagged(stack, tag):
+            data[stack] += hits
 
     with open(dst, "w") as fp:
         for stack, hits in data.items():
@@ -36,9 +58,14 @@ def main():
         default=DEFAULT_OUT,
         help=f"write resulting stackcollapse to this file (default: {DEFAULT_OUT})",
     )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        help="keep only stacks tagged with this root frame, e.g. '[span 42]'",
+    )
     opts = parser.parse_args(sys.argv[1:])
 
-    merge(opts.files, opts.out)
+    merge(opts.files, opts.out, tag=opts.tag)
 
 
 if __name__ == "__main__":
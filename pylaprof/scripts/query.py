@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+
+from pylaprof import SQLite
+from pylaprof.scripts.merge import read
+
+DEFAULT_DB = "pylaprof.db"
+DEFAULT_TOP = 10
+
+
+def timestamp(value):
+    """Parse an ISO 8601 date (UTC if no timezone is given) into Unix time."""
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def table(rows, header, total, out=None):
+    """Print `(name, hits)` rows, with their share of `total` hits, to `out`
+    (defaults to standard output)."""
+    if out is None:
+        out = sys.stdout
+    total = total or 1
+    print(f"{'samples':>10} {'%':>7}  {header}", file=out)
+    for name, hits in rows:
+        print(f"{hits:>10} {100 * hits / total:7.2f}  {name}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ingest stackcollapse files into an indexed SQLite database and "
+        "query it"
+    )
+    parser.add_argument(
+        "-d",
+        "--db",
+        default=DEFAULT_DB,
+        help=f"path of the database (default: {DEFAULT_DB})",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest = commands.add_parser("ingest", help="add stackcollapse files")
+    ingest.add_argument(
+        "files", metavar="FILE", type=str, nargs="+", help="a stackcollapse file"
+    )
+    ingest.add_argument(
+        "--time",
+        type=timestamp,
+        help="reports' date in ISO 8601 format (default: files' modification time)",
+    )
+    ingest.add_argument(
+        "--partition",
+        type=int,
+        help="aggregate hits by periods of this many seconds (default: 3600); it's "
+        "set when the database is created and can't change",
+    )
+
+    queries = []
+    top = commands.add_parser("top", help="functions with most self or total time")
+    top.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=DEFAULT_TOP,
+        help=f"number of functions to show (default: {DEFAULT_TOP})",
+    )
+    top.add_argument(
+        "--total", action="store_true", help="rank by total instead of self time"
+    )
+    queries.append(top)
+    for name in ("callers", "callees"):
+        calls = commands.add_parser(name, help=f"{name} of a function")
+        calls.add_argument(
+            "function", help="function, e.g. 'main (app.py)' or just 'main'"
+        )
+        queries.append(calls)
+    queries.append(commands.add_parser("totals", help="total hits per time partition"))
+    for query in queries:
+        query.add_argument(
+            "--since", type=timestamp, help="start date in ISO 8601 format"
+        )
+        query.add_argument(
+            "--until", type=timestamp, help="end date in ISO 8601 format"
+        )
+
+    opts = parser.parse_args(sys.argv[1:])
+
+    if opts.command == "ingest":
+        try:
+            db = SQLite(opts.db, partition=opts.partition)
+        except ValueError as exc:
+            parser.error(str(exc))
+        for file in opts.files:
+            when = opts.time if opts.time is not None else os.path.getmtime(file)
+            db.ingest(read([file]), when)
+        return
+
+    db = SQLite(opts.db)
+    since, until = opts.since, opts.until
+    totals = db.totals(since=since, until=until)
+    total = sum(hits for _, hits in totals)
+    if opts.command == "top":
+        kind = "total" if opts.total else "self"
+        rows = db.top(opts.top, total=opts.total, since=since, until=until)
+        table(rows, f"function (by {kind} time)", total)
+    elif opts.command == "callers":
+        table(db.callers(opts.function, since=since, until=until), "caller", total)
+    elif opts.command == "callees":
+        table(db.callees(opts.function, since=since, until=until), "callee", total)
+    else:
+        dates = [
+            (datetime.fromtimestamp(bucket, timezone.utc).isoformat(), hits)
+            for bucket, hits in totals
+        ]
+        table(dates, "partition", total)
+
+
+if __name__ == "__main__":
+    main()
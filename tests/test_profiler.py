@@ -1,10 +1,38 @@
+import contextvars
+import os
+import signal
+import socket
 import sys
 import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import defaultdict
 from inspect import signature
 from io import BytesIO
-from unittest.mock import MagicMock, Mock
+from types import SimpleNamespace
+from unittest.mock import MagicMock, Mock, call
 
-from pylaprof import Profiler, profile
+import pytest
+
+import pylaprof
+from pylaprof import (
+    Aggregate,
+    BoundedStackCollapse,
+    CallGraph,
+    Profiler,
+    SharedStackCollapse,
+    StackCollapse,
+    Threads,
+    Tracemalloc,
+    _cpu_clocks,
+    _on_shutdown,
+    _ThreadStates,
+    lambda_profile,
+    profile,
+    serve,
+)
 
 
 def test_profiler_init():
@@ -15,11 +43,17 @@ def test_profiler_init():
     storer = object()
 
     profiler = Profiler(
-        period=period, single=single, min_time=min_time, sampler=sampler, storer=storer
+        period=period,
+        single=single,
+        min_time=min_time,
+        sampler=sampler,
+        storer=storer,
+        engine="thread",
     )
 
     # Check instance attributes were correctly set
     assert profiler.period == period
+    assert profiler.engine == "thread"
     assert profiler._test is None  # None will signal to the profiler thread to setup a
     # test function that excludes itself.
     assert profiler.min_time == min_time
@@ -47,6 +81,7 @@ def test_profiler_init_defaults(monkeypatch):
     assert profiler._test is not None
     assert profiler._test(threading.get_ident()) is True
     assert profiler.min_time == 0
+    assert profiler.engine == "thread"
     assert profiler.sampler == stack_collapse_mock()
     assert profiler.storer == s3_mock()
     assert profiler._can_run is False
@@ -55,6 +90,52 @@ def test_profiler_init_defaults(monkeypatch):
     assert profiler.clean_exit is False
 
 
+def test_profiler_init_invalid_engine():
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), engine="magic")
+
+    # Annotations need to sample threads that aren't running.
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), engine="signal", annotate=True)
+
+    # Spans can be read only from the sampled thread.
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), span=contextvars.ContextVar("s"))
+
+    # The burst period is useless without a deadline.
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), burst=0.001)
+
+    # Aggregates merge collapsed stacks' hits, not call graphs or bytes.
+    for sampler in (CallGraph(), Tracemalloc(), object()):
+        with pytest.raises(ValueError):
+            Profiler(sampler=sampler, storer=object(), aggregate=Aggregate())
+    for sampler in (None, BoundedStackCollapse(), SharedStackCollapse()):
+        Profiler(sampler=sampler, storer=object(), aggregate=Aggregate())
+
+    # Thread selection is pointless when sampling a single thread.
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), threads=Threads())
+
+    # Signal engine can sample only the main thread...
+    with pytest.raises(ValueError):
+        Profiler(sampler=object(), storer=object(), single=False, engine="signal")
+
+    # ... and must be set up from it.
+    errors = []
+
+    def init():
+        try:
+            Profiler(sampler=object(), storer=object(), engine="signal")
+        except ValueError:
+            errors.append(True)
+
+    thread = threading.Thread(target=init)
+    thread.start()
+    thread.join()
+    assert errors == [True]
+
+
 def test_profiler_start(monkeypatch):
     monkeypatch.setattr(threading.Thread, "start", Mock())
     profiler = Profiler(storer=object(), sampler=object())
@@ -189,6 +270,7 @@ def test_profiler_run_min_time(monkeypatch):
     profiler.join()
     profiler.sampler.sample.assert_called()  # We sampled some stack frames...
     profiler.sampler.dump.assert_not_called()  # ... but didn't store them.
+    profiler.sampler.close.assert_called_once()  # The session is over anyway.
 
     profiler = Profiler(min_time=min_time, sampler=Mock(), storer=Mock())
     mtime.time.return_value = 0
@@ -198,6 +280,61 @@ def test_profiler_run_min_time(monkeypatch):
     profiler.join()
     profiler.sampler.sample.assert_called()  # We sampled some stack frames...
     profiler.sampler.dump.assert_called()  # ... and stored them.
+    profiler.sampler.close.assert_called_once()
+
+
+def test_profiler_run_aggregate():
+    """Check that sampler's report is added to the aggregate even if it isn't stored."""
+    sampler = StackCollapse()
+    sampler._data[("f",)] = 3
+    storer = Mock()
+    aggregate = Aggregate()
+    for _ in range(2):
+        with Profiler(min_time=60, sampler=sampler, storer=storer, aggregate=aggregate):
+            pass
+
+    storer.store.assert_not_called()
+    assert aggregate._copy()[b"f"] == 6
+
+
+def test_profiler_run_aggregate_after_store():
+    """Check that the report is stored before being added to the aggregate, so that a
+    bad report can't prevent storing it."""
+    calls = []
+
+    def add(report):
+        calls.append("add")
+        raise ValueError
+
+    profiler = Profiler(sampler=StackCollapse(), storer=Mock(), aggregate=Aggregate())
+    profiler.storer.store.side_effect = lambda file: calls.append("store")
+    profiler.aggregate.add = add
+    with profiler:
+        pass
+
+    assert calls == ["store", "add"]
+
+
+def test_profiler_run_tracemalloc():
+    """Check that a `Tracemalloc` sampler stops tracing at the end of each session,
+    even if its report isn't stored, and that it can be used again."""
+    sampler = Tracemalloc(interval=0, max_overhead=1)
+    storer = Mock()
+    with Profiler(period=0.001, min_time=60, sampler=sampler, storer=storer):
+        time.sleep(0.02)
+    storer.store.assert_not_called()
+    assert sampler.snapshots > 0
+    assert not tracemalloc.is_tracing()
+    assert sampler._start is sampler._snapshot is None
+
+    storer, reports = storing()
+    with Profiler(period=0.001, sampler=sampler, storer=storer):
+        time.sleep(0.02)
+        data = bytearray(1 << 20)
+        time.sleep(0.02)
+    assert not tracemalloc.is_tracing()
+    sizes = [int(line.rsplit(" ", 1)[1]) for line in reports[0].splitlines()]
+    assert max(sizes) >= len(data)
 
 
 def test_profiler_run_exception(monkeypatch):
@@ -231,6 +368,744 @@ def test_profiler_run_exception(monkeypatch):
     # execution failed.
 
 
+def busy(duration):
+    """Burn CPU time in the current thread for `duration` seconds."""
+    end = time.time() + duration
+    while time.time() < end:
+        pass
+
+
+def test_profiler_run_signal_engine():
+    """Check that with the signal engine frames of the main thread are sampled from a
+    SIGPROF handler, which is removed once the profiler stops."""
+    prev_handler = signal.getsignal(signal.SIGPROF)
+    profiler = Profiler(period=0.005, sampler=Mock(), storer=Mock(), engine="signal")
+
+    with profiler:
+        assert signal.getsignal(signal.SIGPROF) == profiler._handle_signal
+        busy(0.1)
+
+    assert signal.getsignal(signal.SIGPROF) == prev_handler
+    assert signal.getitimer(signal.ITIMER_PROF) == (0.0, 0.0)
+    assert profiler.sampler.sample.call_count > 0
+    frames = {
+        args[0].f_code.co_name for args, _ in profiler.sampler.sample.call_args_list
+    }
+    assert "busy" in frames
+    profiler.sampler.dump.assert_called_once()
+    profiler.storer.store.assert_called_once()
+    assert profiler.clean_exit is True
+
+
+def test_profiler_run_signal_engine_pylaprof_disable(monkeypatch):
+    monkeypatch.setenv("PYLAPROF_DISABLE", "true")
+    prev_handler = signal.getsignal(signal.SIGPROF)
+    profiler = Profiler(sampler=Mock(), storer=Mock(), engine="signal")
+
+    with profiler:
+        assert signal.getsignal(signal.SIGPROF) == prev_handler
+        busy(0.05)
+
+    profiler.sampler.sample.assert_not_called()
+    assert profiler.clean_exit is True
+
+
+def test_profiler_run_signal_engine_exception(monkeypatch):
+    """Check that an exception in the signal handler doesn't reach the interrupted code
+    and is logged by the profiler's thread."""
+    logger = Mock()
+    monkeypatch.setattr("pylaprof.logger", logger)
+    profiler = Profiler(period=0.005, sampler=Mock(), storer=Mock(), engine="signal")
+    profiler.sampler.sample.side_effect = KeyError
+
+    with profiler:
+        busy(0.05)
+
+    profiler.sampler.sample.assert_called_once()  # Timer was disarmed
+    profiler.storer.store.assert_not_called()
+    logger.exception.assert_called()
+    assert profiler.clean_exit is False
+
+
+def test_profiler_span():
+    """Check that with the signal engine samples are tagged with the active span,
+    under the tags the sampler had when the profiler started."""
+    span = contextvars.ContextVar("span")
+    sampler = StackCollapse()
+    sampler.tags = ("[request 1]",)
+
+    def traced(value):
+        token = span.set(value)
+        try:
+            busy(0.05)
+        finally:
+            span.reset(token)
+
+    profiler = Profiler(
+        period=0.002, sampler=sampler, storer=Mock(), engine="signal", span=span
+    )
+    with profiler:
+        traced("a")
+        busy(0.05)
+        traced("b")
+
+    assert sampler.tags == ("[request 1]",)
+    roots = {stack[-1] for stack in sampler._data}
+    assert roots == {"[request 1]"}
+    spans = {stack[-2] for stack in sampler._data if stack[-2].startswith("[")}
+    assert spans == {"[span a]", "[span b]"}
+    assert any(not stack[-2].startswith("[") for stack in sampler._data)
+
+
+def test_profiler_shared_sampler_tags():
+    """Check that per-thread profilers sharing a `SharedStackCollapse` don't tag each
+    other's samples: each one uses the tags of the thread that started it."""
+    sampler = SharedStackCollapse()
+    barrier = threading.Barrier(2)
+
+    def section(name):
+        sampler.tags = (f"[{name}]",)
+        with Profiler(period=0.005, sampler=sampler, storer=Mock()):
+            barrier.wait()
+            busy(0.1)
+
+    threads = [
+        threading.Thread(target=section, args=(name,)) for name in ("first", "second")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    tags = {stack[-1] for stack in sampler.snapshot()._data}
+    assert tags == {"[first]", "[second]"}
+
+
+def burst_hits(sampler):
+    """Return the hits of samples taken before and during the burst."""
+    hits = {False: 0, True: 0}
+    for stack, count in sampler._data.items():
+        hits["[burst]" in stack] += count
+    return hits[False], hits[True]
+
+
+def test_profiler_burst(monkeypatch):
+    """Check that past the deadline samples are taken more often and tagged, under the
+    tags the sampler had when the profiler started."""
+    clock = Mock(wraps=time)
+    clock.monotonic.return_value = 0
+    monkeypatch.setattr("pylaprof.time", clock)
+
+    def run(profiler, ticks):
+        """Run the profiler for `ticks` samples: each wait advances the clock."""
+        waits = []
+
+        def wait(timeout=None):
+            waits.append(timeout)
+            clock.monotonic.return_value += timeout
+            if len(waits) == ticks:
+                profiler._can_run = False
+            return False
+
+        profiler._stop_event = Mock(wait=wait)
+        profiler.start()
+        profiler.join()
+        return waits
+
+    sampler = StackCollapse()
+    sampler.tags = ("[request 1]",)
+    profiler = Profiler(
+        period=0.05, sampler=sampler, storer=Mock(), deadline=0.1, burst=0.002
+    )
+    # The sample at the deadline is the last regular one.
+    assert run(profiler, 10) == [0.05, 0.05] + [0.002] * 8
+    assert sampler.tags == ("[request 1]",)
+    assert burst_hits(sampler) == (3, 7)
+    assert {stack[-2:] for stack in sampler._data if "[burst]" in stack} == {
+        ("[burst]", "[request 1]")
+    }
+
+    # Sections that end before the deadline aren't affected.
+    sampler = StackCollapse()
+    clock.monotonic.return_value = 0
+    profiler = Profiler(period=0.01, sampler=sampler, storer=Mock(), deadline=10)
+    assert profiler.burst == 0.001
+    assert run(profiler, 5) == [0.01] * 5
+    assert burst_hits(sampler) == (5, 0)
+
+
+def test_profiler_burst_signal_engine(monkeypatch):
+    """Check that the signal engine bursts too: the first signal past the deadline arms
+    the timer with the burst period, and spans are inside the burst tag."""
+    clock = Mock(wraps=time)
+    monkeypatch.setattr("pylaprof.time", clock)
+    setitimer = Mock()  # Signals are sent by hand
+    monkeypatch.setattr("pylaprof.signal.setitimer", setitimer)
+    frame = sys._getframe()
+
+    def run(profiler, ticks):
+        clock.monotonic.return_value = 0
+        setitimer.reset_mock()
+        with profiler:
+            for now in ticks:
+                clock.monotonic.return_value = now
+                profiler._handle_signal(signal.SIGPROF, frame)
+        return setitimer.call_args_list
+
+    span = contextvars.ContextVar("span")
+    sampler = StackCollapse()
+    profiler = Profiler(
+        period=0.05,
+        sampler=sampler,
+        storer=Mock(),
+        engine="signal",
+        span=span,
+        deadline=0.1,
+        burst=0.002,
+    )
+    token = span.set("a")
+    try:
+        calls = run(profiler, [0, 0.05, 0.1, 0.102, 0.104])
+    finally:
+        span.reset(token)
+
+    assert calls == [
+        call(signal.ITIMER_PROF, 0.05, 0.05),
+        call(signal.ITIMER_PROF, 0.002, 0.002),
+        call(signal.ITIMER_PROF, 0),
+    ]
+    assert sampler.tags == ()
+    assert burst_hits(sampler) == (2, 3)
+    assert {stack[-2:] for stack in sampler._data if "[burst]" in stack} == {
+        ("[span a]", "[burst]")
+    }
+
+    # Without span.
+    sampler = StackCollapse()
+    profiler = Profiler(
+        period=0.05, sampler=sampler, storer=Mock(), engine="signal", deadline=0.05
+    )
+    assert len(run(profiler, [0, 0.05])) == 3
+    assert sampler.tags == ()
+    assert burst_hits(sampler) == (1, 1)
+    assert {stack[-1] for stack in sampler._data if "[burst]" in stack} == {"[burst]"}
+
+
+def test_profiler_burst_shared_sampler():
+    """Check that per-thread profilers sharing a `SharedStackCollapse` don't tag each
+    other's samples: only the profiler past its deadline bursts."""
+    sampler = SharedStackCollapse()
+    barrier = threading.Barrier(2)
+
+    def fast():
+        busy(0.2)
+
+    def slow():
+        busy(0.2)
+
+    def section(func, deadline):
+        sampler.tags = (f"[{func.__name__}]",)
+        with Profiler(period=0.01, sampler=sampler, storer=Mock(), deadline=deadline):
+            barrier.wait()
+            func()
+
+    threads = [
+        threading.Thread(target=section, args=(fast, 10)),
+        threading.Thread(target=section, args=(slow, 0.05)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    data = sampler.snapshot()._data
+    tags = {stack[-2:] for stack in data if "[burst]" in stack}
+    assert tags == {("[burst]", "[slow]")}
+    assert any(stack[-1] == "[fast]" for stack in data)
+
+
+def storing():
+    """Return a storer mock and the list of the reports it stored."""
+    reports = []
+    storer = Mock()
+    storer.store.side_effect = lambda file: reports.append(file.read().decode())
+    return storer, reports
+
+
+@pytest.mark.parametrize("engine", ["thread", "signal"])
+def test_profiler_partial_flush(engine):
+    """Simulate a deadline: when only `margin` seconds are left a partial report is
+    stored, even below `min_time`, and nothing else when the profiler stops."""
+    storer, reports = storing()
+    with Profiler(
+        period=0.001,
+        min_time=60,
+        storer=storer,
+        engine=engine,
+        remaining=0.15,
+        margin=0.05,
+    ) as profiler:
+        busy(0.05)
+        assert not reports
+        busy(0.15)  # Past the flush
+        assert len(reports) == 1
+        assert not profiler.is_alive()
+    assert len(reports) == 1
+    assert "busy" in reports[0]
+    assert profiler.clean_exit is True
+
+    # Sections that end in time are stored as usual.
+    storer, reports = storing()
+    with Profiler(period=0.001, storer=storer, engine=engine, remaining=10):
+        busy(0.02)
+    assert len(reports) == 1
+
+
+def test_profiler_partial_flush_long_period():
+    """Check that the partial report is stored on time even if the sampling period is
+    longer than the time left."""
+    storer, reports = storing()
+    with Profiler(period=1, storer=storer, remaining=0.5, margin=0.2):
+        start = time.monotonic()
+        while not reports and time.monotonic() - start < 1:
+            time.sleep(0.01)
+        assert 0.25 < time.monotonic() - start < 0.45
+    assert len(reports) == 1
+
+
+def test_profiler_partial_flush_no_snapshot(monkeypatch):
+    """Check that if the signal handler can't copy the sampler, it's dumped as is."""
+    monkeypatch.setattr("pylaprof.logger", Mock())
+    sampler = Mock()
+    sampler.snapshot.side_effect = NotImplementedError
+    sampler.dump.side_effect = lambda file: file.write(b"partial")
+    storer, reports = storing()
+    with Profiler(
+        sampler=sampler, storer=storer, engine="signal", remaining=0.05, margin=0.05
+    ):
+        busy(0.05)
+    assert reports == ["partial"]
+    pylaprof.logger.warning.assert_called_once()
+
+
+@pytest.mark.parametrize("engine", ["thread", "signal"])
+def test_profiler_flush_on_sigterm(engine):
+    """Check that a partial report is stored on SIGTERM, before the previous handler
+    is called, and that the previous handler is restored when the profiler stops."""
+    calls = []
+    previous = signal.signal(signal.SIGTERM, lambda *args: calls.append(len(reports)))
+    handler = signal.getsignal(signal.SIGTERM)
+    storer, reports = storing()
+    try:
+        with Profiler(
+            period=0.001, min_time=60, storer=storer, engine=engine, remaining=60
+        ) as profiler:
+            busy(0.02)
+            start = time.monotonic()
+            os.kill(os.getpid(), signal.SIGTERM)
+            assert calls == [1]
+            assert time.monotonic() - start < profiler.margin / 2  # No snapshot
+        assert signal.getsignal(signal.SIGTERM) is handler
+        assert len(reports) == 1
+        assert "busy" in reports[0]
+
+        # SIGTERM is handled only while profiling.
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert calls == [1, 1]
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+
+def test_profiler_flush_not_main_thread(monkeypatch):
+    monkeypatch.setattr("pylaprof.logger", Mock())
+    Profiler(storer=Mock(), remaining=60).flush()  # Not running, nothing to do
+
+    handlers = []
+
+    def section():
+        with Profiler(period=0.001, storer=Mock(), remaining=60):
+            handlers.append(signal.getsignal(signal.SIGTERM))
+
+    handler = signal.getsignal(signal.SIGTERM)
+    thread = threading.Thread(target=section)
+    thread.start()
+    thread.join()
+    assert handlers == [handler]
+    pylaprof.logger.debug.assert_any_call(
+        "Not in the main thread, won't flush on SIGTERM"
+    )
+
+
+def test_profiler_annotate(monkeypatch):
+    """Check that samples of threads blocked in known calls are annotated, while those
+    of threads running Python code are not."""
+    # Fake CPU clocks: the main thread is always on CPU, the others never are.
+    main = threading.main_thread().ident
+    monkeypatch.setattr(
+        "pylaprof.time.pthread_getcpuclockid", lambda i: i, raising=False
+    )
+    monkeypatch.setattr(
+        "pylaprof.time.clock_gettime",
+        lambda clock: 2 * time.monotonic() if clock == main else 0,
+    )
+    reader, writer = socket.socketpair()
+    event = threading.Event()
+    threads = [
+        threading.Thread(target=reader.makefile("rb").read, args=(1,)),
+        threading.Thread(target=event.wait),
+    ]
+    for thread in threads:
+        thread.start()
+
+    sampler = StackCollapse()
+    try:
+        with Profiler(
+            period=0.002, single=False, sampler=sampler, storer=Mock(), annotate=True
+        ):
+            busy(0.1)
+    finally:
+        writer.send(b"x")
+        event.set()
+        for thread in threads:
+            thread.join()
+        reader.close()
+        writer.close()
+
+    leaves = defaultdict(set)  # Caller of the leaf -> leaves
+    for stack in sampler._data:
+        leaves[stack[1].split(" ", 1)[0]].add(stack[0].split(" ", 1)[0])
+    assert leaves["readinto"] == {"[IO]"}
+    assert leaves["wait"] >= {"[wait]"}  # The main thread waits in Thread.start too
+    assert leaves["busy"] == set()  # Frames of `busy` are leaves
+    assert "busy" in leaves["test_profiler_annotate"]
+
+
+def test_thread_states(monkeypatch):
+    """Check the heuristics of `_ThreadStates` with fake clocks."""
+    clocks = {"monotonic": 0, "process": 0, "own": 0, 1: 0, 2: 0}
+    monkeypatch.setattr("pylaprof.time.monotonic", lambda: clocks["monotonic"])
+    monkeypatch.setattr("pylaprof.time.process_time", lambda: clocks["process"])
+    monkeypatch.setattr("pylaprof.time.thread_time", lambda: clocks["own"])
+    monkeypatch.setattr("pylaprof.time.pthread_getcpuclockid", lambda i: i)
+    monkeypatch.setattr("pylaprof.time.clock_gettime", lambda i: clocks[i])
+    frame = sys._getframe()
+    states = _ThreadStates()
+
+    def tick(elapsed, cpu1, cpu2, own=0):
+        clocks["monotonic"] += elapsed
+        clocks[1] += cpu1
+        clocks[2] += cpu2
+        clocks["own"] += own
+        clocks["process"] += cpu1 + cpu2 + own
+        states.tick({1: frame, 2: frame})
+        return states.classify(1, frame), states.classify(2, frame)
+
+    assert tick(0, 0, 0) == (None, None)  # Nothing to compare with yet
+    assert tick(1, 1, 0, own=0.1) == (None, "[GIL wait]")
+    assert tick(1, 0, 0) == ("[off-CPU]", "[off-CPU]")
+    # Thread 1 is on CPU half of the time: in half of its samples.
+    assert [tick(1, 0.5, 0)[0] for _ in range(4)] == ["[off-CPU]", None] * 2
+
+    # Without per-thread CPU clocks only known blocking calls are annotated.
+    monkeypatch.delattr("pylaprof.time.pthread_getcpuclockid")
+    assert tick(1, 1, 0) == (None, None)
+    monkeypatch.setitem(pylaprof.BLOCKING_CALLS, (__name__, "test_thread_states"), "X")
+    assert _ThreadStates().classify(1, frame) == "X"
+
+    # Ended threads are forgotten.
+    states._threads = {i: (0, 0) for i in range(10)}
+    states.tick({1: frame})
+    assert list(states._threads) == [1]
+
+
+def test_cpu_clocks(monkeypatch):
+    """Check that clock ids are taken once per thread, and that those of threads that
+    ended aren't read."""
+    calls = []
+
+    def getcpuclockid(ident):
+        calls.append(ident)
+        if ident == 3:
+            raise OSError
+        return ident * 10
+
+    monkeypatch.setattr("pylaprof.time.pthread_getcpuclockid", getcpuclockid)
+    clocks = _cpu_clocks({1: None, 2: None, 3: None}, {})
+    assert clocks == {1: 10, 2: 20}
+    assert _cpu_clocks({1: None, 2: None}, clocks) == {1: 10, 2: 20}
+    assert calls == [1, 2, 3]
+    assert _cpu_clocks({1: None}, clocks) == {1: 10}  # Thread 2 ended
+
+    # Clocks of threads that ended can't be read anymore.
+    def clock_gettime(clock):
+        raise OSError
+
+    monkeypatch.setattr("pylaprof.time.clock_gettime", clock_gettime)
+    frame = sys._getframe()
+    states = _ThreadStates()
+    states.tick({1: frame})
+    assert states.classify(1, frame) is None
+    assert states._clocks == {}
+    threads = Threads(active=1)
+    assert threads.select({1: frame}) == [(1, frame)]
+    assert threads._clocks == {}
+
+
+def test_threads(monkeypatch):
+    """Check thread selection by name, registration and activity, and its caching."""
+    clocks = {"monotonic": 0}
+    monkeypatch.setattr("pylaprof.time.monotonic", lambda: clocks["monotonic"])
+    event = threading.Event()
+    worker = threading.Thread(target=event.wait, name="worker-1")
+    worker.start()
+    me = threading.get_ident()
+    frames = {me: SimpleNamespace(f_lasti=0), worker.ident: SimpleNamespace(f_lasti=0)}
+    try:
+        threads = Threads(name="worker-")
+        assert threads.select(frames) == [(worker.ident, frames[worker.ident])]
+        # The selection is cached...
+        worker.name = "other"
+        assert threads.select(frames) == [(worker.ident, frames[worker.ident])]
+        # ... until it's refreshed periodically or threads start or stop.
+        clocks["monotonic"] += 1
+        assert threads.select(frames) == []
+        worker.name = "worker-1"
+        assert threads.select(dict(frames, **{"42": None})) == [
+            (worker.ident, frames[worker.ident])
+        ]
+    finally:
+        event.set()
+        worker.join()
+
+    threads = Threads(registered=True)
+    assert threads.select(frames) == []
+    threads.register()
+    assert threads.select(frames) == [(me, frames[me])]
+    threads.unregister()
+    assert threads.select(frames) == []
+
+    cpu = {me: 0, worker.ident: 0}
+    monkeypatch.setattr("pylaprof.time.pthread_getcpuclockid", lambda i: i)
+    monkeypatch.setattr("pylaprof.time.clock_gettime", lambda i: cpu[i])
+    threads = Threads(active=0.1)
+    assert threads.interval == 0.1
+    assert len(threads.select(frames)) == 2  # Nothing to compare with yet
+
+    def select():
+        clocks["monotonic"] += 0.1
+        return [ident for ident, _ in threads.select(frames)]
+
+    cpu[me] += 0.01
+    assert select() == [me]
+    frames[worker.ident] = SimpleNamespace(f_lasti=0)
+    assert select() == [worker.ident]
+    frames[me].f_lasti = 2
+    assert select() == [me]
+    assert select() == []
+
+    # Without per-thread CPU clocks only frames are compared.
+    monkeypatch.delattr("pylaprof.time.pthread_getcpuclockid")
+    select()
+    frames[me].f_lasti = 4
+    assert select() == [me]
+
+    # Ended threads are forgotten.
+    del frames[worker.ident]
+    select()
+    assert list(threads._last) == [me]
+
+
+def test_profiler_threads():
+    """Check that only selected threads are sampled."""
+    event = threading.Event()
+
+    def target():
+        event.wait()
+
+    def other():
+        event.wait()
+
+    threads = [
+        threading.Thread(target=target, name="target"),
+        threading.Thread(target=other, name="other"),
+    ]
+    for thread in threads:
+        thread.start()
+
+    sampler = StackCollapse()
+    try:
+        with Profiler(
+            period=0.002,
+            single=False,
+            sampler=sampler,
+            storer=Mock(),
+            threads=Threads(name="target$"),
+        ):
+            time.sleep(0.05)
+    finally:
+        event.set()
+        for thread in threads:
+            thread.join()
+
+    assert sampled(sampler) > 0
+    for stack in sampler._data:
+        functions = {frame.split(" ", 1)[0] for frame in stack}
+        assert "target" in functions
+        assert "other" not in functions
+
+
+def sampled(sampler):
+    """Return the total number of hits of a `StackCollapse`."""
+    return sum(sampler._data.values())
+
+
+def test_profiler_snapshot():
+    """Check that snapshots can be taken while the profiler is running, and before and
+    after it runs."""
+    profiler = Profiler(period=0.001, sampler=StackCollapse(), storer=Mock())
+    assert sampled(profiler.snapshot()) == 0  # Not started: taken by the caller
+
+    with profiler:
+        time.sleep(0.05)
+        snapshot = profiler.snapshot(timeout=1)
+        delta1 = profiler.snapshot(delta=True, timeout=1)
+        time.sleep(0.05)
+        delta2 = profiler.snapshot(delta=True, timeout=1)
+        assert profiler.sampler is not snapshot
+        assert sampled(snapshot) > 0
+        assert sampled(delta1) >= sampled(snapshot)
+        assert sampled(delta2) > 0
+
+    total = sampled(profiler.sampler)
+    assert total >= sampled(delta1) + sampled(delta2)
+    assert sampled(profiler.snapshot()) == total  # Stopped: taken by the caller
+    profiler.storer.store.assert_called_once()
+
+
+def test_profiler_snapshot_signal_engine():
+    profiler = Profiler(
+        period=0.001, sampler=StackCollapse(), storer=Mock(), engine="signal"
+    )
+
+    with profiler:
+        busy(0.05)
+        # The main thread is waiting: we must not wait for CPU time to be consumed.
+        snapshot = profiler.snapshot(timeout=1)
+
+    assert sampled(snapshot) > 0
+
+
+def test_profiler_snapshot_signal_engine_idle():
+    """Check that the SIGPROFs sent by `snapshot` to wake up the main thread don't add
+    samples: an idle process has (almost) nothing to sample."""
+    profiler = Profiler(
+        period=0.1, sampler=StackCollapse(), storer=Mock(), engine="signal"
+    )
+    deltas = []
+
+    def poll():
+        for _ in range(50):
+            deltas.append(profiler.snapshot(delta=True, timeout=1))
+
+    with profiler:
+        thread = threading.Thread(target=poll)
+        thread.start()
+        while thread.is_alive():
+            time.sleep(0.01)
+
+    assert len(deltas) == 50
+    assert sum(sampled(delta) for delta in deltas) < 5
+
+
+def test_profiler_snapshot_timeout():
+    profiler = Profiler(period=60, sampler=StackCollapse(), storer=Mock())
+
+    with profiler:
+        time.sleep(0.01)  # Let the profiler reach its wait
+        with pytest.raises(TimeoutError):
+            profiler.snapshot(timeout=0.01)
+        assert profiler._requests == []
+
+
+def test_profiler_snapshot_served_on_exit():
+    """Check that pending snapshot requests are served when the profiler stops."""
+    profiler = Profiler(period=60, sampler=StackCollapse(), storer=Mock())
+    snapshots = []
+
+    with profiler:
+        time.sleep(0.01)
+        thread = threading.Thread(target=lambda: snapshots.append(profiler.snapshot()))
+        thread.start()
+        while not profiler._requests:
+            time.sleep(0.001)
+    thread.join()
+
+    assert sampled(snapshots[0]) == 1
+
+
+def test_profiler_snapshot_slow():
+    """Check that if the timeout expires while the snapshot is being taken, we wait for
+    it."""
+    sampler = Mock()
+    released = threading.Event()
+    sampler.snapshot.side_effect = lambda delta: released.wait() and "snapshot"
+    profiler = Profiler(period=0.001, sampler=sampler, storer=Mock())
+
+    with profiler:
+        threading.Timer(0.05, released.set).start()
+        assert profiler.snapshot(timeout=0.01) == "snapshot"
+
+
+def test_profiler_snapshot_error():
+    sampler = Mock()
+    sampler.snapshot.side_effect = NotImplementedError
+    profiler = Profiler(period=0.001, sampler=sampler, storer=Mock())
+
+    with profiler:
+        with pytest.raises(NotImplementedError):
+            profiler.snapshot(timeout=1)
+
+    assert profiler.clean_exit is True
+
+
+def test_serve(monkeypatch):
+    logger = Mock()
+    monkeypatch.setattr("pylaprof.logger", logger)
+    profiler = Profiler(period=0.001, sampler=StackCollapse(), storer=Mock())
+    server = serve(profiler)
+    url = "http://%s:%d" % server.server_address
+
+    try:
+        with profiler:
+            time.sleep(0.05)
+            with urllib.request.urlopen(f"{url}/snapshot") as response:
+                assert response.headers["Content-Type"].startswith("text/plain")
+                report = response.read().decode()
+            with urllib.request.urlopen(f"{url}/delta") as response:
+                delta = response.read().decode()
+        assert "test_serve" in report
+        assert "test_serve" in delta
+
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(f"{url}/nope")
+        assert exc.value.code == 404
+
+        profiler.sampler = Mock()
+        profiler.sampler.snapshot.side_effect = NotImplementedError
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(f"{url}/snapshot")
+        assert exc.value.code == 501  # Unsupported by the sampler
+
+        profiler.sampler.snapshot.side_effect = Exception
+        with pytest.raises(urllib.error.HTTPError) as exc:
+            urllib.request.urlopen(f"{url}/snapshot")
+        assert exc.value.code == 500
+        logger.exception.assert_called()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def test_profiler_decorator(monkeypatch):
     period = 0.42
     single = False
@@ -242,7 +1117,20 @@ def test_profiler_decorator(monkeypatch):
     exp_rvalue = "Hello world :)"
 
     @profile(
-        period=period, single=single, min_time=min_time, sampler=sampler, storer=storer
+        period=period,
+        single=single,
+        min_time=min_time,
+        sampler=sampler,
+        storer=storer,
+        engine="signal",
+        span=None,
+        annotate=False,
+        threads=None,
+        aggregate=None,
+        deadline=None,
+        burst=None,
+        remaining=None,
+        margin=1,
     )
     def fun():
         return exp_rvalue
@@ -251,14 +1139,242 @@ def test_profiler_decorator(monkeypatch):
 
     assert rvalue == exp_rvalue
     pmock.assert_called_with(
-        period=period, single=single, min_time=min_time, sampler=sampler, storer=storer
+        period=period,
+        single=single,
+        min_time=min_time,
+        sampler=sampler,
+        storer=storer,
+        engine="signal",
+        span=None,
+        annotate=False,
+        threads=None,
+        aggregate=None,
+        deadline=None,
+        burst=None,
+        remaining=None,
+        margin=1,
     )
     pmock().__enter__.assert_called()
     pmock().__exit__.assert_called()
 
 
+def test_profiler_decorator_remaining(monkeypatch):
+    """Check that a callable `remaining` is called with the arguments of each call."""
+    pmock = MagicMock()
+    monkeypatch.setattr("pylaprof.Profiler", pmock)
+
+    @profile(remaining=lambda event, context: context.get_remaining_time_in_millis())
+    def handler(event, context):
+        pass
+
+    handler({}, SimpleNamespace(get_remaining_time_in_millis=lambda: 1500))
+    assert pmock.call_args[1]["remaining"] == 1500
+
+
+def test_profiler_decorator_concurrent_calls():
+    """Check that with a sampler factory concurrent calls get their own reports, and
+    that all of them are collected by the aggregate."""
+    reports = []
+    storer = Mock()
+    storer.store.side_effect = lambda file: reports.append(file.read())
+    aggregate = Aggregate()
+    barrier = threading.Barrier(2)
+
+    def first():
+        busy(0.1)
+
+    def second():
+        busy(0.1)
+
+    @profile(period=0.001, sampler=StackCollapse, storer=storer, aggregate=aggregate)
+    def handler(func):
+        barrier.wait()
+        func()
+
+    threads = [threading.Thread(target=handler, args=(f,)) for f in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(reports) == 2
+    for report in reports:
+        assert (b"first (" in report) != (b"second (" in report)
+    file = BytesIO()
+    aggregate.dump(file)
+    assert b"first (" in file.getvalue()
+    assert b"second (" in file.getvalue()
+
+
+def test_profiler_decorator_aggregate():
+    """Check that samplers and sampler classes that don't dump collapsed stacks are
+    rejected with an aggregate, other factories on each call."""
+    aggregate = Aggregate()
+    for sampler in (CallGraph, CallGraph(), Tracemalloc()):
+        with pytest.raises(ValueError):
+            profile(sampler=sampler, aggregate=aggregate)
+    profile(sampler=BoundedStackCollapse, aggregate=aggregate)
+
+    @profile(sampler=lambda: CallGraph(), storer=Mock(), aggregate=aggregate)
+    def handler():
+        pass
+
+    with pytest.raises(ValueError):
+        handler()
+
+
 def test_profiler_decorator_defaults():
     """Check that profiler's decorator API is the same as class' ones."""
     assert {
         k: v for k, v in signature(Profiler.__init__).parameters.items() if k != "self"
     } == signature(profile).parameters
+
+
+def roots(report):
+    """Return the set of root frames of a stackcollapse report."""
+    return {line.split(";", 1)[0] for line in report.splitlines()}
+
+
+def test_lambda_profile(monkeypatch):
+    """Simulate warm invocations of the same Lambda container: samples of all the
+    invocations of a window are tagged with their request id and stored together."""
+    monkeypatch.setattr("pylaprof._on_shutdown", Mock())
+    reports = []
+    storer = Mock()
+    storer.store.side_effect = lambda file: reports.append(file.read().decode())
+    decorator = lambda_profile(period=0.001, storer=storer, window=60)
+
+    @decorator
+    def handler(event, context=None):
+        busy(0.03)
+        return event
+
+    assert handler("r1", SimpleNamespace(aws_request_id="r1")) == "r1"
+    sampler = decorator._sampler
+    assert handler("r2", context=SimpleNamespace(aws_request_id="r2")) == "r2"
+    assert decorator._sampler is sampler  # Kept alive between invocations
+    assert sampler.tags == ()
+    handler("untagged")
+    assert not reports  # The window isn't over yet
+
+    decorator.flush()  # E.g. at shutdown
+    assert len(reports) == 1
+    assert {"[request r1]", "[request r2]"} < roots(reports[0])
+    decorator.flush()  # Nothing sampled since the last report
+    assert len(reports) == 1
+
+    decorator.window = 0
+    handler("r3", SimpleNamespace(aws_request_id="r3"))
+    assert len(reports) == 2
+    assert roots(reports[1]) == {"[request r3]"}
+    assert decorator._sampler is None  # The next invocation starts a new window
+
+    decorator.tag = False
+    handler("r4", SimpleNamespace(aws_request_id="r4"))
+    assert len(reports) == 3
+    assert "[request r4]" not in roots(reports[2])
+
+
+def lambda_context(request_id, remaining):
+    """Return a Lambda context whose invocation times out in `remaining` seconds."""
+    deadline = time.monotonic() + remaining
+    return SimpleNamespace(
+        aws_request_id=request_id,
+        get_remaining_time_in_millis=lambda: (deadline - time.monotonic()) * 1000,
+    )
+
+
+def test_lambda_profile_timeout(monkeypatch):
+    """Simulate an invocation that times out: the report of the window is stored
+    before the deadline, and a new window starts."""
+    monkeypatch.setattr("pylaprof._on_shutdown", Mock())
+    storer, reports = storing()
+    decorator = lambda_profile(period=0.001, storer=storer, margin=0.05)
+
+    @decorator
+    def handler(event, context):
+        busy(event)
+        return len(reports)
+
+    assert handler(0.02, lambda_context("r1", 3)) == 0
+    assert handler(0.2, lambda_context("r2", 0.1)) == 1  # Stored while running
+    assert {"[request r1]", "[request r2]"} <= roots(reports[0])
+    assert decorator._sampler is None
+
+    decorator.margin = None
+    assert handler(0.1, lambda_context("r3", 0.01)) == 1
+    decorator.flush()
+    assert len(reports) == 2
+    assert roots(reports[1]) == {"[request r3]"}
+
+
+def test_lambda_profile_defaults(monkeypatch, boto3_mock):
+    monkeypatch.setattr("pylaprof._on_shutdown", Mock())
+    monkeypatch.setattr("pylaprof.logger", Mock())
+    decorator = lambda_profile(period=0.001, window=0)
+
+    @decorator
+    def handler(event, context):
+        busy(0.01)
+
+    handler({}, SimpleNamespace(aws_request_id="r1"))
+    boto3_mock.resource().Bucket().put_object.assert_called_once()
+
+    # Storage failures don't make the invocation fail.
+    boto3_mock.resource().Bucket().put_object.side_effect = Exception
+    handler({}, SimpleNamespace(aws_request_id="r2"))
+    pylaprof.logger.exception.assert_called_once()
+
+    # Nothing is stored when the profiler is disabled.
+    monkeypatch.setenv("PYLAPROF_DISABLE", "true")
+    boto3_mock.resource().Bucket().put_object.reset_mock()
+    handler({}, SimpleNamespace(aws_request_id="r3"))
+    boto3_mock.resource().Bucket().put_object.assert_not_called()
+
+
+def test_on_shutdown(monkeypatch):
+    """Check that the callback is called at exit and on SIGTERM, before the previous
+    handler of SIGTERM."""
+    register = Mock()
+    monkeypatch.setattr("pylaprof.atexit.register", register)
+    prev_handler = signal.getsignal(signal.SIGTERM)
+    calls = []
+    try:
+        signal.signal(signal.SIGTERM, lambda *args: calls.append("previous"))
+        _on_shutdown(lambda: calls.append("callback"))
+        register.assert_called_once()
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert calls == ["callback", "previous"]
+
+        # Without a previous handler, the process is terminated.
+        kill = Mock()
+        monkeypatch.setattr("pylaprof.os.kill", kill)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        _on_shutdown(lambda: calls.append("callback"))
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        assert calls[-1] == "callback"
+        assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+        kill.assert_called_once_with(os.getpid(), signal.SIGTERM)
+
+        # Ignored SIGTERMs stay ignored.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        _on_shutdown(lambda: calls.append("callback"))
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        assert len(calls) == 4
+        assert kill.call_count == 1
+    finally:
+        signal.signal(signal.SIGTERM, prev_handler)
+
+
+def test_on_shutdown_not_main_thread(monkeypatch):
+    register = Mock()
+    monkeypatch.setattr("pylaprof.atexit.register", register)
+    prev_handler = signal.getsignal(signal.SIGTERM)
+
+    thread = threading.Thread(target=_on_shutdown, args=(Mock(),))
+    thread.start()
+    thread.join()
+
+    register.assert_called_once()
+    assert signal.getsignal(signal.SIGTERM) is prev_handler
@@ -1,8 +1,25 @@
+import os
+import random
+import re
+import sys
+import threading
+import tracemalloc
 from collections import defaultdict
 from io import BytesIO
 from unittest.mock import Mock
 
-from pylaprof import StackCollapse
+import pytest
+
+from pylaprof import (
+    Aggregate,
+    BoundedStackCollapse,
+    CallGraph,
+    Rule,
+    SharedStackCollapse,
+    StackCollapse,
+    Tracemalloc,
+    _SpaceSaving,
+)
 
 
 def test_stack_collapse_init():
@@ -92,3 +109,677 @@ def test_stack_collapse_dump():
 
     file.seek(0)
     assert file.read() == exp_file
+
+
+def outer():
+    return lib_a()
+
+
+def lib_a():
+    return lib_b()
+
+
+def lib_b():
+    return inner()
+
+
+def inner():
+    return sys._getframe()
+
+
+def funcnames(stack_collapse):
+    """Return the sampled stacks as tuples of function names, outermost first."""
+    return {
+        tuple(frame.split(" ", 1)[0] for frame in stack[::-1])
+        for stack in stack_collapse._data
+    }
+
+
+def test_rule_match():
+    frame = inner()
+
+    assert Rule().match(frame)
+    assert Rule(module="tests").match(frame)
+    assert Rule(module="tests.test_sampler").match(frame)
+    assert not Rule(module="test").match(frame)
+    assert Rule(filename=os.path.dirname(__file__)).match(frame)
+    assert not Rule(filename="/nowhere").match(frame)
+    assert Rule(function="inner").match(frame)
+    assert not Rule(function="outer").match(frame)
+    assert Rule(module="tests", function="inner").match(frame)
+    assert not Rule(module="pylaprof", function="inner").match(frame)
+
+    assert Rule(module="requests").label == "[requests]"
+    assert Rule(function="inner", label="[in]").label == "[in]"
+
+
+def test_stack_collapse_exclude_include():
+    """Check that excluded frames and frames not included are dropped."""
+    frame = outer()
+    stack_collapse = StackCollapse(
+        include=[Rule(module="tests")], exclude=[Rule(function="lib_a")]
+    )
+
+    stack_collapse.sample(frame)
+
+    # Pytest frames are not included.
+    assert funcnames(stack_collapse) == {
+        ("test_stack_collapse_exclude_include", "outer", "lib_b", "inner")
+    }
+
+    # If all the frames are dropped, there's nothing to record.
+    stack_collapse = StackCollapse(exclude=[Rule()])
+    stack_collapse.sample(frame)
+    assert not stack_collapse._data
+
+
+def test_stack_collapse_fold():
+    """Check that runs of frames matching fold rules with the same label are replaced
+    with a single node."""
+    frame = outer()
+    stack_collapse = StackCollapse(
+        include=[Rule(module="tests")],
+        fold=[
+            Rule(function="lib_a", label="[lib]"),
+            Rule(function="lib_b", label="[lib]"),
+            Rule(function="test_stack_collapse_fold"),
+        ],
+    )
+
+    stack_collapse.sample(frame)
+
+    assert funcnames(stack_collapse) == {
+        ("[test_stack_collapse_fold]", "outer", "[lib]", "inner")
+    }
+
+
+def test_stack_collapse_rules_cache():
+    """Check that rules are evaluated once per code object."""
+    rule = Rule(function="inner")
+    rule.match = Mock(wraps=rule.match)
+    stack_collapse = StackCollapse(exclude=[rule])
+    frame = outer()
+
+    stack_collapse.sample(frame)
+    calls = rule.match.call_count
+    stack_collapse.sample(frame)
+
+    assert rule.match.call_count == calls
+    assert len(stack_collapse._actions) == calls
+    assert sum(stack_collapse._data.values()) == 2
+
+
+def test_stack_collapse_tags():
+    """Check that tags are added at the root of sampled stacks."""
+    frame = outer()
+    for stack_collapse in (StackCollapse(), StackCollapse(include=[Rule("tests")])):
+        stack_collapse.sample(frame)
+        stack_collapse.tags = ("[span 1]", "[request 42]")
+        stack_collapse.sample(frame)
+
+        stacks = sorted(funcnames(stack_collapse), key=len)
+        assert stacks[1] == ("[request", "[span") + stacks[0]
+
+
+def test_stack_collapse_leaf():
+    """Check that the synthetic leaf frame is added on top of the stack."""
+    frame = outer()
+    for stack_collapse in (StackCollapse(), StackCollapse(include=[Rule("tests")])):
+        stack_collapse.sample(frame)
+        stack_collapse.sample(frame, leaf="[IO]")
+
+        stacks = sorted(funcnames(stack_collapse), key=len)
+        assert stacks[1] == stacks[0] + ("[IO]",)
+
+
+def test_stack_collapse_granularity():
+    frame = inner()
+    code = frame.f_code
+
+    stack_collapse = StackCollapse(granularity="function")
+    stack_collapse.sample(frame)
+    (stack,) = stack_collapse._data
+    assert stack[0] == f"inner ({code.co_filename})"
+
+    stack_collapse = StackCollapse(granularity="firstline")
+    stack_collapse.sample(frame)
+    (stack,) = stack_collapse._data
+    assert stack[0] == f"inner ({code.co_filename}:{code.co_firstlineno})"
+
+    with pytest.raises(ValueError):
+        StackCollapse(granularity="instruction")
+
+
+def test_stack_collapse_granularity_aggregates_lines():
+    stack_collapse = StackCollapse(granularity="function", lines=True)
+    line_frames = StackCollapse(lines=True)
+    hot = Mock(co_filename="hot.py", co_name="hot", co_firstlineno=1)
+    for lineno in (2, 3, 3):
+        frame = Mock(f_code=hot, f_lineno=lineno, f_back=None, f_globals={})
+        stack_collapse.sample(frame)
+        line_frames.sample(frame)
+
+    # A single stack...
+    assert dict(stack_collapse._data) == {("hot (hot.py)",): 3}
+    # ... but line details are kept in the histogram.
+    file = BytesIO()
+    stack_collapse.dump_lines(file)
+    assert sorted(file.getvalue().decode().splitlines()) == [
+        "hot (hot.py:2) 1",
+        "hot (hot.py:3) 2",
+    ]
+    assert dict(line_frames._data) == {
+        ("hot (hot.py:2)",): 1,
+        ("hot (hot.py:3)",): 2,
+    }
+
+    # Line histogram is disabled by default.
+    file = BytesIO()
+    StackCollapse().dump_lines(file)
+    assert file.getvalue() == b""
+
+
+def test_stack_collapse_lines_innermost_kept_frame():
+    """Check that the line histogram records the innermost frame that is not dropped or
+    folded."""
+    frame = outer()
+    stack_collapse = StackCollapse(
+        fold=[Rule(function="inner")], exclude=[Rule(function="lib_b")], lines=True
+    )
+
+    stack_collapse.sample(frame)
+
+    # lib_a calls lib_b on the line after its definition
+    assert list(stack_collapse._lines) == [
+        (lib_a.__code__, lib_a.__code__.co_firstlineno + 1)
+    ]
+
+    stack_collapse = StackCollapse(fold=[Rule()], lines=True)
+    stack_collapse.sample(frame)  # Everything is folded: no line is recorded
+    assert not stack_collapse._lines
+
+
+def test_space_saving():
+    """Check Space-Saving's guarantees on a skewed stream of keys."""
+    rng = random.Random(42)
+    capacity = 20
+    counters = _SpaceSaving(capacity)
+    exact = defaultdict(lambda: 0)
+
+    for _ in range(10000):
+        key = int(rng.paretovariate(1))
+        counters[key] += 1
+        exact[key] += 1
+        assert len(counters) <= capacity
+
+    assert counters.evictions > 0
+    assert sum(counters.values()) == sum(exact.values())
+    max_error = sum(exact.values()) / capacity
+    for key, counter in counters.items():
+        error = counters.errors.get(key, 0)
+        assert counter - error <= exact[key] <= counter
+        assert error <= max_error
+    # Heavy hitters are never evicted.
+    for key, hits in exact.items():
+        if hits > max_error:
+            assert key in counters
+
+
+def test_bounded_stack_collapse():
+    bounded = BoundedStackCollapse(capacity=2, granularity="function")
+    assert bounded.capacity == 2
+    assert bounded.granularity == "function"
+
+    frames = {
+        name: Mock(
+            f_code=Mock(co_filename="m.py", co_name=name, co_firstlineno=1),
+            f_lineno=1,
+            f_back=None,
+            f_globals={},
+        )
+        for name in "abc"
+    }
+    for name in "aaaabbc":
+        bounded.sample(frames[name])
+
+    assert len(bounded._data) == 2
+    file = BytesIO()
+    bounded.dump(file)
+    # `c` replaced `b` inheriting its 2 hits, of which only 1 is guaranteed.
+    assert file.getvalue().decode().splitlines() == [
+        "a (m.py) 4",
+        "c (m.py) 1",
+        "[evicted] 2",
+    ]
+    assert bounded.evictions == 1
+
+    with pytest.raises(ValueError):
+        BoundedStackCollapse(capacity=0)
+
+
+def test_bounded_stack_collapse_no_evictions():
+    bounded = BoundedStackCollapse()
+    bounded.sample(inner())
+    file = BytesIO()
+
+    bounded.dump(file)
+
+    assert file.getvalue().count(b"\n") == 1
+    assert b"evicted" not in file.getvalue()
+    assert bounded.evictions == 0
+
+
+def test_stack_collapse_snapshot():
+    """Check that snapshots are independent copies and that deltas contain only data
+    sampled since the last delta snapshot."""
+    stack_collapse = StackCollapse(lines=True)
+    frame = Mock(
+        f_code=Mock(co_filename="m.py", co_name="f"),
+        f_lineno=1,
+        f_back=None,
+        f_globals={},
+    )
+    stack_collapse.sample(frame)
+
+    snapshot = stack_collapse.snapshot()
+    delta1 = stack_collapse.snapshot(delta=True)
+    stack_collapse.sample(frame)
+    delta2 = stack_collapse.snapshot(delta=True)
+    delta3 = stack_collapse.snapshot(delta=True)
+
+    assert isinstance(snapshot, StackCollapse)
+    assert dict(snapshot._data) == {("f (m.py:1)",): 1}
+    assert dict(delta1._data) == {("f (m.py:1)",): 1}
+    assert dict(delta2._data) == {("f (m.py:1)",): 1}
+    assert dict(delta3._data) == {}
+    assert dict(stack_collapse._data) == {("f (m.py:1)",): 2}
+    assert list(delta2._lines.values()) == [1]
+    assert not delta3._lines
+    file = BytesIO()
+    snapshot.dump(file)
+    assert file.getvalue() == b"f (m.py:1) 1\n"
+
+    # Without line histogram
+    stack_collapse = StackCollapse()
+    stack_collapse.sample(frame)
+    assert stack_collapse.snapshot(delta=True)._lines is None
+
+
+def test_bounded_stack_collapse_snapshot():
+    bounded = BoundedStackCollapse(capacity=1, lines=True)
+    frames = [
+        Mock(
+            f_code=Mock(co_filename="m.py", co_name=name),
+            f_lineno=1,
+            f_back=None,
+            f_globals={},
+        )
+        for name in "ab"
+    ]
+    for frame in frames:
+        bounded.sample(frame)
+
+    snapshot = bounded.snapshot()
+    bounded.sample(frames[0])
+
+    file = BytesIO()
+    snapshot.dump(file)
+    assert file.getvalue() == b"b (m.py:1) 1\n[evicted] 1\n"
+    assert snapshot.evictions == 1
+    assert sum(snapshot._lines.values()) == 2
+    assert BoundedStackCollapse().snapshot()._lines is None
+    with pytest.raises(ValueError):
+        bounded.snapshot(delta=True)
+
+
+def test_aggregate():
+    aggregate = Aggregate(shards=4)
+    aggregate.add(b"a;b 2\nc 1\n")
+    aggregate.add(b"a;b 3\n[evicted] 1\n\n")
+
+    file = BytesIO()
+    aggregate.dump(file)
+    assert sorted(file.getvalue().splitlines()) == [
+        b"[evicted] 1",
+        b"a;b 5",
+        b"c 1",
+    ]
+
+    with pytest.raises(ValueError):
+        Aggregate(shards=0)
+
+
+def test_aggregate_concurrent():
+    """Check that no hit is lost when many threads add reports at the same time."""
+    aggregate = Aggregate()
+    report = b"".join(b"f%d;g 1\n" % i for i in range(100))
+    barrier = threading.Barrier(8)
+
+    def add():
+        barrier.wait()
+        for _ in range(50):
+            aggregate.add(report)
+
+    threads = [threading.Thread(target=add) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    data = aggregate.snapshot()._copy()
+    assert len(data) == 100
+    assert set(data.values()) == {8 * 50}
+
+
+def test_aggregate_snapshot():
+    aggregate = Aggregate()
+    aggregate.add(b"a 1\n")
+    snapshot = aggregate.snapshot()
+    delta1 = aggregate.snapshot(delta=True)
+    aggregate.add(b"a 1\nb 1\n")
+    delta2 = aggregate.snapshot(delta=True)
+
+    assert snapshot._copy() == {b"a": 1}
+    assert delta1._copy() == {b"a": 1}
+    assert delta2._copy() == {b"a": 1, b"b": 1}
+    assert aggregate._copy() == {b"a": 2, b"b": 1}
+
+
+def test_shared_stack_collapse():
+    """Check that no sample is lost when many threads sample at the same time, that
+    samples not merged yet are counted and that tags are per thread."""
+    shared = SharedStackCollapse(flush=7, lines=True)
+    frame = chain(("main", 2), ("g", 21))
+    barrier = threading.Barrier(8)
+    release = threading.Event()
+
+    def sample():
+        shared.tags = ("[t]",)
+        barrier.wait()
+        for _ in range(100):
+            shared.sample(frame)
+        release.wait()
+
+    threads = [threading.Thread(target=sample) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while sum(shared.snapshot()._data.values()) < 800:
+        pass
+    stack = ("g (m.py:21)", "main (m.py:2)", "[t]")
+    # 100 = 14 * 7 + 2: two samples of each thread are still in its buffer.
+    assert sum(sum(b._data.values()) for b in shared._buffers.values()) == 8 * 2
+    assert dict(shared.snapshot()._data) == {stack: 800}
+    assert shared.tags == ()  # Tags were set by the other threads
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    file = BytesIO()
+    shared.dump(file)
+    assert file.getvalue() == b"[t];main (m.py:2);g (m.py:21) 800\n"
+    assert not shared._buffers  # Buffers of ended threads are merged
+    assert dict(shared._data) == {stack: 800}
+    file = BytesIO()
+    shared.dump_lines(file)
+    assert file.getvalue().endswith(b" 800\n")
+
+    with pytest.raises(ValueError):
+        SharedStackCollapse(flush=0)
+
+
+def test_shared_stack_collapse_snapshot():
+    shared = SharedStackCollapse(flush=1, granularity="function", lines=True)
+    frame = chain(("main", 2))
+    shared.sample(frame)
+    delta1 = shared.snapshot(delta=True)
+    shared.sample(frame)
+    shared.sample(frame)
+    delta2 = shared.snapshot(delta=True)
+
+    assert type(delta1) is StackCollapse
+    assert delta1.granularity == "function"
+    assert dict(delta1._data) == {("main (m.py)",): 1}
+    assert dict(delta2._data) == {("main (m.py)",): 2}
+    assert sum(delta2._lines.values()) == 2
+
+    # Without line histogram
+    shared = SharedStackCollapse(flush=2)
+    for _ in range(3):
+        shared.sample(frame)
+    delta = shared.snapshot(delta=True)
+    assert dict(delta._data) == {("main (m.py:2)",): 3}
+    assert delta._lines is None
+
+
+FIRSTLINENO = {"main": 1, "f": 10, "g": 20}
+
+
+def chain(*calls):
+    """Return the innermost of a chain of fake frames for `(function, lineno)` calls,
+    outermost first."""
+    frame = None
+    for name, lineno in calls:
+        code = Mock(co_filename="m.py", co_name=name, co_firstlineno=FIRSTLINENO[name])
+        frame = Mock(f_code=code, f_lineno=lineno, f_back=frame, f_globals={})
+    return frame
+
+
+def test_call_graph():
+    graph = CallGraph()
+    # `f` recurses at line 11: the edge is counted once per sample.
+    frame = chain(("main", 2), ("f", 11), ("f", 11), ("f", 12), ("g", 21))
+    for _ in range(2):
+        graph.sample(frame)
+    graph.sample(chain(("main", 3)))
+
+    file = BytesIO()
+    graph.dump(file)
+    assert file.getvalue().decode().split("\n\n") == [
+        "# callgrind format\nversion: 1\ncreator: pylaprof\npositions: line\n"
+        "events: Samples\nsummary: 3",
+        "fl=m.py\nfn=g\n21 2",
+        "fl=m.py\nfn=main\n3 1\ncfl=m.py\ncfn=f\ncalls=2 10\n2 2",
+        "fl=m.py\nfn=f\ncfl=m.py\ncfn=g\ncalls=2 20\n12 2\n"
+        "cfl=m.py\ncfn=f\ncalls=2 10\n11 2\n",
+    ]
+
+
+def test_call_graph_rules():
+    """Check that rules, tags and leaves work as with `StackCollapse`."""
+    graph = CallGraph(exclude=[Rule(function="main")], fold=[Rule(function="f")])
+    graph.tags = ("[span 1]",)
+    graph.sample(chain(("main", 2), ("f", 11), ("f", 12), ("g", 21)), leaf="[IO]")
+    graph.sample(chain(("main", 2)))  # Nothing is kept
+
+    synthetic = CallGraph.SYNTHETIC
+    g = ("m.py", "g", 20)
+    folded = (synthetic, "[f]", 0)
+    span = (synthetic, "[span 1]", 0)
+    assert dict(graph._self) == {((synthetic, "[IO]", 0), 0): 1}
+    assert dict(graph._calls) == {
+        (g, 21, (synthetic, "[IO]", 0)): 1,
+        (folded, 0, g): 1,
+        (span, 0, folded): 1,
+    }
+
+
+def test_call_graph_snapshot():
+    graph = CallGraph()
+    graph.sample(chain(("main", 2), ("g", 21)))
+    delta1 = graph.snapshot(delta=True)
+    graph.sample(chain(("main", 2), ("g", 21)))
+    delta2 = graph.snapshot(delta=True)
+    snapshot = graph.snapshot()
+
+    assert isinstance(snapshot, CallGraph)
+    assert list(delta1._self.values()) == [1]
+    assert list(delta2._calls.values()) == [1]
+    assert list(snapshot._self.values()) == [2]
+    assert list(snapshot._calls.values()) == [2]
+
+
+def allocate(size):
+    return bytearray(size)
+
+
+def test_tracemalloc_init():
+    sampler = Mock()
+
+    tm = Tracemalloc(
+        weight="live", interval=0.5, depth=4, max_overhead=0.1, sampler=sampler
+    )
+
+    assert tm.weight == "live"
+    assert tm.interval == 0.5
+    assert tm.depth == 4
+    assert tm.max_overhead == 0.1
+    assert tm.sampler == sampler
+    assert tm.overhead == 0
+    assert tm.snapshots == 0
+    assert tm.skipped == 0
+
+    with pytest.raises(ValueError):
+        Tracemalloc(weight="peak")
+
+
+def test_tracemalloc_allocated():
+    """Check that bytes allocated between snapshots are attributed to the allocating
+    stack and that the time sampler is fed with frames."""
+    time_sampler = Mock()
+    tm = Tracemalloc(interval=0, max_overhead=1, sampler=time_sampler)
+    frame = sys._getframe()
+
+    tm.sample(frame)  # Starts tracing and takes the baseline snapshot
+    assert tracemalloc.is_tracing()
+    data = allocate(1 << 20)
+    tm.sample(frame)
+    file = BytesIO()
+    tm.dump(file)
+
+    assert not tracemalloc.is_tracing()  # We started it, so we stopped it
+    time_sampler.sample.assert_called_with(frame)
+    assert tm.snapshots == 3
+    assert tm.overhead > 0
+    lines = file.getvalue().decode().splitlines()
+    regex = re.compile(r".*test_sampler\.py:\d+;.*test_sampler\.py:\d+ (\d+)$")
+    sizes = [int(m.group(1)) for m in map(regex.match, lines) if m]
+    assert max(sizes) >= len(data)
+
+
+def test_tracemalloc_live():
+    """Check that live bytes are reported and that tracemalloc is left alone if it was
+    already tracing."""
+    tracemalloc.start()
+    try:
+        tm = Tracemalloc(weight="live", interval=0, max_overhead=1)
+        tm.sample(sys._getframe())
+        data = allocate(1 << 20)
+        file = BytesIO()
+        tm.dump(file)
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+    sizes = [
+        int(line.rsplit(" ", 1)[1])
+        for line in file.getvalue().decode().splitlines()
+        if "test_sampler.py" in line
+    ]
+    assert max(sizes) >= len(data)
+
+
+def test_tracemalloc_reuse():
+    """Check that a dump ends the session: the next sample starts a new one."""
+    tm = Tracemalloc(interval=0, max_overhead=1)
+    frame = sys._getframe()
+    tm.sample(frame)
+    tm.dump(BytesIO())
+    assert tm._start is tm._snapshot is None
+    assert not tm._allocated
+
+    tm.sample(frame)
+    assert tracemalloc.is_tracing()
+    data = allocate(1 << 20)
+    file = BytesIO()
+    tm.dump(file)
+
+    assert not tracemalloc.is_tracing()
+    sizes = [int(line.rsplit(b" ", 1)[1]) for line in file.getvalue().splitlines()]
+    assert max(sizes) >= len(data)
+
+
+def test_tracemalloc_close():
+    """Check that closing stops tracing (if we started it) and closes the time
+    sampler."""
+    time_sampler = Mock()
+    tm = Tracemalloc(sampler=time_sampler)
+    tm.sample(sys._getframe())
+    assert tracemalloc.is_tracing()
+
+    tm.close()
+
+    assert not tracemalloc.is_tracing()
+    assert tm._start is tm._snapshot is None
+    time_sampler.close.assert_called_once()
+
+
+def test_tracemalloc_dump_without_samples():
+    for weight in ("allocated", "live"):
+        tm = Tracemalloc(weight=weight)
+        file = BytesIO()
+
+        tm.dump(file)
+
+        assert file.getvalue() == b""
+        assert tm.snapshots == 0
+
+
+def test_tracemalloc_snapshot():
+    """Check that snapshots report the bytes allocated so far while tracing goes on,
+    and that deltas only report new allocations."""
+    tm = Tracemalloc(interval=60, max_overhead=1)
+    assert dict(tm.snapshot()._data) == {}  # Not started yet
+    tm.sample(sys._getframe())
+    try:
+        data = allocate(1 << 20)
+        snapshot = tm.snapshot(delta=True)
+        assert tracemalloc.is_tracing()
+        assert type(snapshot) is StackCollapse
+        assert max(snapshot._data.values()) >= len(data)
+        stack = max(snapshot._data, key=snapshot._data.get)
+        assert "test_sampler.py" in stack[0]  # Innermost first, like StackCollapse
+        delta = tm.snapshot(delta=True)  # Only small allocations since
+        assert sum(delta._data.values()) < len(data) // 2
+        assert max(tm.snapshot()._data.values()) >= len(data)
+    finally:
+        file = BytesIO()
+        tm.dump(file)
+    assert not tracemalloc.is_tracing()
+
+
+def test_tracemalloc_interval_and_overhead(monkeypatch):
+    """Check that snapshots are taken at most once per `interval` and skipped while
+    their cost exceeds `max_overhead`."""
+    perf_counter = Mock(return_value=0)
+    monkeypatch.setattr("pylaprof.time.perf_counter", perf_counter)
+    frame = sys._getframe()
+    tm = Tracemalloc(interval=1, max_overhead=0.5)
+    try:
+        tm.sample(frame)
+        assert tm.snapshots == 1
+
+        perf_counter.return_value = 0.5  # Too early
+        tm.sample(frame)
+        assert tm.snapshots == 1
+
+        perf_counter.return_value = 1
+        tm.sample(frame)
+        assert tm.snapshots == 2
+
+        tm.overhead = 1.5  # More than half of the session spent in snapshots
+        perf_counter.return_value = 2
+        tm.sample(frame)
+        assert tm.snapshots == 2
+        assert tm.skipped == 1
+    finally:
+        tracemalloc.stop()
@@ -0,0 +1,388 @@
+import os
+import sys
+import xml.dom.minidom
+from io import StringIO
+
+import pytest
+
+from pylaprof.scripts import analyze, callgrind, diff, flame, merge, query
+
+
+def write(path, lines):
+    with open(path, "w") as fp:
+        fp.write("".join(f"{line}\n" for line in lines))
+
+
+def test_merge(tmpcwd, monkeypatch):
+    write("a.txt", ["main (m.py:1);f (m.py:2) 3", "main (m.py:1);g (m.py:3) 1"])
+    write("b.txt", ["main (m.py:1);f (m.py:2) 2"])
+    monkeypatch.setattr(sys, "argv", ["pylaprof-merge", "a.txt", "b.txt"])
+
+    merge.main()
+
+    with open(merge.DEFAULT_OUT) as fp:
+        assert sorted(fp.read().splitlines()) == [
+            "main (m.py:1);f (m.py:2) 5",
+            "main (m.py:1);g (m.py:3) 1",
+        ]
+
+
+def test_merge_tag(tmpcwd, monkeypatch):
+    """Check that only stacks tagged with the given root frame are merged."""
+    write(
+        "a.txt",
+        [
+            "[request 1];[span 1];main (m.py:1);f (m.py:2) 3",
+            "[request 1];[span 2];main (m.py:1);f (m.py:2) 2",
+            "[span 1];main (m.py:1);g (m.py:3) 1",
+            "main (m.py:1);[span 1] 4",
+            "[request 1] 5",
+        ],
+    )
+    monkeypatch.setattr(
+        sys, "argv", ["pylaprof-merge", "a.txt", "--tag", "[span 1]", "-o", "o.txt"]
+    )
+
+    merge.main()
+
+    with open("o.txt") as fp:
+        assert sorted(fp.read().splitlines()) == [
+            "[request 1];[span 1];main (m.py:1);f (m.py:2) 3",
+            "[span 1];main (m.py:1);g (m.py:3) 1",
+        ]
+
+
+def test_diff(tmpcwd, monkeypatch, capsys):
+    """Check that baseline's hits are normalized to candidate's total and that
+    regressions and improvements are ranked by self and total time."""
+    write("base.txt", ["main (m.py:1);f (m.py:2) 5", "main (m.py:1);g (m.py:3) 5"])
+    write(
+        "cand1.txt",
+        ["main (m.py:1);f (m.py:2) 10", "main (m.py:1);g (m.py:3);h (m.py:4) 5"],
+    )
+    write("cand2.txt", ["main (m.py:1);g (m.py:3) 5"])
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["pylaprof-diff", "-b", "base.txt", "-c", "cand1.txt", "cand2.txt", "-o", "d"],
+    )
+
+    diff.main()
+
+    with open("d") as fp:
+        assert sorted(fp.read().splitlines()) == [
+            "main (m.py:1);f (m.py:2) 10 10",
+            "main (m.py:1);g (m.py:3) 10 5",
+            "main (m.py:1);g (m.py:3);h (m.py:4) 0 5",
+        ]
+    out = capsys.readouterr().out
+    sections = dict(
+        (section.split("\n", 1)[0], section.split("\n")[2:])
+        for section in out.strip().split("\n\n")
+    )
+    assert sections["Top regressions by self time:"] == [
+        "  +25.00     0.00    25.00  h (m.py:4)"
+    ]
+    assert sections["Top improvements by self time:"] == [
+        "  -25.00    50.00    25.00  g (m.py:3)"
+    ]
+    assert sections["Top regressions by total time:"] == [
+        "  +25.00     0.00    25.00  h (m.py:4)"
+    ]
+    assert sections["Top improvements by total time:"] == []
+
+
+def test_diff_functions(tmpcwd):
+    """Check that line numbers can be ignored and that empty inputs are handled."""
+    write("base.txt", ["main (m.py:1);f (m.py:2) 4"])
+    write("cand.txt", ["main (m.py:3);f (m.py:7) 2"])
+    write("empty.txt", [])
+
+    out = StringIO()
+
+    diff.diff(["base.txt"], ["cand.txt"], "d", functions=True, out=out)
+    diff.diff(["empty.txt"], ["empty.txt"], "e", out=out)
+
+    with open("d") as fp:
+        assert fp.read() == "main (m.py);f (m.py) 2 2\n"
+    with open("e") as fp:
+        assert fp.read() == ""
+
+
+def test_flame_build():
+    """Check that the call tree and self/total times are computed correctly, counting
+    recursive calls only once in total time."""
+    tree = flame.build(
+        [("main;f;f", 3), ("main;f", 1), ("main;g", 2), ("other", 4), ("main;g", 1)]
+    )
+
+    frames, counts, children = tree
+    assert counts[0] == 11
+    nodes = {}
+    todo = [(0, ())]
+    while todo:
+        node, path = todo.pop()
+        for child in children[node]:
+            nodes[path + (frames[child],)] = counts[child]
+            todo.append((child, path + (frames[child],)))
+    assert nodes == {
+        ("main",): 7,
+        ("main", "f"): 4,
+        ("main", "f", "f"): 3,
+        ("main", "g"): 3,
+        ("other",): 4,
+    }
+
+    self_hits, total_hits = flame.times(tree)
+    assert self_hits == {"main": 0, "f": 4, "g": 3, "other": 4}
+    assert total_hits == {"main": 7, "f": 4, "g": 3, "other": 4}
+
+
+def test_flame_layout():
+    """Check frames' positions and that subtrees narrower than `min_hits` are pruned."""
+    tree = flame.build([("a;b", 6), ("a;c", 1), ("d", 3)])
+
+    rects = flame.layout(tree, min_hits=2)
+
+    assert sorted(rects) == [("a", 0, 0, 7), ("b", 1, 0, 6), ("d", 0, 7, 3)]
+
+
+def test_flame(tmpcwd, monkeypatch, capsys):
+    write("a.txt", ["main (m.py:1);f (m.py:2) 3", "main (m.py:1);<g> (m.py:3) 1"])
+    write("b.txt", ["main (m.py:1);f (m.py:2) 4"])
+    monkeypatch.setattr(
+        sys, "argv", ["pylaprof-flame", "a.txt", "b.txt", "-n", "1", "--title", "T&T"]
+    )
+
+    flame.main()
+
+    svg = xml.dom.minidom.parse(flame.DEFAULT_OUT)  # Well-formed
+    titles = [t.firstChild.data for t in svg.getElementsByTagName("title")]
+    assert sorted(titles) == [
+        "<g> (m.py:3) (1 samples, 12.50%)",
+        "f (m.py:2) (7 samples, 87.50%)",
+        "main (m.py:1) (8 samples, 100.00%)",
+    ]
+    assert "T&T" in [t.firstChild.data for t in svg.getElementsByTagName("text")]
+    assert capsys.readouterr().out == (
+        "Top 1 frames by self time:\n"
+        "   samples       %  frame\n"
+        "         7   87.50  f (m.py:2)\n"
+        "\n"
+        "Top 1 frames by total time:\n"
+        "   samples       %  frame\n"
+        "         8  100.00  main (m.py:1)\n"
+        "\n"
+    )
+
+
+def test_flame_empty(tmpcwd, monkeypatch, capsys):
+    write("a.txt", [])
+    monkeypatch.setattr(sys, "argv", ["pylaprof-flame", "a.txt", "-n", "0"])
+
+    flame.main()
+
+    svg = xml.dom.minidom.parse(flame.DEFAULT_OUT)
+    assert svg.getElementsByTagName("g") == []
+    assert capsys.readouterr().out == ""
+
+
+def test_flame_labels():
+    """Check that labels are truncated to fit frames and omitted from narrow ones."""
+    tree = flame.build([("a_rather_long_function_name (m.py:1) 1", 20), ("b", 1)])
+    fp = StringIO()
+
+    flame.svg(tree, fp, width=120, min_width=0)
+
+    svg = xml.dom.minidom.parseString(fp.getvalue())
+    labels = [g.getElementsByTagName("text")[0] for g in svg.getElementsByTagName("g")]
+    assert sorted(t.firstChild.data if t.firstChild else "" for t in labels) == [
+        "",
+        "a_rather_lo..",
+    ]
+
+
+def test_flame_top():
+    out = StringIO()
+
+    flame.top({"f": 3, "g": 1}, {"main": 4, "f": 3, "g": 1}, n=1, out=out)
+
+    assert "3   75.00  f\n" in out.getvalue()
+    assert "4  100.00  main\n" in out.getvalue()
+
+
+STACKS = [
+    ("main (m.py:1);f (m.py:2);f (m.py:3);g (m.py:9)", 3),
+    ("main (m.py:1);f (m.py:2)", 2),
+    ("[span 1];main (m.py:1);h (m.py:5)", 1),
+    ("main (m.py:1);h (m.py:6)", 4),
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def engine(request, monkeypatch):
+    """Run test with the vectorized and with the pure-Python analysis engine."""
+    if request.param == "python":
+        monkeypatch.setattr(analyze, "numpy", None)
+    return request.param
+
+
+def hits(columns, hits):
+    return dict(zip(columns.frames, (int(h) for h in hits)))
+
+
+def test_analyze_columns(engine):
+    columns = analyze.Columns.load(STACKS)
+
+    assert len(columns) == 4
+    assert columns.total() == 10
+    assert list(columns.offsets) == [0, 4, 6, 9, 11]
+    assert hits(columns, columns.self_hits()) == {
+        "main (m.py:1)": 0,
+        "f (m.py:2)": 2,
+        "f (m.py:3)": 0,
+        "g (m.py:9)": 3,
+        "[span 1]": 0,
+        "h (m.py:5)": 1,
+        "h (m.py:6)": 4,
+    }
+    assert columns.top(columns.total_hits(), n=3) == [
+        ("main (m.py:1)", 10),
+        ("f (m.py:2)", 5),
+        ("h (m.py:6)", 4),
+    ]
+
+    # Recursive calls are counted once per stack.
+    functions = columns.functions()
+    assert functions.frames == [
+        "main (m.py)",
+        "f (m.py)",
+        "g (m.py)",
+        "[span 1]",
+        "h (m.py)",
+    ]
+    assert hits(functions, functions.total_hits()) == {
+        "main (m.py)": 10,
+        "f (m.py)": 5,
+        "g (m.py)": 3,
+        "[span 1]": 1,
+        "h (m.py)": 5,
+    }
+    assert functions.top(functions.self_hits(), n=2) == [
+        ("h (m.py)", 5),
+        ("g (m.py)", 3),
+    ]
+
+
+def test_analyze_columns_filter(engine):
+    columns = analyze.Columns.load(STACKS)
+
+    filtered = columns.filter(["main (m.py:1)", "f (m.py:2)"])
+    assert len(filtered) == 2
+    assert filtered.total() == 5
+    assert list(filtered.offsets) == [0, 4, 6]
+    assert [filtered.frames[i] for i in filtered.ids[4:]] == [
+        "main (m.py:1)",
+        "f (m.py:2)",
+    ]
+    assert filtered.top(filtered.self_hits()) == [("g (m.py:9)", 3), ("f (m.py:2)", 2)]
+
+    assert columns.filter(["[span 1]"]).total() == 1
+    empty = columns.filter(["nope"])
+    assert len(empty) == 0
+    assert empty.top(empty.self_hits()) == []
+    assert empty.top(empty.total_hits()) == []
+
+
+def test_analyze(tmpcwd, monkeypatch, capsys, engine):
+    write("a.txt", [f"{stack} {hits}" for stack, hits in STACKS[:2]])
+    write("b.txt", [f"{stack} {hits}" for stack, hits in STACKS[2:]])
+    monkeypatch.setattr(
+        sys, "argv", ["pylaprof-analyze", "a.txt", "b.txt", "-n", "1", "-f"]
+    )
+
+    analyze.main()
+
+    assert capsys.readouterr().out == (
+        "4 stacks, 10 samples\n"
+        "\nTop 1 frames by self time:\n"
+        "   samples       %  frame\n"
+        "         5   50.00  h (m.py)\n"
+        "\nTop 1 frames by total time:\n"
+        "   samples       %  frame\n"
+        "        10  100.00  main (m.py)\n"
+    )
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["pylaprof-analyze", "a.txt", "b.txt", "-p", "main (m.py:1);h (m.py:6)"],
+    )
+    analyze.main()
+    assert capsys.readouterr().out.startswith("1 stacks, 4 samples\n")
+
+    out = StringIO()
+    analyze.analyze(["a.txt", "b.txt"], prefix=["nope"], out=out)
+    assert out.getvalue().startswith("0 stacks, 0 samples\n")
+
+
+def test_callgrind_parse():
+    assert callgrind.parse("f (m.py:12)") == (("m.py", "f", 0), 12)
+    assert callgrind.parse("f (c:/m.py:12)") == (("c:/m.py", "f", 0), 12)
+    assert callgrind.parse("f (m.py)") == (("m.py", "f", 0), 0)
+    assert callgrind.parse("[span 1]") == (("[pylaprof]", "[span 1]", 0), 0)
+
+
+def test_callgrind(tmpcwd, monkeypatch):
+    write("a.txt", ["main (m.py:2);f (m.py:11);g (m.py:21) 2", "main (m.py:3) 1"])
+    write("b.txt", ["[span 1];main (m.py:2);f (m.py:11);g (m.py:21) 1"])
+    monkeypatch.setattr(sys, "argv", ["pylaprof-callgrind", "a.txt", "b.txt"])
+
+    callgrind.main()
+
+    with open(callgrind.DEFAULT_OUT) as fp:
+        blocks = fp.read().split("\n\n")
+    assert blocks[0].endswith("summary: 4")
+    assert "fl=m.py\nfn=g\n21 3" in blocks
+    assert "fl=m.py\nfn=main\n3 1\ncfl=m.py\ncfn=f\ncalls=3 0\n2 3" in blocks
+    assert "fl=[pylaprof]\nfn=[span 1]\ncfl=m.py\ncfn=main\ncalls=1 0\n0 1\n" in blocks
+
+
+def test_query(tmpcwd, monkeypatch, capsys):
+    write("a.txt", ["main (m.py:1);f (m.py:2) 3", "main (m.py:1);g (m.py:3) 1"])
+    write("b.txt", ["main (m.py:1);f (m.py:4) 4"])
+    os.utime("b.txt", (7200, 7200))
+
+    def run(*args):
+        monkeypatch.setattr(sys, "argv", ["pylaprof-query", "-d", "t.db", *args])
+        query.main()
+        lines = capsys.readouterr().out.splitlines()[1:]
+        return [line.split(None, 2) for line in lines]
+
+    run("ingest", "a.txt", "--time", "1970-01-01T00:30:00", "--partition", "60")
+    run("ingest", "b.txt")
+    with pytest.raises(SystemExit):  # Stored partition is 60 seconds
+        run("ingest", "b.txt", "--partition", "3600")
+    assert "partitioned by 60 seconds" in capsys.readouterr().err
+
+    assert run("top") == [
+        ["7", "87.50", "f (m.py)"],
+        ["1", "12.50", "g (m.py)"],
+    ]
+    assert run("top", "--total", "-n", "1") == [["8", "100.00", "main (m.py)"]]
+    assert run("top", "--since", "1970-01-01T01:00:00+00:00") == [
+        ["4", "100.00", "f (m.py)"]
+    ]
+    assert run("callers", "f") == [["7", "87.50", "main (m.py)"]]
+    assert run("callees", "main (m.py)", "--until", "1970-01-01T01:00") == [
+        ["3", "75.00", "f (m.py)"],
+        ["1", "25.00", "g (m.py)"],
+    ]
+    assert run("totals") == [
+        ["4", "50.00", "1970-01-01T00:30:00+00:00"],
+        ["4", "50.00", "1970-01-01T02:00:00+00:00"],
+    ]
+
+    out = StringIO()  # An empty database
+    query.table([], "function", 0, out=out)
+    assert out.getvalue().split() == ["samples", "%", "function"]
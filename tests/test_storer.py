@@ -3,9 +3,10 @@ import os
 from unittest.mock import Mock
 from uuid import UUID
 
+import pytest
 from freezegun import freeze_time
 
-from pylaprof import FS, S3
+from pylaprof import FS, S3, SQLite, _function
 
 dummy_report = os.path.dirname(__file__) + "/dummy-report.txt"
 
@@ -78,3 +79,93 @@ def test_s3_store(boto3_mock):
 
         fp.seek(0)
         bucket.put_object.assert_called_with(Body=fp.read(), Key=key(), **put_obj_opts)
+
+
+def test_function():
+    assert _function("main (app.py:12)") == "main (app.py)"
+    assert _function("main (C:\\app.py:12)") == "main (C:\\app.py)"
+    assert _function("main (app.py)") == "main (app.py)"
+    assert _function("[IO]") == "[IO]"
+
+
+def test_sqlite_store(tmpcwd):
+    db = SQLite("test.db", now=lambda: 7200.5, partition=3600)
+    with open(dummy_report, "rb") as fp:
+        db.store(fp)
+
+    # Check queries against the report itself.
+    self_hits = {}
+    with open(dummy_report) as fp:
+        for line in fp:
+            stack, hits = line.rsplit(" ", 1)
+            function = _function(stack.rsplit(";", 1)[-1])
+            self_hits[function] = self_hits.get(function, 0) + int(hits)
+    top = db.top(n=100)
+    assert dict(top) == self_hits
+    assert [hits for _, hits in top] == sorted(self_hits.values(), reverse=True)
+    assert db.top(n=1) == top[:1]
+    assert db.totals() == [(7200, sum(self_hits.values()))]
+
+    handler = "handler (/home/gius/pylaprof/tests/handler.py)"
+    assert dict(db.top(n=100, total=True))[handler] == 742
+    assert dict(db.callers("handler")) == {
+        "main (/home/gius/pylaprof/tests/launcher.py)": 742
+    }
+    assert dict(db.callees(handler)) == {
+        "sleepy_task (/home/gius/pylaprof/tests/handler.py)": 290,
+        "cpu_intens_task (/home/gius/pylaprof/tests/handler.py)": 162,
+        "io_task (/home/gius/pylaprof/tests/handler.py)": 290,
+    }
+    assert db.callers("hand") == []  # Not a prefix match
+    assert db.callers("hand%") == []  # Nor a pattern
+
+
+def test_sqlite_calls_case(tmpcwd):
+    """Check that function names are matched case-sensitively."""
+    db = SQLite("test.db")
+    db.ingest(
+        [
+            ("main (a.py:1);f (a.py:2)", 1),
+            ("Main (a.py:1);f (a.py:3)", 2),
+            ("MAIN (b.py:1);f (b.py:2)", 4),
+        ],
+        0,
+    )
+    assert db.callees("main") == [("f (a.py)", 1)]
+    assert db.callees("Main") == [("f (a.py)", 2)]
+    assert db.callees("MAIN (b.py)") == [("f (b.py)", 4)]
+    assert db.callees("mAIN") == []
+
+
+def test_sqlite_ingest_incremental(tmpcwd):
+    """Check that reports are added to the ones already in the database, by time
+    partition, and that recursive functions are counted once in total time."""
+    SQLite("test.db", partition=60).ingest([("main (a.py:1);f (a.py:2)", 2)], 100)
+    db = SQLite("test.db")
+    db.ingest(
+        [
+            ("main (a.py:1);f (a.py:2)", 1),
+            ("main (a.py:1);f (a.py:2);f (a.py:3);[IO]", 4),
+        ],
+        130,
+    )
+
+    assert db.totals() == [(60, 2), (120, 5)]
+    assert db.totals(since=125) == [(120, 5)]
+    assert db.totals(until=119) == [(60, 2)]
+    assert db.top(total=True) == [("f (a.py)", 7), ("main (a.py)", 7), ("[IO]", 4)]
+    assert db.top(since=120) == [("[IO]", 4), ("f (a.py)", 1)]
+    assert db.callers("f") == [("main (a.py)", 7), ("f (a.py)", 4)]
+    assert db.callees("f (a.py)", until=60) == []
+    assert db.callees("f (a.py)") == [("[IO]", 4), ("f (a.py)", 4)]
+
+
+def test_sqlite_partition(tmpcwd):
+    """Check that the partition is set when the database is created."""
+    assert SQLite("test.db").partition == 3600
+    assert SQLite("test.db", partition=3600).partition == 3600
+    with pytest.raises(ValueError):
+        SQLite("test.db", partition=60)
+
+    assert SQLite("other.db", partition=60).partition == 60
+    assert SQLite("other.db").partition == 60